@@ -0,0 +1,68 @@
+from collections import deque
+from itertools import count
+from constants import PLAYER_1, PLAYER_2, FPS
+
+
+# В этом файле находится очередь действий игроков, через которую действия попадают в игровой цикл сервера
+
+
+class ActionQueue:
+    """Ограниченная FIFO очередь действий игроков, у каждого игрока своя.
+    Потоки клиентов добавляют действия, а игровой цикл раз в тик забирает все накопившиеся действия разом.
+    Добавление и извлечение из deque атомарны, поэтому блокировки не нужны.
+    Каждый игрок может совершать не более rate действий в секунду (с запасом в burst действий),
+    одинаковые действия игрока за один тик схлопываются в одно"""
+    def __init__(self, players=(PLAYER_1, PLAYER_2), max_length=32, rate=10, burst=5):
+        self.max_length = max_length
+        self.rate = rate
+        self.burst = burst
+        self.queues = {player: deque() for player in players}
+        self.tokens = {player: burst for player in players}  # сколько действий игрок может совершить прямо сейчас
+        # Каждый счётчик изменяется только одним потоком: received и dropped - потоком клиента, остальные - игровым
+        self.counters = {player: {'received': 0, 'dropped': 0, 'applied': 0, 'rate_limited': 0, 'coalesced': 0,
+                                  'invalid': 0} for player in players}
+        self.sequence = count()  # сквозная нумерация действий, чтобы сохранить порядок между игроками
+
+    def put(self, player, action, data):
+        """Добавляет действие в очередь игрока. Если очередь переполнена, действие отбрасывается"""
+        self.counters[player]['received'] += 1
+        queue = self.queues[player]
+        if len(queue) >= self.max_length:
+            self.counters[player]['dropped'] += 1
+            return False
+        queue.append((next(self.sequence), action, data))
+        return True
+
+    def drain(self, parse):
+        """Забирает все накопившиеся действия и возвращает список (игрок, действие, аргументы, исходные аргументы)
+        в порядке поступления. parse(игрок, действие, аргументы) проверяет действие и возвращает разобранные
+        аргументы либо вызывает ValueError, если действие некорректно"""
+        batch = []
+        for player, queue in self.queues.items():
+            counters = self.counters[player]
+            self.tokens[player] = min(self.tokens[player] + self.rate / FPS, self.burst)
+            seen = set()
+            # Забираем не больше действий, чем было в очереди на момент начала: клиент может добавлять новые
+            for _ in range(len(queue)):
+                sequence_number, action, data = queue.popleft()
+                key = (action, tuple(data))
+                if key in seen:
+                    counters['coalesced'] += 1
+                    continue
+                seen.add(key)
+                try:
+                    parsed_data = parse(player, action, data)
+                except ValueError:
+                    counters['invalid'] += 1
+                    continue
+                if self.tokens[player] < 1:
+                    counters['rate_limited'] += 1
+                    continue
+                self.tokens[player] -= 1
+                counters['applied'] += 1
+                batch.append((sequence_number, player, action, parsed_data, data))
+        batch.sort(key=lambda item: item[0])
+        return [(player, action, parsed_data, data) for _, player, action, parsed_data, data in batch]
+
+    def __len__(self):
+        return sum(map(len, self.queues.values()))
@@ -0,0 +1,513 @@
+"""Бенчмарки серверной части онлайн режима.
+Запуск из корня проекта: python benchmarks.py <бенчмарк> [параметры], список бенчмарков - python benchmarks.py -h"""
+import os
+import sys
+import math
+import time
+import socket
+import pickle
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import deque
+from constants import *
+from protocol import *
+from headless import load_game_class
+from input_log import state_hash
+from tick_profiler import TickProfiler, Histogram, TOTAL, format_histograms
+try:
+    import resource
+except ImportError:  # не Unix: процессорное время сервера не замеряется, см. children_cpu_time
+    resource = None
+
+
+HOST = '127.0.0.1'
+ACTION_RATE = 0.5  # сколько действий в секунду в среднем отправляет бот
+TOWER_SHARE = 0.2  # доля спавнов башен среди случайных действий бота
+PING_RATE = 5  # сколько раз в секунду бот нагрузочного теста замеряет задержку
+# Места под башни игроков - левый верхний угол плента, как их отправляет клиент (см. online_game.py)
+PLANTS = {PLAYER_1: (619, 259), PLAYER_2: (1027, 610)}
+
+
+def wait_for_server(host, port, timeout=10):
+    """Ждёт, пока запущенный сервер начнёт принимать подключения"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            # Пробное подключение сервер принимает за игрока, даём ему время закрыть созданную комнату:
+            time.sleep(0.5)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError('Сервер не запустился')
+
+
+def random_action(player, rng):
+    """Возвращает команду спавна случайного моба на случайной дороге или случайной башни на плент игрока"""
+    if rng.random() < TOWER_SHARE:
+        return f"spawn_tower {rng.choice(TOWER_TYPES)} {';'.join(map(str, PLANTS[player]))}"
+    x = 150 if player == PLAYER_1 else WIDTH - 150
+    return f'spawn_mob {rng.choice(MOBS)} {rng.randint(0, 2)} {x};540'
+
+
+def load_script(path):
+    """Читает сценарий нагрузочного теста: строки вида "<секунда от подключения> <игрок> <действие>",
+    например "2.5 1 spawn_mob skillet 0 150;540". Пустые строки и комментарии после # пропускаются"""
+    script = []
+    with open(path, 'r') as script_file:
+        for line in script_file:
+            line = line.split('#')[0].strip()
+            if line:
+                seconds, player, action = line.split(maxsplit=2)
+                script.append((float(seconds), int(player), action))
+    script.sort(key=lambda entry: entry[0])
+    return script
+
+
+class BotActions:
+    """Действия одного бота: строки сценария (см. load_script), если он задан, иначе случайные действия,
+    в среднем rate в секунду"""
+    def __init__(self, rng, rate=ACTION_RATE, script=None):
+        self.rng = rng
+        self.rate = rate
+        self.script = script
+        self.position = 0  # первая невыполненная строка сценария
+        self.next_time = rng.expovariate(rate) if rate else math.inf  # время следующего случайного действия
+
+    def take(self, player, elapsed):
+        """Действия игрока player, время которых наступило через elapsed секунд после подключения"""
+        actions = []
+        if self.script is not None:
+            while self.position < len(self.script) and self.script[self.position][0] <= elapsed:
+                _, script_player, action = self.script[self.position]
+                if script_player == player:
+                    actions.append(action)
+                self.position += 1
+            return actions
+        while self.next_time <= elapsed:
+            actions.append(random_action(player, self.rng))
+            self.next_time += self.rng.expovariate(self.rate)
+        return actions
+
+
+def new_bot_stats():
+    """Общая статистика ботов: задержки, принятые состояния и байты, отправленные действия, ошибки соединения"""
+    return {'snapshots': 0, 'bytes': 0, 'actions': 0, 'errors': 0, 'rtt': Histogram()}
+
+
+async def connect(host, port, stats):
+    """Подключается к серверу, при ошибке учитывает её в статистике и возвращает None"""
+    try:
+        return await asyncio.open_connection(host, port)
+    except OSError:
+        stats['errors'] += 1
+        return None
+
+
+async def legacy_bot(host, port, deadline, stats, actions, ping_interval=None):
+    """Бот, ведущий себя как клиент online_game.OnlineGame: раз в кадр отправляет действие и получает ответ.
+    Задержкой считается время от отправки до ответа, поэтому ping_interval не нужен"""
+    connection = await connect(host, port, stats)
+    if connection is None:
+        return
+    reader, writer = connection
+    start = time.perf_counter()
+    player = pickle.loads(await reader.read(1024))
+    pending = deque()  # сервер разбирает одно действие за кадр, остальные ждут следующих кадров
+    try:
+        while time.perf_counter() < deadline:
+            frame_start = time.perf_counter()
+            pending.extend(actions.take(player, frame_start - start))
+            action = pending.popleft() if pending else 'ok'
+            writer.write(action.encode())
+            await writer.drain()
+            data = await reader.read(1 << 16)
+            if not data:
+                break
+            stats['rtt'].add(time.perf_counter() - frame_start)
+            stats['snapshots'] += 1
+            stats['bytes'] += len(data)
+            stats['actions'] += action != 'ok'
+            await asyncio.sleep(max(TICK - (time.perf_counter() - frame_start), 0))
+    except ConnectionError:
+        if time.perf_counter() < deadline:  # после конца замера соединение рвёт вышедший соперник
+            stats['errors'] += 1
+    writer.close()
+
+
+async def send_pings(writer, interval):
+    """Раз в interval секунд отправляет серверу PING со временем отправки"""
+    while True:
+        writer.write(pack_message(PING, encode_ping(time.perf_counter())))
+        await asyncio.sleep(interval)
+
+
+async def framed_bot(host, port, deadline, stats, actions, ping_interval=None):
+    """Аналог legacy_bot для протокола с заголовками сообщений.
+    Состояние игры сервер присылает сам, бот только подтверждает его и отправляет действия.
+    Если задан ping_interval, бот раз в ping_interval секунд замеряет задержку сообщениями PING и PONG"""
+    connection = await connect(host, port, stats)
+    if connection is None:
+        return
+    reader, writer = connection
+    start = time.perf_counter()
+    pinger = None
+    try:
+        message_type, body = await read_message(reader)
+        player = decode_hello(body)
+        if ping_interval:
+            pinger = asyncio.create_task(send_pings(writer, ping_interval))
+        while time.perf_counter() < deadline:
+            message_type, body = await read_message(reader)
+            now = time.perf_counter()
+            stats['bytes'] += HEADER.size + len(body)
+            if message_type == SNAPSHOT:
+                # Подтверждаем тик, чтобы сервер присылал дельты, как настоящему клиенту
+                writer.write(pack_message(ACK, encode_ack(SNAPSHOT_HEADER.unpack_from(body)[0])))
+                for action in actions.take(player, now - start):
+                    writer.write(pack_message(ACTION, action.encode()))
+                    stats['actions'] += 1
+                await writer.drain()
+                stats['snapshots'] += 1
+            elif message_type == PONG:
+                stats['rtt'].add(now - decode_ping(body))
+    except (ConnectionError, asyncio.IncompleteReadError):
+        if time.perf_counter() < deadline:
+            stats['errors'] += 1
+    if pinger is not None:
+        pinger.cancel()
+    writer.close()
+
+
+async def run_bots(host, port, matches, duration, protocol=FRAMED, seed=0, rate=ACTION_RATE, script=None,
+                   ping_rate=0):
+    """Запускает matches * 2 ботов, которые сервер рассаживает по комнатам парами, и возвращает их общую
+    статистику (см. new_bot_stats)"""
+    stats = new_bot_stats()
+    deadline = time.perf_counter() + duration
+    rng = random.Random(seed)
+    bot = framed_bot if protocol == FRAMED else legacy_bot
+    ping_interval = 1 / ping_rate if ping_rate else None
+    bots = []
+    for _ in range(matches * 2):
+        actions = BotActions(random.Random(rng.random()), rate, script)
+        bots.append(asyncio.create_task(bot(host, port, deadline, stats, actions, ping_interval)))
+        await asyncio.sleep(0.005)  # не забиваем очередь подключений сервера
+    await asyncio.gather(*bots)
+    return stats
+
+
+def children_cpu_time():
+    """Процессорное время завершённых дочерних процессов, сек, или None, если его нельзя узнать"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark_server(args):
+    """Сравнивает многопоточный и асинхронный сервер по числу матчей на одно ядро процессора,
+    а также сервер с разным числом процессов-обработчиков (--workers) по числу матчей на машину.
+    Сервер запускается в дочернем процессе, процессорное время которого (вместе с обработчиками)
+    измеряется через getrusage (вне Unix колонки с процессорным временем пустые).
+    delivered - доля состояний игры, дошедших до ботов, от положенного по частоте рассылки"""
+    print(f'{"mode":>9} {"workers":>8} {"matches":>8} {"cpu, s":>8} {"load":>6} {"snapshots/s":>12} '
+          f'{"delivered":>10} {"matches/core":>13}')
+    for mode in args.modes:
+        for workers in args.workers:
+            for matches in args.matches:
+                cpu_before = children_cpu_time()
+                server = subprocess.Popen([sys.executable, 'server.py', '--mode', mode, '--port', str(args.port),
+                                           '--protocol', args.protocol, '--send-rate', str(args.send_rate),
+                                           '--workers', str(workers), '--metrics-port', '0'],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    wait_for_server(HOST, args.port)
+                    start = time.perf_counter()
+                    stats = asyncio.run(run_bots(HOST, args.port, matches, args.duration, args.protocol))
+                    wall_time = time.perf_counter() - start
+                finally:
+                    server.terminate()
+                    server.wait()
+                snapshot_rate = stats['snapshots'] / wall_time
+                send_rate = args.send_rate if args.protocol == FRAMED else FPS
+                delivered = snapshot_rate / (matches * 2 * send_rate)
+                if cpu_before is None:
+                    cpu_columns = f'{"-":>8} {"-":>6}'
+                    matches_per_core = '-'
+                else:
+                    cpu_time = children_cpu_time() - cpu_before
+                    load = cpu_time / wall_time  # доля одного ядра, занятая сервером
+                    cpu_columns = f'{cpu_time:>8.2f} {load:>6.2f}'
+                    matches_per_core = f'{matches / max(load, 1e-9):.0f}'
+                print(f'{mode:>9} {workers:>8} {matches:>8} {cpu_columns} {snapshot_rate:>12.0f} '
+                      f'{delivered:>10.0%} {matches_per_core:>13}')
+
+
+def process_status(pid):
+    """Число потоков и занятая физическая память процесса (Linux), байт"""
+    status = {}
+    with open(f'/proc/{pid}/status', 'r') as status_file:
+        for line in status_file:
+            key, _, value = line.partition(':')
+            status[key] = value.split()
+    return int(status['Threads'][0]), int(status['VmRSS'][0]) * 1024
+
+
+def benchmark_soak(args):
+    """Проверяет, что сервер освобождает ресурсы закончившихся матчей: проводит тысячи коротких матчей
+    волнами по --concurrency и после каждых --sample-every матчей замеряет число потоков и память сервера.
+    Первая половина матчей считается прогревом: память растёт, пока аллокатор Python не наберёт арены под пиковое
+    число одновременных матчей. Если за вторую половину потоков стало больше или память выросла больше чем
+    на --rss-tolerance, бенчмарк завершается с кодом 1"""
+    failed = False
+    for mode in args.modes:
+        server = subprocess.Popen([sys.executable, 'server.py', '--mode', mode, '--port', str(args.port),
+                                   '--metrics-port', '0'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(HOST, args.port)
+            print(f'{mode}:')
+            print(f'{"matches":>8} {"threads":>8} {"rss, MB":>8} {"errors":>7}')
+            samples = []  # (потоки, память) после каждых sample_every матчей
+            matches = errors = 0
+            while matches < args.matches:
+                wave = min(args.concurrency, args.matches - matches)
+                stats = asyncio.run(run_bots(HOST, args.port, wave, args.match_duration, seed=matches))
+                matches += wave
+                errors += stats['errors']
+                if matches % args.sample_every < wave or matches == args.matches:
+                    time.sleep(args.settle)  # сервер закрывает комнаты, когда замечает отключение игроков
+                    threads, rss = process_status(server.pid)
+                    print(f'{matches:>8} {threads:>8} {rss / 1e6:>8.1f} {errors:>7}')
+                    samples.append((threads, rss))
+            baseline = samples[(len(samples) - 1) // 2]
+            growth = rss / baseline[1] - 1
+            leaked = threads > baseline[0] or growth > args.rss_tolerance
+            failed |= leaked
+            print(f'threads {baseline[0]} -> {threads}, rss {growth:+.1%}: {"LEAK" if leaked else "flat"}')
+        finally:
+            server.terminate()
+            server.wait()
+    if failed:
+        sys.exit(1)
+
+
+def populate_game(game, mobs_per_side, seed=0):
+    """Наполняет серверную игру мобами и башнями обоих игроков, минуя проверку денег"""
+    import server
+    rng = random.Random(seed)
+    for player in (PLAYER_1, PLAYER_2):
+        game.players_cache[player] = float('inf')
+        for _ in range(mobs_per_side):
+            x = rng.randint(0, WIDTH // 4 - 1) if player == PLAYER_1 else rng.randint(WIDTH // 4 * 3 + 1, WIDTH)
+            game.handle_player_action(player, 'spawn_mob', (rng.choice(MOBS), rng.randint(0, 2), (x, rng.randint(0, HEIGHT))))
+    for player, coords in PLANTS.items():
+        for tower_type in TOWER_TYPES:
+            tower = server.TOWERS[tower_type]
+            game.place_tower(player, tower(player, coords, game.mob_grids, game.bullets, game.sounds_query))
+        game.players_cache[player] = 100
+    return game
+
+
+def benchmark_protocol(args):
+    """Сравнивает скорость кодирования и декодирования состояния игры через struct (protocol.py) и через pickle.
+    Для протокола замеряется и полное состояние, и дельта относительно предыдущего тика"""
+    import pickle
+    import server
+    game = populate_game(server.OnlineGame(seed=0), args.mobs)
+    for _ in range(args.ticks):  # прогоняем игру, чтобы появились снаряды, стычки и звуки
+        game.update()
+    snapshot = game.snapshot
+    previous = game.snapshots.get(snapshot.tick - 1)
+    print(f'{len(snapshot.as_tuple()[0])} mobs, {len(snapshot.as_tuple()[1])} towers, '
+          f'{len(snapshot.as_tuple()[2])} bullets')
+    entities_count = len(snapshot.entities)
+
+    def encode_message(base):
+        snapshot.wire = None  # записи сущностей кэшируются в состоянии, а замеряется кодирование с нуля
+        return pack_message(SNAPSHOT, encode_snapshot(snapshot, base))
+
+    codecs = (
+        ('pickle', lambda: pickle.dumps(snapshot.as_tuple()), pickle.loads),
+        ('keyframe', lambda: encode_message(None), lambda data: decode_snapshot(data[HEADER.size:], game.snapshots)),
+        ('delta', lambda: encode_message(previous), lambda data: decode_snapshot(data[HEADER.size:], game.snapshots))
+    )
+    print(f'{"codec":>8} {"bytes":>8} {"B/entity":>9} {"encode/s":>10} {"decode/s":>10} {"encode MB/s":>12} '
+          f'{"decode MB/s":>12}')
+    for name, encode, decode in codecs:
+        data = encode()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            encode()
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            decode(data)
+        decode_time = time.perf_counter() - start
+        megabytes = len(data) * args.repeat / 1e6
+        print(f'{name:>8} {len(data):>8} {len(data) / entities_count:>9.1f} {args.repeat / encode_time:>10.0f} '
+              f'{args.repeat / decode_time:>10.0f} {megabytes / encode_time:>12.1f} {megabytes / decode_time:>12.1f}')
+
+
+def benchmark_tick(args):
+    """Замеряет время тика серверной игры при разном количестве мобов у каждого игрока на разных движках"""
+    print(f'{"engine":>8} {"mobs":>6} {"tick, ms":>9} {"p99, ms":>8} {"max, ms":>8} {"skirmishes, ms":>15} '
+          f'{"fighting":>9}')
+    for mobs in args.mobs:
+        for engine in args.engines:
+            game = populate_game(load_game_class(engine)(seed=args.seed), mobs, args.seed)
+            game.profiler = TickProfiler(window=args.ticks)
+            for _ in range(args.ticks):
+                game.update()
+            histograms = game.profiler.histograms()
+            fighting = sum(mob.state == 'attack' for player in (PLAYER_1, PLAYER_2) for mob in game.mobs[player])
+            print(f'{engine:>8} {mobs:>6} {histograms[TOTAL].mean() * 1000:>9.2f} '
+                  f'{histograms[TOTAL].percentile(99) * 1000:>8.2f} {histograms[TOTAL].max * 1000:>8.2f} '
+                  f'{histograms["skirmishes"].mean() * 1000:>15.2f} {fighting:>9}')
+            if args.phases:
+                for line in format_histograms(histograms):
+                    print(' ' * 8, line)
+
+
+def benchmark_load(args):
+    """Нагрузочный тест уже запущенного сервера (например, python server.py --mode asyncio): --clients ботов
+    подключаются к нему, сервер рассаживает их по комнатам парами, и боты играют как клиенты online_game.OnlineGame -
+    подтверждают состояния игры и спавнят мобов и башни, случайно или по сценарию (--script, см. load_script).
+    Для каждого числа ботов выводит процентили задержки (PING -> PONG, в протоколе legacy - действие -> ответ),
+    частоту принятых состояний игры и входящий трафик, всего и на одного бота"""
+    script = load_script(args.script) if args.script else None
+    wait_for_server(args.host, args.port)
+    print(f'{"clients":>8} {"rtt p50, ms":>12} {"p90, ms":>8} {"p99, ms":>8} {"max, ms":>8} {"snapshots/s":>12} '
+          f'{"per bot":>8} {"KB/s":>9} {"per bot":>8} {"actions":>8} {"errors":>7}')
+    for clients in args.clients:
+        start = time.perf_counter()
+        stats = asyncio.run(run_bots(args.host, args.port, clients // 2, args.duration, args.protocol, args.seed,
+                                     args.action_rate, script, args.ping_rate))
+        wall_time = time.perf_counter() - start
+        rtt = stats['rtt']
+        snapshot_rate = stats['snapshots'] / wall_time
+        traffic = stats['bytes'] / wall_time / 1000
+        print(f'{clients:>8} {rtt.percentile(50) * 1000:>12.2f} {rtt.percentile(90) * 1000:>8.2f} '
+              f'{rtt.percentile(99) * 1000:>8.2f} {rtt.max * 1000:>8.2f} {snapshot_rate:>12.0f} '
+              f'{snapshot_rate / clients:>8.1f} {traffic:>9.1f} {traffic / clients:>8.2f} {stats["actions"]:>8} '
+              f'{stats["errors"]:>7}')
+        time.sleep(args.settle)  # сервер закрывает комнаты, когда замечает отключение ботов
+
+
+def benchmark_engines(args):
+    """Проверяет, что движки objects и numpy дают одинаковые матчи: играет на обоих движках одни и те же матчи
+    со случайными действиями игроков до падения главной башни и сверяет хеш состояния игры на каждом тике.
+    Если состояния разошлись, бенчмарк завершается с кодом 1"""
+    print(f'{"seed":>6} {"ticks":>7} {"over":>5} {"objects, s":>11} {"numpy, s":>9} {"result":>9}')
+    failed = False
+    for seed in range(args.seed, args.seed + args.matches):
+        games = [load_game_class(engine)(FRAMED, seed) for engine in ('objects', 'numpy')]
+        elapsed = [0., 0.]
+        rng = random.Random(seed)
+        diverged = None
+        while diverged is None and games[0].tick < args.max_ticks and not games[0].is_over():
+            for player in (PLAYER_1, PLAYER_2):
+                if rng.random() < args.action_rate / FPS:
+                    action, *data = random_action(player, rng).split()
+                    for game in games:
+                        game.get_player_action(player, action, data)
+            for i, game in enumerate(games):
+                start = time.perf_counter()
+                game.update()
+                elapsed[i] += time.perf_counter() - start
+            if state_hash(games[0].snapshot) != state_hash(games[1].snapshot):
+                diverged = games[0].tick
+        failed |= diverged is not None
+        result = 'identical' if diverged is None else f'tick {diverged}'
+        print(f'{seed:>6} {games[0].tick:>7} {"yes" if games[0].is_over() else "no":>5} {elapsed[0]:>11.2f} '
+              f'{elapsed[1]:>9.2f} {result:>9}')
+    if failed:
+        sys.exit(1)
+
+
+BENCHMARKS = {
+    'server': benchmark_server,
+    'protocol': benchmark_protocol,
+    'tick': benchmark_tick,
+    'soak': benchmark_soak,
+    'load': benchmark_load,
+    'engines': benchmark_engines
+}
+
+
+def even_number(value):
+    """Тип аргумента командной строки: сервер рассаживает ботов по двое, поэтому их число должно быть чётным"""
+    number = int(value)
+    if number <= 0 or number % 2:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive even number')
+    return number
+
+
+def main():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # сервер загружает карты по относительным путям
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    server_parser = subparsers.add_parser('server', help=benchmark_server.__doc__.split('\n')[0])
+    server_parser.add_argument('--modes', nargs='+', choices=('threaded', 'asyncio'), default=['threaded', 'asyncio'])
+    server_parser.add_argument('--matches', nargs='+', type=int, default=[10, 50])
+    server_parser.add_argument('--duration', type=float, default=10, help='длительность замера, сек')
+    server_parser.add_argument('--port', type=int, default=4445)
+    server_parser.add_argument('--protocol', choices=(FRAMED, LEGACY), default=FRAMED)
+    server_parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                               help='частота рассылки состояния игры, раз/сек')
+    server_parser.add_argument('--workers', nargs='+', type=int, default=[0],
+                               help='числа процессов-обработчиков сервера, 0 - без обработчиков')
+
+    protocol_parser = subparsers.add_parser('protocol', help=benchmark_protocol.__doc__)
+    protocol_parser.add_argument('--mobs', type=int, default=50, help='мобов у каждого игрока')
+    protocol_parser.add_argument('--ticks', type=int, default=300, help='сколько тиков прогнать перед замером')
+    protocol_parser.add_argument('--repeat', type=int, default=2000)
+
+    tick_parser = subparsers.add_parser('tick', help=benchmark_tick.__doc__)
+    tick_parser.add_argument('--mobs', nargs='+', type=int, default=[100, 500, 2000], help='мобов у каждого игрока')
+    tick_parser.add_argument('--ticks', type=int, default=600)
+    tick_parser.add_argument('--seed', type=int, default=0)
+    tick_parser.add_argument('--engines', nargs='+', choices=('objects', 'numpy'), default=['objects', 'numpy'])
+    tick_parser.add_argument('--phases', action='store_true', help='вывести процентили времени каждой фазы тика')
+
+    soak_parser = subparsers.add_parser('soak', help=benchmark_soak.__doc__.split('\n')[0])
+    soak_parser.add_argument('--modes', nargs='+', choices=('threaded', 'asyncio'), default=['threaded', 'asyncio'])
+    soak_parser.add_argument('--matches', type=int, default=2000)
+    soak_parser.add_argument('--concurrency', type=int, default=20, help='сколько матчей идёт одновременно')
+    soak_parser.add_argument('--match-duration', type=float, default=0.5, help='длительность матча, сек')
+    soak_parser.add_argument('--sample-every', type=int, default=200, help='через сколько матчей замерять сервер')
+    soak_parser.add_argument('--settle', type=float, default=1, help='пауза перед замером, сек')
+    soak_parser.add_argument('--rss-tolerance', type=float, default=0.1, help='допустимый рост памяти, доля')
+    soak_parser.add_argument('--port', type=int, default=4446)
+
+    engines_parser = subparsers.add_parser('engines', help=benchmark_engines.__doc__.split('\n')[0])
+    engines_parser.add_argument('--matches', type=int, default=3)
+    engines_parser.add_argument('--seed', type=int, default=0, help='зерно первого матча, дальше по порядку')
+    engines_parser.add_argument('--action-rate', type=float, default=2,
+                                help='сколько случайных действий в секунду отправляет каждый игрок')
+    engines_parser.add_argument('--max-ticks', type=int, default=FPS * 600,
+                                help='на каком тике остановить матч, если главная башня так и не упала')
+
+    load_parser = subparsers.add_parser('load', help=benchmark_load.__doc__.split('\n')[0])
+    load_parser.add_argument('--clients', nargs='+', type=even_number, default=[20, 100],
+                             help='числа одновременно подключённых ботов (чётные), замеры идут по очереди')
+    load_parser.add_argument('--duration', type=float, default=10, help='длительность замера, сек')
+    load_parser.add_argument('--host', default=HOST)
+    load_parser.add_argument('--port', type=int, default=4444, help='порт сервера, по умолчанию как у server.py')
+    load_parser.add_argument('--protocol', choices=(FRAMED, LEGACY), default=FRAMED)
+    load_parser.add_argument('--action-rate', type=float, default=ACTION_RATE,
+                             help='сколько случайных действий в секунду отправляет бот')
+    load_parser.add_argument('--script', help='файл сценария действий вместо случайных действий')
+    load_parser.add_argument('--ping-rate', type=float, default=PING_RATE, help='сколько замеров задержки в секунду')
+    load_parser.add_argument('--seed', type=int, default=0)
+    load_parser.add_argument('--settle', type=float, default=1, help='пауза между замерами, сек')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import time
+import select
+import socket
+import struct
+import asyncio
+from collections import deque
+from threading import Thread, Event
+from snapshots import SnapshotStream
+from exceptions import SlowClientError, ProtocolError
+try:
+    import fcntl
+    import termios
+except ImportError:  # не Unix: очередь сокета узнать нельзя, см. unsent_bytes
+    fcntl = termios = None
+
+
+# В этом файле находится рассылка состояния игры клиентам онлайн режима.
+# Комната раз в несколько тиков сообщает отправителям всех своих клиентов, что появилось новое состояние,
+# а отправка выполняется отдельно от игрового цикла, поэтому медленный клиент не задерживает тики комнаты
+
+SEND_BUFFER_SIZE = 1 << 14  # размер буфера отправки сокета клиента, байт
+SLOW_CLIENT_TIMEOUT = 5  # клиент, который столько секунд не может принять сообщение, отключается
+POLL_INTERVAL = 0.1  # как часто поток отправки проверяет, не освободился ли буфер сокета, сек
+# Отправка без блокировки потока. Где MSG_DONTWAIT нет (Windows), отправка блокирующая: медленный клиент
+# задерживает только свой поток отправки, но отключается, лишь когда соединение порвётся
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+MAX_REPLIES = 16  # сколько ответов клиенту может ждать отправки, более старые отбрасываются
+
+
+class SendBacklog:
+    """Отставание отправки клиенту (для метрик сервера и отключения медленных клиентов): сколько байт
+    сообщения ещё не передано сокету, как долго отправляется текущее сообщение и сколько состояний пропущено"""
+    def __init__(self):
+        self.pending = 0
+        self.send_start = None  # когда начата отправка текущего сообщения, None - сообщение не отправляется
+        self.skipped = 0
+
+    def start(self, size):
+        self.pending = size
+        self.send_start = time.monotonic()
+
+    def finish(self):
+        self.pending = 0
+        self.send_start = None
+
+    def lag(self):
+        """Сколько секунд отправляется текущее сообщение"""
+        send_start = self.send_start
+        return time.monotonic() - send_start if send_start is not None else 0.
+
+    def stalled(self):
+        return self.lag() > SLOW_CLIENT_TIMEOUT
+
+
+def limit_send_buffer(sock):
+    """Уменьшает буфер отправки сокета: иначе в нём копятся секунды устаревших состояний игры"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    except (OSError, AttributeError):
+        pass
+
+
+def unsent_bytes(sock):
+    """Сколько байт лежит в буфере отправки сокета (Linux), 0 - если узнать нельзя"""
+    if fcntl is None:
+        return 0
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0' * 4))[0]
+    except (OSError, AttributeError, ValueError):
+        return 0
+
+
+class TrafficCounter:
+    """Сколько байт отправлено клиенту всего и за последнюю секунду (для метрик сервера, см. metrics.py)"""
+    def __init__(self):
+        self.bytes_sent = 0
+        self.rate = 0.  # байт/сек за последнее полное окно
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def add(self, size):
+        self.bytes_sent += size
+        self.window_bytes += size
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.rate = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+    def current_rate(self):
+        """Скорость отправки. Если клиенту давно ничего не отправлялось, она считается нулевой"""
+        if time.monotonic() - self.window_start >= 2:
+            return 0.
+        return self.rate
+
+
+class SnapshotSender:
+    """Отправляет клиенту состояние игры из отдельного потока (для многопоточного сервера).
+    Исходящий слот вмещает одно состояние: если клиент не успевает принимать данные, промежуточные состояния
+    пропускаются - отправляется самое новое. Сокет не блокирует поток на переполненном буфере, а клиент,
+    который не принимает данные дольше SLOW_CLIENT_TIMEOUT, отключается"""
+    def __init__(self, conn, game, player):
+        self.conn = conn
+        self.game = game
+        self.player = player
+        self.stream = SnapshotStream()
+        self.traffic = TrafficCounter()
+        self.backlog = SendBacklog()
+        self.wakeup = Event()  # появилось новое состояние или ответ клиенту
+        self.snapshot_due = False  # клиенту пора отправить состояние игры
+        self.replies = deque(maxlen=MAX_REPLIES)  # ответы на запросы клиента, см. reply
+        self.closed = False
+        limit_send_buffer(conn)
+        Thread(target=self.run, daemon=True).start()
+
+    def notify(self):
+        """Сообщает, что клиенту пора отправить состояние игры. Не блокирует вызывающий поток"""
+        if self.snapshot_due:
+            self.backlog.skipped += 1  # в слоте уже лежит неотправленное состояние, его заменит новое
+        self.snapshot_due = True
+        self.wakeup.set()
+
+    def reply(self, data):
+        """Ставит в очередь короткое сообщение клиенту (например, PONG). Писать в сокет может только поток
+        отправки, иначе сообщение вклинится в середину состояния игры. Не блокирует вызывающий поток"""
+        self.replies.append(data)
+        self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                if self.closed:
+                    break
+                while self.replies:
+                    self.send(self.replies.popleft())
+                if self.snapshot_due:
+                    self.snapshot_due = False
+                    self.send(self.game.get_data_to_send(self.stream))
+        except SlowClientError:
+            print(f'Player {self.player} does not receive data for {SLOW_CLIENT_TIMEOUT} s, disconnecting')
+            self.disconnect()
+        except ProtocolError as err:
+            print(f'Can not encode the game state for player {self.player}, disconnecting: {err}')
+            self.disconnect()
+        except OSError:
+            # Соединение закрыто, поток клиента узнает об этом сам при следующем чтении
+            pass
+
+    def disconnect(self):
+        try:
+            # Поток клиента выйдет из recv и закроет комнату, как при обычном отключении
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, data):
+        """Отправляет сообщение по частям, которые помещаются в буфер сокета. Начатое сообщение нельзя бросить,
+        не сломав поток сообщений, поэтому оно дописывается, а новые состояния тем временем заменяют друг друга"""
+        view = memoryview(data)
+        self.backlog.start(len(data))
+        while view:
+            try:
+                sent = self.conn.send(view, SEND_FLAGS)
+            except BlockingIOError:
+                sent = 0
+            view = view[sent:]
+            self.backlog.pending = len(view)
+            if view:
+                if self.closed:
+                    return
+                if self.backlog.stalled():
+                    raise SlowClientError
+                select.select([], [self.conn], [], POLL_INTERVAL)
+        self.backlog.finish()
+        self.traffic.add(len(data))
+
+    def queued_bytes(self):
+        """Сколько байт ждут отправки клиенту: остаток текущего сообщения и содержимое буфера сокета"""
+        return self.backlog.pending + unsent_bytes(self.conn)
+
+
+class AsyncSnapshotSender:
+    """Аналог SnapshotSender для асинхронного сервера: отправка выполняется в отдельной задаче asyncio"""
+    def __init__(self, writer, game, player):
+        self.writer = writer
+        self.game = game
+        self.player = player
+        self.stream = SnapshotStream()
+        self.traffic = TrafficCounter()
+        self.backlog = SendBacklog()
+        self.new_snapshot = asyncio.Event()
+        limit_send_buffer(writer.get_extra_info('socket'))
+        # drain ждёт, пока в буфере транспорта не останется меньше SEND_BUFFER_SIZE байт
+        writer.transport.set_write_buffer_limits(SEND_BUFFER_SIZE)
+        self.task = asyncio.create_task(self.run())
+
+    def notify(self):
+        if self.new_snapshot.is_set():
+            self.backlog.skipped += 1
+        self.new_snapshot.set()
+
+    def reply(self, data):
+        # Сообщение целиком попадает в буфер транспорта, поэтому не может вклиниться в середину состояния игры
+        self.writer.write(data)
+
+    def close(self):
+        self.task.cancel()
+
+    async def run(self):
+        try:
+            while True:
+                await self.new_snapshot.wait()
+                self.new_snapshot.clear()
+                data = self.game.get_data_to_send(self.stream)
+                self.backlog.start(len(data))
+                self.writer.write(data)
+                await asyncio.wait_for(self.writer.drain(), SLOW_CLIENT_TIMEOUT)
+                self.backlog.finish()
+                self.traffic.add(len(data))
+        except asyncio.TimeoutError:
+            print(f'Player {self.player} does not receive data for {SLOW_CLIENT_TIMEOUT} s, disconnecting')
+            self.writer.transport.abort()  # сопрограмма клиента получит ошибку чтения и закроет комнату
+        except ProtocolError as err:
+            print(f'Can not encode the game state for player {self.player}, disconnecting: {err}')
+            self.writer.transport.abort()
+        except ConnectionError:
+            pass
+
+    def queued_bytes(self):
+        return self.writer.transport.get_write_buffer_size() + unsent_bytes(self.writer.get_extra_info('socket'))
@@ -0,0 +1,96 @@
+import socket
+from time import perf_counter
+from queue import Queue
+from threading import Thread, Lock
+from exceptions import ProtocolError, OpponentExitError
+from protocol import *
+
+
+# В этом файле находится соединение клиента онлайн режима с сервером. Приём и отправка сообщений идут
+# в отдельных потоках, поэтому игровой цикл клиента никогда не ждёт сеть: частота кадров не зависит от задержек сети.
+# Поток приёма декодирует состояния игры и складывает их в заполняемый буфер, а игровой цикл раз в кадр меняет
+# буферы местами и забирает всё, что пришло с прошлого кадра. Действия игрока ставятся в очередь потока отправки
+
+
+class ServerConnection:
+    """Соединение с сервером после приветствия: номер игрока известен, дальше сервер рассылает состояние игры"""
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        message_type, body = recv_message(self.sock)
+        if message_type != HELLO:
+            self.sock.close()
+            raise ProtocolError(f'Unexpected message type {message_type}')
+        self.player = decode_hello(body)
+        self.history = SnapshotHistory()  # последние полученные состояния игры, к которым применяются дельты
+        self.lock = Lock()
+        self.back = []  # (состояние, время получения), заполняется потоком приёма
+        self.front = []  # состояния, которые игровой цикл забрал на этом кадре
+        self.waiting = False  # сервер ждёт второго игрока
+        self.error = None  # ошибка, на которой остановился поток приёма или отправки
+        self.outgoing = Queue()  # сообщения для отправки, None - сигнал потоку отправки завершиться
+        self.closed = False
+        Thread(target=self.receive_loop, daemon=True).start()
+        Thread(target=self.send_loop, daemon=True).start()
+
+    def send(self, message_type, body=b''):
+        """Ставит сообщение в очередь на отправку. Не блокирует вызывающий поток"""
+        self.outgoing.put((message_type, body))
+
+    def send_action(self, action):
+        self.send(ACTION, str.encode(action))
+
+    def take_snapshots(self):
+        """Возвращает состояния, полученные с прошлого вызова, в виде списка (состояние, время получения).
+        Если соединение разорвано, вызывает OpponentExitError"""
+        self.front.clear()
+        with self.lock:
+            self.front, self.back = self.back, self.front
+        if self.error is not None:
+            if isinstance(self.error, (EOFError, ConnectionError)):
+                raise OpponentExitError
+            raise self.error
+        return self.front
+
+    def receive_loop(self):
+        try:
+            while not self.closed:
+                message_type, body = recv_message(self.sock)
+                if message_type == WAITING:
+                    self.waiting = True
+                elif message_type == SNAPSHOT:
+                    snapshot = decode_snapshot(body, self.history)
+                    if snapshot is None:
+                        # Дельта посчитана относительно состояния, которого у нас уже нет, - просим полное состояние
+                        self.send(KEYFRAME_REQUEST)
+                        continue
+                    arrival = perf_counter()  # время получения нужно для оценки времени сервера, см. interpolation.py
+                    self.history.add(snapshot)
+                    self.send(ACK, encode_ack(snapshot.tick))
+                    with self.lock:
+                        self.back.append((snapshot, arrival))
+                    self.waiting = False
+                else:
+                    raise ProtocolError(f'Unexpected message type {message_type}')
+        except (EOFError, OSError, ProtocolError) as err:
+            if not self.closed:
+                self.error = err
+
+    def send_loop(self):
+        try:
+            while True:
+                message = self.outgoing.get()
+                if message is None:
+                    return
+                send_message(self.sock, *message)
+        except OSError as err:
+            if not self.closed:
+                self.error = err
+
+    def close(self):
+        self.closed = True
+        self.outgoing.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # прерывает ожидание данных в потоке приёма
+        except OSError:
+            pass
+        self.sock.close()
@@ -3,6 +3,15 @@ PLAYER_1 = 1
 PLAYER_2 = 2
 FPS = 60
 TICK = 1 / 60
+# Сколько раз в секунду сервер рассылает состояние игры. Клиент рисует кадры чаще и интерполирует между состояниями
+SEND_RATE = 30
+# Состояния комнаты онлайн сервера: ожидает второго игрока, игра идёт, игра окончена (тики остановлены, игроки
+# ещё смотрят результат), комната закрыта и убрана из реестра - её память освобождается вместе с потоками клиентов
+WAITING_ROOM = 'waiting'
+RUNNING_ROOM = 'running'
+FINISHED_ROOM = 'finished'
+RECLAIMED_ROOM = 'reclaimed'
+MOB_GRID_CELL_SIZE = 100  # размер ячейки сетки, по которой башни ищут мобов, пикселей
 MASK = 'mask'
 SKILLET = 'skillet'
 STONE_GOLEM = 'stone_golem'
@@ -10,6 +19,10 @@ BOAR_WARRIOR = 'boar_warrior'
 HORNY_DOG = 'horny_dog'
 CRYSTAL_GOLEM = 'crystal_golem'
 MOBS = (MASK, SKILLET, STONE_GOLEM, BOAR_WARRIOR, HORNY_DOG, CRYSTAL_GOLEM)
+MOB_STATES = ('move', 'attack', 'death', 'killed')
+TOWER_TYPES = ('bow', 'cannon', 'crystal')
+BULLET_TYPES = ('arrow', 'shell', 'sphere')
+SOUND_NAMES = ('bow_shot', 'cannon_shot', 'crystal_shot', 'mob_hit')
 CACHE_VELOCITY = 1 / 10
 MAINTOWERS_POSITIONS = {
     1: (20, 670),  # Для первого уровня
@@ -24,3 +24,13 @@ class Lose(Exception):
 class Exit(Exception):
     """Вызывается когда игрок вышел из онлайн режима"""
     pass
+
+
+class ProtocolError(Exception):
+    """Вызывается, если от собеседника пришло сообщение, не соответствующее протоколу обмена данными"""
+    pass
+
+
+class SlowClientError(Exception):
+    """Вызывается на сервере, если клиент слишком долго не принимает отправленные ему данные"""
+    pass
@@ -0,0 +1,115 @@
+"""Прогон серверной игры без сети и без ожидания реального времени: тики выполняются подряд с максимальной скоростью.
+Действия игроков берутся из сценария - строк вида "<тик> <игрок> <действие> <аргументы>", например
+"60 1 spawn_mob skillet 0 150;540" или "120 2 spawn_tower cannon 1300;600". Пустые строки и строки с # пропускаются.
+Сценарием может быть и журнал действий матча, записанный сервером (server.py --input-log-dir, см. input_log.py):
+матч повторяется с тем же зерном до последнего тика, и последнее состояние сверяется с записанным.
+Запуск из корня проекта: python headless.py [сценарий] --ticks 3600 [параметры], параметры - python headless.py -h"""
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+from constants import *
+from protocol import FRAMED
+from input_log import parse_input_log, state_hash
+from tick_profiler import TickProfiler, format_histograms
+
+
+def load_game_class(engine):
+    """Возвращает класс серверной игры для движка engine (см. параметр --engine сервера)"""
+    if engine == 'numpy':
+        from numpy_engine import NumpyOnlineGame
+        return NumpyOnlineGame
+    from server import OnlineGame
+    return OnlineGame
+
+
+def run_headless(game, inputs, ticks):
+    """Выполняет ticks тиков игры game подряд, без пауз. Действие из inputs с номером тика t попадает в очередь
+    действий игры так же, как действие от клиента, перед тиком t (действия с t <= 0 - перед первым тиком).
+    Возвращает время прогона в секундах"""
+    inputs = iter(inputs)
+    pending = next(inputs, None)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        while pending is not None and pending[0] <= game.tick + 1:
+            _, player, action, args = pending
+            game.get_player_action(player, action, args)
+            pending = next(inputs, None)
+        game.update()
+    return time.perf_counter() - start
+
+
+def describe_state(game):
+    """Возвращает строки с кратким описанием последнего состояния игры"""
+    lines = [f'tick {game.tick}, state hash {state_hash(game.snapshot)}']
+    for player in (PLAYER_1, PLAYER_2):
+        states = Counter(mob.state for mob in game.mobs[player])
+        mobs = ', '.join(f'{state} {number}' for state, number in sorted(states.items())) or 'none'
+        lines.append(f'player {player}: main tower {game.main_towers[player].health}, '
+                     f'cache {int(game.players_cache[player])}, towers {len(game.towers[player])}, mobs: {mobs}')
+    lines.append(f'bullets {len(game.bullets)}')
+    return lines
+
+
+def main():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # сервер загружает карты по относительным путям
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', nargs='?', help='файл сценария, "-" - читать сценарий из stdin')
+    parser.add_argument('--ticks', type=int, help='сколько тиков прогнать, по умолчанию - до конца журнала '
+                                                  f'или {FPS * 60}')
+    parser.add_argument('--engine', choices=('objects', 'numpy'), default='objects')
+    parser.add_argument('--seed', type=int,
+                        help='зерно генератора случайных чисел игры (выбор пути мобов), '
+                             'по умолчанию - из журнала или 0')
+    parser.add_argument('--profile', action='store_true', help='вывести самые долгие функции по данным cProfile')
+    parser.add_argument('--dump', action='store_true', help='вывести последнее состояние игры целиком')
+    parser.add_argument('--phases', action='store_true', help='вывести процентили времени каждой фазы тика')
+    args = parser.parse_args()
+    if args.script == '-':
+        seed, inputs, end = parse_input_log(sys.stdin)
+    elif args.script is not None:
+        with open(args.script, 'r', encoding='utf-8') as script:
+            seed, inputs, end = parse_input_log(script)
+    else:
+        seed, inputs, end = None, [], None
+    if args.seed is not None:
+        seed = args.seed
+    if args.ticks is None:
+        args.ticks = end[0] if end is not None else FPS * 60
+    if args.ticks < 1:
+        parser.error('--ticks должно быть положительным')
+
+    game = load_game_class(args.engine)(FRAMED, seed or 0)
+    game.profiler = TickProfiler(window=args.ticks)  # статистика за весь прогон
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        elapsed = profiler.runcall(run_headless, game, inputs, args.ticks)
+        pstats.Stats(profiler).sort_stats('tottime').print_stats(20)
+    else:
+        elapsed = run_headless(game, inputs, args.ticks)
+
+    print(f'{args.ticks} ticks in {elapsed:.3f} s: {args.ticks / max(elapsed, 1e-9):.0f} ticks/s, '
+          f'{elapsed / max(args.ticks, 1) * 1000:.3f} ms/tick ({args.ticks / FPS / max(elapsed, 1e-9):.1f}x real time)')
+    for line in describe_state(game):
+        print(line)
+    if end is not None and end[0] == game.tick:
+        if state_hash(game.snapshot) != end[1]:
+            print(f'Replay diverged from the recorded match: recorded state hash {end[1]}')
+            sys.exit(1)
+        print('Replay matches the recorded match')
+    if args.phases:
+        for line in format_histograms(game.profiler.histograms()):
+            print(line)
+    if args.dump:
+        mobs, towers, bullets = game.snapshot.as_tuple()[:3]
+        for name, records in (('mobs', mobs), ('towers', towers), ('bullets', bullets)):
+            print(f'{name}:')
+            for record in records:
+                print(' ', record)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import time
+import hashlib
+from threading import Lock
+from protocol import encode_snapshot
+
+
+# В этом файле находится журнал действий игроков онлайн матча. Игра на сервере детерминирована: маршруты мобов
+# выбирает генератор случайных чисел комнаты с известным зерном, а действия игроков применяются в начале тика.
+# Поэтому зерна и списка действий с номерами тиков, на которых они применены, достаточно, чтобы повторить матч
+# в headless.py тик в тик.
+# Журнал - текстовый файл в формате сценария headless.py, в который строки только дописываются:
+#   seed <зерно>
+#   <тик> <игрок> <действие> <аргументы>  - действие, применённое на этом тике
+#   end <тик> <хэш состояния>  - последнее состояние игры, записывается при закрытии комнаты
+
+INPUT_LOG_SUFFIX = '.inputs'
+
+
+def state_hash(snapshot):
+    """Хэш состояния игры. Одинаковые прогоны (и разные движки) дают одинаковый хэш"""
+    return hashlib.md5(encode_snapshot(snapshot)).hexdigest()
+
+
+def room_file_path(directory, room_number, suffix):
+    """Имя файла журнала или записи новой комнаты: время начала, номер процесса и номер комнаты"""
+    return os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-room{room_number}{suffix}')
+
+
+class InputLog:
+    """Журнал действий одной комнаты. Действия записывает игровой цикл, а закрывает журнал поток клиента,
+    поэтому запись и закрытие защищены блокировкой"""
+    def __init__(self, path, seed):
+        self.path = path
+        # Построчная буферизация: если сервер упадёт, в журнале останутся все действия до падения
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.lock = Lock()
+        self.file.write(f'seed {seed}\n')
+
+    def record(self, tick, player, action, data):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(f'{tick} {player} {action} {" ".join(data)}\n')
+
+    def close(self, snapshot=None):
+        """Закрывает журнал, записывая последнее состояние игры, если оно есть"""
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                if snapshot is not None:
+                    self.file.write(f'end {snapshot.tick} {state_hash(snapshot)}\n')
+            finally:
+                self.file.close()
+                self.file = None
+
+
+def parse_input_log(lines):
+    """Разбирает журнал или сценарий headless.py. Возвращает зерно (None, если его нет), действия в виде списка
+    (тик, игрок, действие, аргументы), упорядоченного по тикам, и последнее состояние (тик, хэш) или None"""
+    seed = end = None
+    inputs = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.split('#')[0].split()
+        if not line:
+            continue
+        if line[0] == 'seed' and len(line) == 2:
+            seed = int(line[1])
+            continue
+        if line[0] == 'end' and len(line) == 3:
+            end = (int(line[1]), line[2])
+            continue
+        if len(line) < 3:
+            raise ValueError(f'Line {line_number}: expected "<tick> <player> <action> <args>"')
+        tick, player, action, *args = line
+        inputs.append((int(tick), int(player), action, args))
+    inputs.sort(key=lambda item: item[0])  # сортировка устойчивая, действия одного тика идут в порядке журнала
+    return seed, inputs, end
@@ -0,0 +1,135 @@
+import math
+from collections import deque
+from constants import TICK
+from snapshots import Snapshot, MOB_KIND, TOWER_KIND, BULLET_KIND, PROJECTILE_KIND
+
+
+# В этом файле находится буфер состояний игры на клиенте онлайн режима. Сервер рассылает состояние реже, чем
+# клиент рисует кадры, а сообщения приходят с неравными задержками. Поэтому клиент рисует игру с небольшим
+# отставанием от сервера: положение мобов и снарядов плавно переходит от одного полученного состояния к следующему.
+# Игровое время сервера клиент оценивает по номерам тиков в полученных состояниях и времени их получения.
+# Прямолетящие снаряды не интерполируются: их положение рассчитывается по записи на дробный тик картинки
+
+SYNC_WINDOW = 2  # за сколько последних секунд учитываются задержки состояний при оценке времени сервера
+DELAY_INTERVALS = 2  # на сколько интервалов между рассылками состояний картинка отстаёт от сервера
+BUFFER_LENGTH = 32  # сколько последних состояний хранится
+# Номер поля кадра анимации в записях сущностей разных видов (см. snapshots.py)
+ANIMATION_FIELDS = {MOB_KIND: 5, TOWER_KIND: 3, BULLET_KIND: 4}
+
+
+class ServerClock:
+    """Оценка игрового времени сервера. Время получения состояния - это время его тика на сервере плюс задержка
+    сети. Наименьшая задержка за последние SYNC_WINDOW секунд считается задержкой без помех, так что оценка
+    не дёргается вслед за случайно задержавшимися сообщениями"""
+    def __init__(self, tick=TICK, window=SYNC_WINDOW):
+        self.tick = tick
+        self.window = window
+        self.samples = deque()  # (время получения, смещение), смещения возрастают - остальные не нужны
+        self.offset = None  # местное время, соответствующее нулевому тику сервера
+
+    def add(self, server_tick, now):
+        offset = now - server_tick * self.tick
+        while self.samples and self.samples[-1][1] >= offset:
+            self.samples.pop()
+        self.samples.append((now, offset))
+        while self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        self.offset = self.samples[0][1]
+
+    def server_tick(self, now):
+        """Дробный номер тика, который сервер выполняет в момент now"""
+        return (now - self.offset) / self.tick
+
+
+class SnapshotBuffer:
+    """Последние полученные состояния игры и их отрисовка с интерполяцией.
+    animation_length(вид, запись) возвращает число кадров анимации сущности или None, если анимацию
+    не нужно сглаживать"""
+    def __init__(self, animation_length=None, delay_intervals=DELAY_INTERVALS, length=BUFFER_LENGTH):
+        self.animation_length = animation_length
+        self.delay_intervals = delay_intervals
+        self.snapshots = deque(maxlen=length)
+        self.clock = ServerClock()
+        self.interval = 0  # интервал между рассылками состояний, тиков
+        self.render_tick = None  # тик, который рисовался на прошлом кадре
+        self.played_tick = None  # тик последнего состояния, звуки которого уже проиграны
+
+    def add(self, snapshot, now):
+        if self.snapshots and snapshot.tick <= self.snapshots[-1].tick:
+            return  # устаревшее или повторное состояние
+        if len(self.snapshots) == 1:
+            self.interval = snapshot.tick - self.snapshots[-1].tick
+        elif self.snapshots:
+            # Интервал рассылки плавно подстраивается, если сервер пропустил или задержал рассылку
+            self.interval += (min(snapshot.tick - self.snapshots[-1].tick, 30) - self.interval) * 0.1
+        self.snapshots.append(snapshot)
+        self.clock.add(snapshot.tick, now)
+
+    def __bool__(self):
+        return bool(self.snapshots)
+
+    def latest(self):
+        return self.snapshots[-1]
+
+    def get_render_tick(self, now):
+        """Тик, который нужно нарисовать сейчас: оценка тика сервера с отставанием на несколько интервалов рассылки.
+        Время картинки не идёт назад и не уходит дальше последнего полученного состояния"""
+        render_tick = self.clock.server_tick(now) - self.interval * self.delay_intervals
+        render_tick = min(max(render_tick, self.snapshots[0].tick), self.snapshots[-1].tick)
+        if self.render_tick is not None:
+            render_tick = max(render_tick, self.render_tick)
+        self.render_tick = render_tick
+        return render_tick
+
+    def frame(self, now):
+        """Возвращает состояние игры для отрисовки в момент now в виде Snapshot.as_tuple.
+        Звуки - все звуки состояний, время которых наступило с прошлого кадра"""
+        render_tick = self.get_render_tick(now)
+        previous = following = self.snapshots[0]
+        for snapshot in self.snapshots:
+            if snapshot.tick > render_tick:
+                following = snapshot
+                break
+            previous = following = snapshot
+        sounds = []
+        for snapshot in self.snapshots:
+            if snapshot.tick <= render_tick and (self.played_tick is None or snapshot.tick > self.played_tick):
+                sounds.extend(snapshot.sounds)
+                self.played_tick = snapshot.tick
+        if following is previous:
+            entities = previous.entities
+        else:
+            entities = self.interpolate(previous, following,
+                                        (render_tick - previous.tick) / (following.tick - previous.tick))
+        return Snapshot(previous.tick, entities, previous.scalars, tuple(sounds)).as_tuple(render_tick)
+
+    def interpolate(self, previous, following, t):
+        """Сущности состояния previous, передвинутые на долю t пути к состоянию following"""
+        entities = {}
+        following_entities = following.entities
+        for entity_id, (kind, record) in previous.entities.items():
+            next_entity = following_entities.get(entity_id)
+            if next_entity is None or next_entity[0] != kind or kind == PROJECTILE_KIND:
+                entities[entity_id] = (kind, record)
+                continue
+            next_record = next_entity[1]
+            record = list(record)
+            if kind == MOB_KIND:
+                # При смене состояния у моба меняется размер спрайта и он может перескочить на другое место
+                if record[4] == next_record[4]:
+                    record[2] += (next_record[2] - record[2]) * t
+                    record[3] += (next_record[3] - record[3]) * t
+            elif kind == BULLET_KIND:
+                record[1] += (next_record[1] - record[1]) * t
+                record[2] += (next_record[2] - record[2]) * t
+                turn = (next_record[3] - record[3] + math.pi) % (2 * math.pi) - math.pi
+                record[3] += turn * t
+            if self.animation_length is not None and (kind != MOB_KIND or record[4] == next_record[4]):
+                length = self.animation_length(kind, record)
+                if length:
+                    # Кадры анимации идут по кругу, поэтому переход считается вперёд по модулю длины анимации
+                    index = ANIMATION_FIELDS[kind]
+                    step = (next_record[index] - record[index]) % length
+                    record[index] = int(record[index] + step * t) % length
+            entities[entity_id] = (kind, tuple(record))
+        return entities
@@ -5,7 +5,9 @@ from threading import Thread
 from sprites import *
 from online_game import play_online
 from exceptions import ServerError
-from utils import load_ways, calculate_distance_between_points
+from utils import load_ways, is_alive, tagged_first
+from spatial import SpatialGrid
+from mob_templates import get_mob_template
 from pygame_functions import *
 from sounds import *
 
@@ -40,6 +42,7 @@ class Mob(pygame.sprite.Sprite):
         self.pos = pos
         self.state = state
         self.load_info(self.type)
+        self.steps_table = self.way.get_steps_table(self.velocity)  # шаги моба по каждому отрезку маршрута
         self.animations = MOB_ANIMATIONS[self.type]
         self.animation = self.animations[state]
         self.animation_index = animation_index
@@ -73,45 +76,22 @@ class Mob(pygame.sprite.Sprite):
         )
 
     def load_info(self, type):
-        """Загружает параметры моба из json файла"""
-        with open(os.path.join('mobs', type, 'info.json'), 'r', encoding='utf-8') as info_file:
-            self.info = json.load(info_file)
-        self.width = self.info[self.state]['width']
-        self.height = self.info[self.state]['height']
-        self.velocity = self.info['velocity'] / FPS
-        self.health = self.max_health = self.info['health']
-        self.damage = self.info['damage']
-        self.reward = self.info['reward']
-        self.animation_speed = self.info[self.state]['animation_speed']
-        self.animation_length = self.info[self.state]['animation_length']
-        self.health_line_bias = tuple(self.info['health_line_bias'].values())
+        """Берёт параметры моба из общего реестра шаблонов мобов (см. mob_templates.py)"""
+        self.template = get_mob_template(type)
+        state_template = self.template.states[self.state]
+        self.width = state_template.width
+        self.height = state_template.height
+        self.velocity = self.template.velocity
+        self.health = self.max_health = self.template.health
+        self.damage = self.template.damage
+        self.reward = self.template.reward
+        self.animation_speed = state_template.animation_speed
+        self.animation_length = state_template.animation_length
+        self.health_line_bias = self.template.health_line_bias
 
     def get_position(self, delta_steps):
         """Возвращает координату, в которой окажется моб через заданное количество шагов"""
-        index = self.pos
-        steps = self.steps_to_next_point
-        way_len = len(self.way)
-        # Будет просчитываться движение моба до тех пор, пока он не пройдёт нужное количество шагов
-        while index < way_len - 1:
-            if steps < delta_steps:
-                delta_steps -= steps
-            else:
-                if index > self.pos:
-                    way_point_1 = self.way[index - 1]
-                else:
-                    way_point_1 = self.coords.copy()
-                way_point_2 = self.way[index]
-                d_x = way_point_2[0] - way_point_1[0]
-                d_y = way_point_2[1] - way_point_1[1]
-                return (way_point_1[0] + d_x / steps * delta_steps,
-                        way_point_1[1] + d_y / steps * delta_steps)
-            start_point = self.way[index]
-            index += 1
-            next_point = self.way[index]
-            d_x, d_y = next_point[0] - start_point[0], next_point[1] - start_point[1]
-            steps = math.hypot(d_x, d_y) / self.velocity
-        else:
-            return self.way[-1]
+        return self.way.get_position(self.pos, self.coords, self.steps_to_next_point, self.velocity, delta_steps)
 
     def update(self):
         # Смена картинки:
@@ -129,15 +109,10 @@ class Mob(pygame.sprite.Sprite):
                                   screen)
             try:
                 if self.steps_to_next_point <= 0:
-                    # Определение маршрута до следующей точки пути:
-                    start_point = self.way[self.pos]
-                    self.pos += 1
-                    next_point = self.way[self.pos]
-                    d_x = next_point[0] - start_point[0]
-                    d_y = next_point[1] - start_point[1]
-                    self.steps_to_next_point = math.hypot(d_x, d_y) // self.velocity
-                    self.x_velocity = d_x / self.steps_to_next_point
-                    self.y_velocity = d_y / self.steps_to_next_point
+                    # Переход на следующий отрезок пути, шаги по нему посчитаны заранее.
+                    # В конце пути таблица шагов заканчивается и возникает IndexError
+                    self.pos = min(self.pos + 1, len(self.way))
+                    self.steps_to_next_point, self.x_velocity, self.y_velocity = self.steps_table[self.pos - 1]
                 self.steps_to_next_point -= 1
                 self.coords[0] += self.x_velocity
                 self.coords[1] += self.y_velocity
@@ -164,10 +139,11 @@ class Mob(pygame.sprite.Sprite):
         if self.state != 'attack':
             self.state = 'attack'
             self.animation = attack_animation
-            self.animation_speed = self.info['attack']['animation_speed']
-            self.animation_length = self.info['attack']['animation_length']
+            state_template = self.template.states['attack']
+            self.animation_speed = state_template.animation_speed
+            self.animation_length = state_template.animation_length
             self.animation_index = 0 - self.animation_speed
-            self.width, self.height = self.info['attack']['width'], self.info['attack']['height']
+            self.width, self.height = state_template.width, state_template.height
 
     def hit(self, damage):
         self.health -= damage
@@ -177,9 +153,10 @@ class Mob(pygame.sprite.Sprite):
         Game.currency += self.reward
         self.animation = self.animations['death']
         self.animation_index = 0.
-        self.animation_speed = self.info['death']['animation_speed']
-        self.animation_length = self.info['death']['animation_length']
-        self.width, self.height = self.info['death']['width'], self.info['death']['height']
+        state_template = self.template.states['death']
+        self.animation_speed = state_template.animation_speed
+        self.animation_length = state_template.animation_length
+        self.width, self.height = state_template.width, state_template.height
 
 
 class BowTower(pygame.sprite.Sprite):
@@ -193,10 +170,10 @@ class BowTower(pygame.sprite.Sprite):
     y_bias = -25
     # bias - смещение точки, из которой вылетает снаряд, от левого верхнего угла плента, на котором спавнится башня
 
-    def __init__(self, group, coords, moblist, bullets_group, reloading=0, animation_index=0):
+    def __init__(self, group, coords, mob_grid, bullets_group, reloading=0, animation_index=0):
         super().__init__(group)
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.moblist = moblist
+        self.mob_grid = mob_grid  # сетка с мобами, по которой башня ищет цель
         self.bullets_group = bullets_group
         self.reloading = reloading  # сколько времени осталось до выстрела(сек/60)
         self.animation_index = animation_index  # Всегда равен нулю, так как эта башня не имеет анимации
@@ -209,14 +186,12 @@ class BowTower(pygame.sprite.Sprite):
     def update(self):
         if not self.reloading:
             # Поиск цели:
-            for mob in sorted(self.moblist, key=lambda mob_: not mob_.tagged):
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        Bullet(self.bullets_group, self.coords, self.damage, 'arrow', distance, mob)
-                        bow_shot_sound.play()
-                        self.reloading = self.time_to_reload
-                        return
+            mob, distance = self.mob_grid.first_within(self.coords, self.shooting_range, is_alive, tagged_first)
+            if mob is not None:
+                Bullet(self.bullets_group, self.coords, self.damage, 'arrow', distance, mob)
+                bow_shot_sound.play()
+                self.reloading = self.time_to_reload
+                return
         else:
             self.reloading -= 1
 
@@ -237,10 +212,10 @@ class CannonTower(pygame.sprite.Sprite):
     # bias - смещение точки, из которой вылетает снаряд, от левого верхнего угла плента, на котором спавнится башня
     animation_length = 16
 
-    def __init__(self, group, coords, moblist, bullets_group, reloading=0, animation_index=0):
+    def __init__(self, group, coords, mob_grid, bullets_group, reloading=0, animation_index=0):
         super().__init__(group)
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.moblist = moblist
+        self.mob_grid = mob_grid  # сетка с мобами, по которой башня ищет цель
         self.bullets_group = bullets_group
         self.reloading = reloading  # сколько времени осталось до выстрела(сек/60)
         self.animation_index = animation_index
@@ -253,18 +228,16 @@ class CannonTower(pygame.sprite.Sprite):
     def update(self):
         if not self.reloading:
             # Поиск цели:
-            for mob in sorted(self.moblist, key=lambda mob_: not mob_.tagged):
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        bullet = Bullet(self.bullets_group, self.coords, self.damage, 'shell', distance, mob,
-                                        velocity=20)
-                        cannon_shot_sound.play()
-                        # Пушка меняет спрайт в зависимости от того под каким углом она выстрелила
-                        self.animation_index = round(bullet.angle / (math.pi / 8)) % self.animation_length
-                        self.image = TOWERS_SPRITES['cannon'][self.animation_index]
-                        self.reloading = self.time_to_reload
-                        return
+            mob, distance = self.mob_grid.first_within(self.coords, self.shooting_range, is_alive, tagged_first)
+            if mob is not None:
+                bullet = Bullet(self.bullets_group, self.coords, self.damage, 'shell', distance, mob,
+                                velocity=20)
+                cannon_shot_sound.play()
+                # Пушка меняет спрайт в зависимости от того под каким углом она выстрелила
+                self.animation_index = round(bullet.angle / (math.pi / 8)) % self.animation_length
+                self.image = TOWERS_SPRITES['cannon'][self.animation_index]
+                self.reloading = self.time_to_reload
+                return
         else:
             self.reloading -= 1
 
@@ -285,10 +258,10 @@ class CrystalTower(pygame.sprite.Sprite):
     # bias - смещение точки, из которой вылетает снаряд, от левого верхнего угла плента, на котором спавнится башня
     animation_length = 27
 
-    def __init__(self, group, coords, moblist, bullets_group, reloading=0, animation_index=0):
+    def __init__(self, group, coords, mob_grid, bullets_group, reloading=0, animation_index=0):
         super().__init__(group)
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.moblist = moblist
+        self.mob_grid = mob_grid  # сетка с мобами, по которой башня ищет цель
         self.bullets_group = bullets_group
         self.reloading = reloading  # сколько времени осталось до выстрела(сек/60)
         self.animation_index = animation_index
@@ -301,14 +274,12 @@ class CrystalTower(pygame.sprite.Sprite):
     def update(self):
         if not self.reloading:
             # Поиск цели:
-            for mob in sorted(self.moblist, key=lambda mob_: not mob_.tagged):
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        HomingBullet(self.bullets_group, self.coords, self.damage, 'sphere', mob)
-                        crystal_shot_sound.play()
-                        self.reloading = self.time_to_reload
-                        return
+            mob, distance = self.mob_grid.first_within(self.coords, self.shooting_range, is_alive, tagged_first)
+            if mob is not None:
+                HomingBullet(self.bullets_group, self.coords, self.damage, 'sphere', mob)
+                crystal_shot_sound.play()
+                self.reloading = self.time_to_reload
+                return
         else:
             self.reloading -= 1
         self.animation_index = (self.animation_index + 0.3) % self.animation_length
@@ -326,10 +297,10 @@ class MainTower(pygame.sprite.Sprite):
     shooting_range = 600
     damage = 10
 
-    def __init__(self, group, coords, moblist, bullets_group):
+    def __init__(self, group, coords, mob_grid, bullets_group):
         super().__init__(group)
         self.coords = coords
-        self.moblist = moblist
+        self.mob_grid = mob_grid
         self.bullets_group = bullets_group
         self.reloading = 0
         self.rect = pygame.Rect(*self.coords, 10, 10)
@@ -347,14 +318,13 @@ class MainTower(pygame.sprite.Sprite):
 
             if not self.reloading:
                 # Поиск цели:
-                for mob in sorted(self.moblist, key=lambda mob_: not mob_.tagged):
-                    distance = math.hypot(self.coords[0] - mob.coords[0], self.coords[1] - mob.coords[1])
-                    if distance <= self.shooting_range and mob.state != 'death':
-                        coords = (self.coords[0] + 135, self.coords[1] + 70)
-                        Bullet(self.bullets_group, coords, self.damage, 'arrow', distance, mob)
-                        bow_shot_sound.play()
-                        self.reloading = self.time_to_reload
-                        return
+                mob, distance = self.mob_grid.first_within(self.coords, self.shooting_range, is_alive, tagged_first)
+                if mob is not None:
+                    coords = (self.coords[0] + 135, self.coords[1] + 70)
+                    Bullet(self.bullets_group, coords, self.damage, 'arrow', distance, mob)
+                    bow_shot_sound.play()
+                    self.reloading = self.time_to_reload
+                    return
             else:
                 self.reloading -= 1
         else:
@@ -466,11 +436,11 @@ class AddTowerMenu(pygame.sprite.Sprite):
     width = 400
     height = 180
 
-    def __init__(self, group, plant, moblist, group_for_towers, group_for_bullets):
+    def __init__(self, group, plant, mob_grid, group_for_towers, group_for_bullets):
         super().__init__(group)
         self.coords = plant.rect.x, plant.rect.y
         self.plant = plant
-        self.moblist = moblist
+        self.mob_grid = mob_grid
         self.group_for_towers = group_for_towers
         self.group_for_bullets = group_for_bullets
         self.image = ADD_TOWER_MENU_IMAGE
@@ -518,7 +488,7 @@ class AddTowerMenu(pygame.sprite.Sprite):
             if self.plant.tower.cost >= tower.cost:
                 return  # нельзя заменить более дорогую башню на более дешёвую
             self.plant.tower.kill()
-        self.plant.tower = tower(self.group_for_towers, self.coords, self.moblist, self.group_for_bullets)
+        self.plant.tower = tower(self.group_for_towers, self.coords, self.mob_grid, self.group_for_bullets)
         Game.currency -= tower.cost
         self.plant.image = load_image(os.path.join('sprites', 'nothing.png'))
 
@@ -594,8 +564,10 @@ class Game:
         self.on_pause = False
         self.mob_query = []
         self.moblist = []
+        self.mob_grid = SpatialGrid(MOB_GRID_CELL_SIZE)  # те же мобы, что и в self.moblist, разложенные по сетке
         self.main_tower_group = pygame.sprite.Group()
-        self.main_tower = MainTower(self.main_tower_group, MAINTOWERS_POSITIONS[self.level], self.moblist, self.bullets)
+        self.main_tower = MainTower(self.main_tower_group, MAINTOWERS_POSITIONS[self.level], self.mob_grid,
+                                    self.bullets)
         self.mob_mark = MobMark()  # Крестик, которым можно помечать мобов
         self.playing = False  # playing == True когда игрок проходит кампанию
 
@@ -648,7 +620,7 @@ class Game:
                 y -= tower.y_bias
                 for plant in self.plants:
                     if plant.rect.x == x and plant.rect.y == y:
-                        tower = tower(self.towers, (x, y), self.moblist, self.bullets, reloading, animation_index)
+                        tower = tower(self.towers, (x, y), self.mob_grid, self.bullets, reloading, animation_index)
                         plant.tower = tower
                         plant.kill()
                         break
@@ -862,7 +834,7 @@ class Game:
 
         for plant in self.plants:
             if click.colliderect(plant):
-                AddTowerMenu(self.add_tower_menus, plant, self.moblist, self.towers, self.bullets)
+                AddTowerMenu(self.add_tower_menus, plant, self.mob_grid, self.towers, self.bullets)
                 return
 
         for mob in self.moblist:
@@ -962,6 +934,7 @@ class Game:
             way, way_index = self.map.get_way(road_index)
             mob = Mob(self.mobs[mob_type], way, mob_type, road_index, way_index, target=self.main_tower)
             self.moblist.append(mob)
+        self.update_mob_grid()
         # Отрисовка карты
         self.map.render(self.screen)
         # Обновление и отрисовка игровых объектов
@@ -970,6 +943,7 @@ class Game:
         for mob_type in (HORNY_DOG, BOAR_WARRIOR, SKILLET, CRYSTAL_GOLEM, STONE_GOLEM, MASK):
             self.mobs[mob_type].update()
             self.mobs[mob_type].draw(self.screen)
+        self.update_mob_grid()
         self.plants.draw(self.screen)
         self.towers.update()
         self.towers.draw(self.screen)
@@ -986,6 +960,11 @@ class Game:
             self.level += 1
             self.start_next_level()
 
+    def update_mob_grid(self):
+        """Перекладывает мобов в ячейки сетки, соответствующие их текущим координатам"""
+        for mob in self.moblist:
+            self.mob_grid.place(mob)
+
     def save_progress(self):
         """Сохраняет прогресс в базу данных"""
         self.reset_progress()
@@ -998,6 +977,7 @@ class Game:
         for mob in self.moblist:
             if mob.state == 'death':
                 self.moblist.remove(mob)
+                self.mob_grid.remove(mob)
         # Сохранение информации о мобах:
         mobs_data = []
         for mob in self.moblist:
@@ -1052,6 +1032,7 @@ class Game:
 
     def kill_all_mobs(self):
         self.moblist.clear()
+        self.mob_grid.clear()
         for mob in self.mobs.keys():
             self.mobs[mob].empty()
 
@@ -0,0 +1,171 @@
+import os
+import threading
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from constants import PLAYER_1, PLAYER_2, WAITING_ROOM, RUNNING_ROOM, FINISHED_ROOM
+from tick_profiler import TOTAL
+try:
+    import resource
+except ImportError:  # не Unix: память процесса не отдаётся, см. resident_memory
+    resource = None
+
+
+# В этом файле находится служебный HTTP сервер с метриками игрового сервера: комнаты и игроки, частота и
+# отставание тиков каждой комнаты, число сущностей, скорость отправки данных каждому клиенту, очередь действий
+# и занятая процессом память. Метрики отдаются по адресу /metrics в текстовом формате Prometheus.
+# Сервер метрик слушает только локальный адрес и работает в своём потоке, поэтому не задерживает тики комнат
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9444
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'towerdef_'
+
+# Имя метрики -> (тип, описание)
+METRICS = {
+    'rooms': ('gauge', 'Rooms by state'),
+    'rooms_reclaimed_total': ('counter', 'Closed rooms removed from the registry'),
+    'players': ('gauge', 'Connected players'),
+    'room_tick': ('gauge', 'Last executed tick of the room'),
+    'room_tick_rate': ('gauge', 'Measured ticks per second of the room'),
+    'room_tick_lag_seconds': ('gauge', 'How late the last tick of the room started'),
+    'room_tick_max_lag_seconds': ('gauge', 'Maximum tick lag of the room'),
+    'room_tick_overruns_total': ('counter', 'How many times the room fell behind its schedule'),
+    'room_skipped_ticks_total': ('counter', 'Ticks dropped to catch up with the schedule'),
+    'room_tick_duration_seconds': ('gauge', 'Tick duration percentiles over the last profiler windows'),
+    'room_ticks_over_budget_total': ('counter', 'Ticks that did not fit into the tick budget'),
+    'room_entities': ('gauge', 'Entities of the room by kind'),
+    'room_queued_actions': ('gauge', 'Player actions waiting for the next tick'),
+    'room_actions_total': ('counter', 'Player actions by result'),
+    'connection_sent_bytes_total': ('counter', 'Bytes of game state sent to the client'),
+    'connection_send_rate_bytes': ('gauge', 'Bytes per second sent to the client during the last second'),
+    'connection_queued_bytes': ('gauge', 'Bytes waiting to be sent to the client, including the socket buffer'),
+    'connection_send_lag_seconds': ('gauge', 'How long the current message to the client has been sending'),
+    'connection_skipped_snapshots_total': ('counter', 'Snapshots replaced by newer ones before being sent'),
+    'process_resident_memory_bytes': ('gauge', 'Resident memory of the server process'),
+    'process_threads': ('gauge', 'Threads of the server process'),
+    'workers': ('gauge', 'Running worker processes'),
+    'worker_players': ('gauge', 'Players of the worker process by its last report'),
+}
+
+
+def resident_memory():
+    """Занятая процессом физическая память, байт. Вне Linux - пиковое значение, а без модуля resource - None"""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsWriter:
+    """Собирает текст метрик. Заголовки HELP и TYPE выводятся перед первым значением каждой метрики"""
+    def __init__(self):
+        self.samples = {}  # имя метрики -> строки значений
+
+    def add(self, name, value, **labels):
+        if labels:
+            labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            name_with_labels = f'{PREFIX}{name}{{{labels}}}'
+        else:
+            name_with_labels = PREFIX + name
+        self.samples.setdefault(name, []).append(f'{name_with_labels} {value}')
+
+    def render(self):
+        lines = []
+        for name, samples in self.samples.items():
+            metric_type, description = METRICS[name]
+            lines.append(f'# HELP {PREFIX}{name} {description}')
+            lines.append(f'# TYPE {PREFIX}{name} {metric_type}')
+            lines += samples
+        return '\n'.join(lines) + '\n'
+
+
+def collect_lobby_metrics(lobby, writer):
+    """Добавляет метрики всех комнат lobby. Вызывается из потока сервера метрик, поэтому работает с копиями
+    списков комнат и отправителей: их меняют потоки клиентов или цикл событий"""
+    rooms = lobby.rooms.list()
+    for state in (WAITING_ROOM, RUNNING_ROOM, FINISHED_ROOM):
+        writer.add('rooms', sum(room.state == state for room in rooms), state=state)
+    writer.add('rooms_reclaimed_total', lobby.rooms.reclaimed)
+    writer.add('players', lobby.players_count())
+    for room in rooms:
+        number = room.number
+        game = room.game
+        clock = room.tick_clock
+        writer.add('room_tick', game.tick, room=number)
+        if clock is not None:
+            writer.add('room_tick_rate', clock.tick_rate, room=number)
+            writer.add('room_tick_lag_seconds', clock.lag, room=number)
+            writer.add('room_tick_max_lag_seconds', clock.max_lag, room=number)
+            writer.add('room_tick_overruns_total', clock.overruns, room=number)
+            writer.add('room_skipped_ticks_total', clock.skipped_ticks, room=number)
+        tick_histogram = game.profiler.histograms()[TOTAL]
+        for quantile in (0.5, 0.9, 0.99):
+            writer.add('room_tick_duration_seconds', tick_histogram.percentile(quantile * 100),
+                       room=number, quantile=quantile)
+        writer.add('room_ticks_over_budget_total', game.profiler.over_budget, room=number)
+        writer.add('room_entities', len(game.mobs[PLAYER_1]) + len(game.mobs[PLAYER_2]), room=number, kind='mob')
+        writer.add('room_entities', len(game.towers[PLAYER_1]) + len(game.towers[PLAYER_2]), room=number,
+                   kind='tower')
+        writer.add('room_entities', len(game.bullets), room=number, kind='bullet')
+        writer.add('room_queued_actions', len(game.actions), room=number)
+        for player, counters in game.actions.counters.items():
+            for result, value in counters.items():
+                writer.add('room_actions_total', value, room=number, player=player, result=result)
+        for sender in room.senders.copy():
+            writer.add('connection_sent_bytes_total', sender.traffic.bytes_sent, room=number, player=sender.player)
+            writer.add('connection_send_rate_bytes', sender.traffic.current_rate(), room=number,
+                       player=sender.player)
+            writer.add('connection_queued_bytes', sender.queued_bytes(), room=number, player=sender.player)
+            writer.add('connection_send_lag_seconds', sender.backlog.lag(), room=number, player=sender.player)
+            writer.add('connection_skipped_snapshots_total', sender.backlog.skipped, room=number,
+                       player=sender.player)
+
+
+def collect_workers_metrics(workers, writer):
+    """Метрики главного процесса многопроцессного сервера по последним отчётам обработчиков (см. workers.py)"""
+    workers = workers.copy()
+    writer.add('workers', len(workers))
+    for number, worker in enumerate(workers):
+        writer.add('worker_players', worker.players, worker=number)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    collect = None  # функция, добавляющая метрики в MetricsWriter, задаётся в start_metrics_server
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        writer = MetricsWriter()
+        self.collect(writer)
+        memory = resident_memory()
+        if memory is not None:
+            writer.add('process_resident_memory_bytes', memory)
+        writer.add('process_threads', threading.active_count())
+        body = writer.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы метрик не засоряют вывод сервера
+
+
+def start_metrics_server(collect, port=METRICS_PORT, host=METRICS_HOST):
+    """Запускает сервер метрик в отдельном потоке. collect(writer) добавляет метрики в MetricsWriter.
+    Если порт занят, сервер работает без метрик. Возвращает HTTP сервер или None"""
+    handler = type('Handler', (MetricsHandler,), {'collect': staticmethod(collect)})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as err:
+        print(f'Metrics are disabled: {err}')
+        return None
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Metrics: http://{host}:{port}/metrics')
+    return server
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from constants import FPS, MOBS
+
+
+# В этом файле находится общий для всего процесса реестр параметров мобов (mobs/<тип>/info.json).
+# Файлы читаются один раз, а не при каждом спавне моба. Если файл изменился, при следующем обращении
+# шаблон перечитывается, поэтому правки баланса подхватываются без перезапуска сервера.
+# Модуль не зависит от pygame, чтобы его мог использовать сервер
+
+MOBS_DIR = 'mobs'
+CHECK_INTERVAL = 1  # как часто проверяется время изменения файла с параметрами моба, сек
+
+# Параметры моба в одном из состояний (move, attack, death):
+StateTemplate = namedtuple('StateTemplate', ('width', 'height', 'half_width', 'half_height',
+                                             'animation_speed', 'animation_length'))
+# Неизменяемый шаблон моба. info - содержимое info.json (только для чтения), velocity - скорость в пикселях за тик:
+MobTemplate = namedtuple('MobTemplate', ('type', 'info', 'velocity', 'health', 'damage', 'cost', 'reward',
+                                         'health_line_bias', 'states'))
+
+
+def freeze(data):
+    """Возвращает копию словаря из json, которую нельзя изменить"""
+    if isinstance(data, dict):
+        return MappingProxyType({key: freeze(value) for key, value in data.items()})
+    return data
+
+
+def load_mob_template(mob_type, path):
+    with open(path, 'r', encoding='utf-8') as info_file:
+        info = json.load(info_file)
+    states = {}
+    for state in ('move', 'attack', 'death'):
+        state_info = info[state]
+        states[state] = StateTemplate(state_info['width'], state_info['height'],
+                                      state_info['width'] / 2, state_info['height'] / 2,
+                                      state_info['animation_speed'], state_info['animation_length'])
+    return MobTemplate(mob_type, freeze(info), info['velocity'] / FPS, info['health'], info['damage'],
+                       info['cost'], info['reward'], tuple(info['health_line_bias'].values()),
+                       MappingProxyType(states))
+
+
+class MobTemplates:
+    """Реестр шаблонов мобов. Время изменения файла проверяется не чаще раза в CHECK_INTERVAL секунд,
+    так что обычное обращение к реестру - это поиск в словаре"""
+    def __init__(self, root=MOBS_DIR, mob_types=MOBS, check_interval=CHECK_INTERVAL):
+        self.root = root
+        self.check_interval = check_interval
+        self.templates = {}  # тип моба -> (время изменения файла, время последней проверки, шаблон)
+        for mob_type in mob_types:
+            self.get(mob_type)
+
+    def get(self, mob_type):
+        now = time.monotonic()
+        cached = self.templates.get(mob_type)
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[2]
+        path = os.path.join(self.root, mob_type, 'info.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if cached is not None and cached[0] == mtime:
+                template = cached[2]
+            else:
+                template = load_mob_template(mob_type, path)
+        except (json.JSONDecodeError, OSError, KeyError, TypeError, ValueError, AttributeError) as error:
+            if cached is None:
+                raise
+            # Файл могли прочитать посреди записи. Остаётся прежний шаблон, а файл перечитается при следующей
+            # проверке: время изменения в реестре не обновляется
+            print(f'Failed to reload mob template {path}: {error!r}')
+            self.templates[mob_type] = (cached[0], now, cached[2])
+            return cached[2]
+        # Кортеж заменяется целиком, поэтому потоки, читающие реестр, не увидят его в промежуточном состоянии
+        self.templates[mob_type] = (mtime, now, template)
+        return template
+
+
+MOB_TEMPLATES = MobTemplates()
+
+
+def get_mob_template(mob_type):
+    return MOB_TEMPLATES.get(mob_type)
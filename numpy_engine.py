@@ -0,0 +1,541 @@
+import math
+from heapq import heapify, heappush, heappop
+from itertools import repeat
+import numpy as np
+from constants import *
+from utils import opponent, calculate_distance_between_points
+from server import OnlineGame, MainTower, HomingBullet, SKIRMISH_DISTANCE
+from snapshots import MOB_KIND, BULLET_KIND, PROJECTILE_KIND
+from protocol import FRAMED
+
+
+# В этом файле находится движок онлайн игры, в котором мобы и снаряды хранятся не объектами, а столбцами numpy
+# (struct of arrays): координаты, скорости, здоровье, состояния, индексы анимации и т.д. Перемещение мобов и
+# снарядов и смена анимаций считаются сразу для всех строк таблицы. В цикле на Python обрабатываются только
+# редкие события (переход на следующий отрезок маршрута, удар, стычка), а также всё, где важен порядок обхода
+# списков в OnlineGame. Движок даёт ровно тот же результат, что и OnlineGame: корни и арктангенсы numpy
+# могут отличаться от math в последнем знаке, поэтому окончательные расстояния считаются через math.
+# Для движка нужен numpy, на сервере он включается параметром --engine numpy
+
+MOVE, ATTACK, DEATH, KILLED = range(len(MOB_STATES))
+NO_TARGET = -1
+MAIN_TOWER = -2  # цель моба - главная башня противника
+EPSILON = 1e-6  # запас, с которым numpy отбирает кандидатов, перед точной проверкой через math
+INITIAL_CAPACITY = 64
+
+
+def skipped_after_removal(removed):
+    """Возвращает маску элементов списка, которые пропустит цикл for, удаляющий из этого списка во время обхода
+    элементы с маской removed (после удаления элемента следующий за ним не обходится). None - если удалять нечего"""
+    candidates = np.flatnonzero(removed).tolist()
+    if not candidates:
+        return None
+    skipped = np.zeros(len(removed), bool)
+    for i in candidates:
+        if not skipped[i] and i + 1 < len(removed):
+            skipped[i + 1] = True
+    return skipped
+
+
+class Table:
+    """Набор столбцов numpy одинаковой длины, строки добавляются в конец. Ёмкость растёт вдвое при заполнении"""
+    COLUMNS = {}  # название столбца -> тип numpy
+
+    def __init__(self):
+        self.size = 0
+        self.capacity = INITIAL_CAPACITY
+        for name, dtype in self.COLUMNS.items():
+            setattr(self, name, np.zeros(self.capacity, dtype))
+
+    def add_row(self):
+        if self.size == self.capacity:
+            self.capacity *= 2
+            for name, dtype in self.COLUMNS.items():
+                column = np.zeros(self.capacity, dtype)
+                column[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, column)
+        self.size += 1
+        return self.size - 1
+
+    def keep_rows(self, keep):
+        """Оставляет только строки с маской keep, сохраняя их порядок"""
+        new_size = int(np.count_nonzero(keep))
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            column[:new_size] = column[:self.size][keep]
+        self.size = new_size
+
+
+class MobTable(Table):
+    """Мобы обоих игроков. Строки идут в порядке спавна, поэтому порядок строк игрока совпадает с порядком его списка
+    мобов в OnlineGame. Строка удалённого из игры моба живёт, пока на неё ссылаются снаряды или другие мобы"""
+    COLUMNS = {
+        'player': np.int64,
+        'type': np.int64,  # номер в MOBS
+        'x': np.float64,
+        'y': np.float64,
+        'state': np.int64,  # номер в MOB_STATES
+        'animation_index': np.float64,
+        'animation_speed': np.float64,
+        'animation_length': np.float64,
+        'half_width': np.float64,
+        'half_height': np.float64,
+        'health': np.int64,
+        'damage': np.int64,
+        'velocity': np.float64,
+        'steps_to_next_point': np.float64,
+        'x_velocity': np.float64,
+        'y_velocity': np.float64,
+        'pos': np.int64,
+        'target': np.int64,  # строка моба-цели, NO_TARGET или MAIN_TOWER
+        'pre_fight_x': np.float64,
+        'pre_fight_y': np.float64,
+        'has_pre_fight_coords': np.bool_,  # после схватки моба нужно вернуть в pre_fight_x, pre_fight_y
+        'in_list': np.bool_,  # моб ещё в игре (в списке мобов игрока)
+        'id': np.int64  # id в состоянии игры, 0 - ещё не выдан
+    }
+
+    def __init__(self):
+        super().__init__()
+        # Для редких событий нужны объекты Python, они хранятся в списках параллельно строкам:
+        self.templates = []
+        self.ways = []
+        self.steps_tables = []
+        self.removed = 0  # сколько строк вышло из игры с последнего сжатия таблицы
+
+    def add(self, mob):
+        """Копирует только что созданный объект Mob в новую строку"""
+        row = self.add_row()
+        self.player[row] = mob.player
+        self.type[row] = MOBS.index(mob.type)
+        self.x[row], self.y[row] = mob.coords
+        self.health[row] = mob.health
+        self.damage[row] = mob.damage
+        self.velocity[row] = mob.velocity
+        self.steps_to_next_point[row] = mob.steps_to_next_point
+        self.x_velocity[row] = self.y_velocity[row] = 0
+        self.pos[row] = mob.pos
+        self.target[row] = NO_TARGET
+        self.has_pre_fight_coords[row] = False
+        self.in_list[row] = True
+        self.id[row] = 0
+        self.templates.append(mob.template)
+        self.ways.append(mob.way)
+        self.steps_tables.append(mob.steps_table)
+        self.set_state(row, MOVE)
+
+    def rows_of(self, player):
+        """Строки мобов игрока в порядке его списка мобов"""
+        return np.flatnonzero(self.in_list[:self.size] & (self.player[:self.size] == player))
+
+    def set_state(self, row, state):
+        """Аналог Mob.set_state"""
+        self.state[row] = state
+        state_template = self.templates[row].states[MOB_STATES[state]]
+        self.half_width[row] = state_template.half_width
+        self.half_height[row] = state_template.half_height
+        self.animation_speed[row] = state_template.animation_speed
+        self.animation_length[row] = state_template.animation_length
+        self.animation_index[row] = 0.
+
+    def set_coords(self, row, x, y):
+        """Аналог Mob.set_coords"""
+        self.pre_fight_x[row] = self.x[row]
+        self.pre_fight_y[row] = self.y[row]
+        self.has_pre_fight_coords[row] = True
+        self.x[row] = x
+        self.y[row] = y
+
+    def attack(self, row, target):
+        if self.state[row] != ATTACK:
+            self.target[row] = target
+            self.set_state(row, ATTACK)
+
+    def remove(self, rows):
+        self.state[rows] = KILLED
+        self.in_list[rows] = False
+        self.removed += len(rows)
+
+    def compact(self, bullets):
+        """Убирает строки вышедших из игры мобов, на которые уже никто не ссылается"""
+        keep = self.in_list[:self.size].copy()
+        targets = self.target[:self.size][keep]
+        keep[targets[targets >= 0]] = True
+        keep[bullets.target[:bullets.size]] = True
+        new_rows = np.cumsum(keep) - 1
+        kept = np.flatnonzero(keep).tolist()
+        self.templates = [self.templates[row] for row in kept]
+        self.ways = [self.ways[row] for row in kept]
+        self.steps_tables = [self.steps_tables[row] for row in kept]
+        self.keep_rows(keep)
+        targets = self.target[:self.size]
+        targets[~self.in_list[:self.size]] = NO_TARGET  # цели вышедших из игры мобов больше не нужны
+        has_target = targets >= 0
+        targets[has_target] = new_rows[targets[has_target]]
+        bullets.target[:bullets.size] = new_rows[bullets.target[:bullets.size]]
+        self.removed = 0
+
+
+class MobView:
+    """Моб из таблицы для кода, написанного для объектов Mob: башен и конструкторов снарядов"""
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def coords(self):
+        return [float(self.table.x[self.row]), float(self.table.y[self.row])]
+
+    @property
+    def state(self):
+        return MOB_STATES[self.table.state[self.row]]
+
+    @property
+    def health(self):
+        return int(self.table.health[self.row])
+
+    def get_position(self, delta_steps):
+        """Аналог Mob.get_position"""
+        table, row = self.table, self.row
+        return table.ways[row].get_position(int(table.pos[row]), self.coords,
+                                            float(table.steps_to_next_point[row]), float(table.velocity[row]),
+                                            delta_steps)
+
+
+class MobList:
+    """Список мобов игрока поверх таблицы: то, что добавляется в список, копируется в таблицу"""
+    def __init__(self, table, player):
+        self.table = table
+        self.player = player
+
+    def append(self, mob):
+        self.table.add(mob)
+
+    def __iter__(self):
+        return (MobView(self.table, row) for row in self.table.rows_of(self.player).tolist())
+
+    def __len__(self):
+        return len(self.table.rows_of(self.player))
+
+
+class MobIndex:
+    """Замена SpatialGrid для башен: поиск первого подходящего моба игрока перебором таблицы средствами numpy"""
+    def __init__(self, table, player):
+        self.table = table
+        self.player = player
+
+    def first_within(self, coords, radius, accept, key=None):
+        """Аналог SpatialGrid.first_within без параметра key (он нужен только одиночной игре)"""
+        if key is not None:
+            raise NotImplementedError('key is not supported by the numpy engine')
+        table = self.table
+        rows = table.rows_of(self.player)
+        distances = np.hypot(coords[0] - table.x[rows], coords[1] - table.y[rows])
+        for row in rows[distances <= radius + EPSILON].tolist():
+            mob = MobView(table, row)
+            distance = calculate_distance_between_points(*coords, *mob.coords)
+            if distance <= radius and accept(mob):
+                return mob, distance
+        return None, None
+
+
+class BulletTable(Table):
+    """Снаряды в порядке их появления. Целью снаряда служит строка в таблице мобов.
+    x и y прямолетящего снаряда - точка вылета: его положение рассчитывает клиент (см. server.Bullet)"""
+    COLUMNS = {
+        'homing': np.bool_,
+        'type': np.int64,  # номер в types
+        'x': np.float64,
+        'y': np.float64,
+        'angle': np.float64,
+        'animation_index': np.int64,
+        'animation_length': np.int64,
+        'damage': np.int64,
+        'target': np.int64,
+        'velocity': np.float64,
+        'end_x': np.float64,
+        'end_y': np.float64,
+        'steps_to_target': np.float64,
+        'spawn_tick': np.int64,
+        'id': np.int64
+    }
+
+    def __init__(self, mobs):
+        super().__init__()
+        self.mobs = mobs
+        self.types = []
+
+    def append(self, bullet):
+        """Копирует только что созданный объект Bullet или HomingBullet в новую строку"""
+        row = self.add_row()
+        homing = isinstance(bullet, HomingBullet)
+        if bullet.type not in self.types:
+            self.types.append(bullet.type)
+        self.homing[row] = homing
+        self.type[row] = self.types.index(bullet.type)
+        self.x[row], self.y[row] = bullet.coords
+        self.angle[row] = bullet.angle
+        self.animation_index[row] = bullet.animation_index
+        self.damage[row] = bullet.damage
+        self.target[row] = bullet.mob.row
+        self.velocity[row] = bullet.velocity
+        self.id[row] = 0
+        if homing:
+            self.animation_length[row] = bullet.animation_length
+        else:
+            self.end_x[row], self.end_y[row] = bullet.end_coords
+            self.steps_to_target[row] = bullet.steps_to_target
+
+    def __len__(self):
+        return self.size
+
+    def update(self):
+        """Аналог цикла по снарядам в OnlineGame.update_bullets"""
+        size = self.size
+        if not size:
+            return
+        mobs = self.mobs
+        homing = self.homing[:size]
+        homing_rows = np.flatnonzero(homing).tolist()
+        targets = self.target[:size]
+        killed = ~homing & (self.steps_to_target[:size] <= 0)
+        # Самонаводящийся снаряд долетает, когда подлетает к цели или цель умирает. Расстояние нужно посчитать
+        # так же, как HomingBullet, поэтому оно считается через math
+        x, y = self.x[:size].tolist(), self.y[:size].tolist()
+        target_x, target_y = mobs.x[targets].tolist(), mobs.y[targets].tolist()
+        target_dead = (mobs.state[targets] == DEATH).tolist()
+        for row in homing_rows:
+            killed[row] = math.hypot(target_x[row] - x[row], y[row] - target_y[row]) < 10 or target_dead[row]
+        skipped = skipped_after_removal(killed)
+        processed = ~skipped if skipped is not None else np.ones(size, bool)
+
+        flying = processed & ~killed & ~homing
+        self.steps_to_target[:size][flying] -= 1
+        hits = processed & killed & ~homing
+        np.subtract.at(mobs.health, targets[hits], self.damage[:size][hits])
+
+        processed_list = processed.tolist()
+        for row in homing_rows:
+            if not processed_list[row]:
+                continue
+            bullet_x, bullet_y = x[row], y[row]
+            d_x, d_y = target_x[row] - bullet_x, bullet_y - target_y[row]
+            distance = math.hypot(d_x, d_y)
+            velocity = float(self.velocity[row])
+            self.x[row] = bullet_x + velocity * (d_x / distance)
+            self.y[row] = bullet_y + velocity * (-d_y / distance)
+            angle = math.atan(d_y / d_x)
+            if d_x > 0:
+                angle += math.pi
+            self.angle[row] = angle
+            self.animation_index[row] = (self.animation_index[row] + 1) % self.animation_length[row]
+            if killed[row]:
+                mobs.health[targets[row]] -= self.damage[row]
+
+        removed = processed & killed
+        if removed.any():
+            self.keep_rows(~removed)
+
+
+class NumpyOnlineGame(OnlineGame):
+    """OnlineGame, в которой мобы и снаряды хранятся в таблицах numpy. Башни остаются объектами"""
+    def __init__(self, protocol=FRAMED, seed=None):
+        super().__init__(protocol, seed)
+        self.table = MobTable()
+        self.mobs = {
+            PLAYER_1: MobList(self.table, PLAYER_1),
+            PLAYER_2: MobList(self.table, PLAYER_2)
+        }
+        self.mob_grids = {
+            PLAYER_1: MobIndex(self.table, PLAYER_1),
+            PLAYER_2: MobIndex(self.table, PLAYER_2)
+        }
+        self.bullets = BulletTable(self.table)
+        self.main_towers = {
+            PLAYER_1: MainTower(PLAYER_1, self.mob_grids, self.bullets, self.sounds_query),
+            PLAYER_2: MainTower(PLAYER_2, self.mob_grids, self.bullets, self.sounds_query)
+        }
+        self.ready_towers = [self.main_towers[PLAYER_1], self.main_towers[PLAYER_2]]
+
+    def update_mobs(self):
+        table = self.table
+        if table.removed > max(table.size - table.removed, INITIAL_CAPACITY):
+            table.compact(self.bullets)
+        self.update_player_mobs(PLAYER_1)
+        return self.update_player_mobs(PLAYER_2)
+
+    def update_player_mobs(self, player):
+        """Аналог цикла по мобам игрока с вызовом Mob.update и удалением убитых мобов.
+        Возвращает строки обновлённых мобов, оставшихся в игре"""
+        table = self.table
+        rows = table.rows_of(player)
+        animation = (table.animation_index[rows] + table.animation_speed[rows]) % table.animation_length[rows]
+        state = table.state[rows]
+        killed = (state == DEATH) & (np.round(animation) == table.animation_length[rows])
+        skipped = skipped_after_removal(killed)
+        if skipped is not None:
+            rows, animation, killed = rows[~skipped], animation[~skipped], killed[~skipped]
+        table.animation_index[rows] = animation
+        dying = rows[(table.health[rows] <= 0) & (table.state[rows] != DEATH)]
+        for row in dying.tolist():
+            table.set_state(row, DEATH)
+        state = table.state[rows]
+        self.move_mobs(rows[state == MOVE])
+        self.resolve_mobs_hits(rows[state == ATTACK], player)
+        table.remove(rows[killed])
+        return rows[~killed]
+
+    def move_mobs(self, rows):
+        """Шаг мобов в состоянии move"""
+        table = self.table
+        walking = np.ones(len(rows), bool)
+        for i in np.flatnonzero(table.steps_to_next_point[rows] <= 0).tolist():
+            # Переход на следующий отрезок маршрута
+            row = int(rows[i])
+            pos = table.pos[row] = min(int(table.pos[row]) + 1, len(table.ways[row]))
+            steps_table = table.steps_tables[row]
+            if pos - 1 < len(steps_table):
+                table.steps_to_next_point[row], table.x_velocity[row], table.y_velocity[row] = steps_table[pos - 1]
+            else:
+                # Маршрут закончился - моб атакует главную башню противника
+                walking[i] = False
+                table.attack(row, MAIN_TOWER)
+        rows = rows[walking]
+        table.steps_to_next_point[rows] -= 1
+        table.x[rows] += table.x_velocity[rows]
+        table.y[rows] += table.y_velocity[rows]
+
+    def resolve_mobs_hits(self, rows, player):
+        """Удары мобов в состоянии attack. Удары применяются по очереди, потому что от здоровья цели после удара
+        зависит, продолжат ли драться следующие мобы"""
+        table = self.table
+        hits = rows[np.trunc(table.animation_index[rows]) == table.animation_length[rows] - 1]
+        main_tower = self.main_towers[opponent(player)]
+        for row in hits.tolist():
+            target = int(table.target[row])
+            damage = int(table.damage[row])
+            if target == MAIN_TOWER:
+                main_tower.hit(damage)
+                target_health = main_tower.health
+            else:
+                table.health[target] -= damage
+                target_health = table.health[target]
+            self.sounds_query.append('mob_hit')
+            if target_health <= 0:
+                table.target[row] = NO_TARGET
+                table.set_state(row, MOVE)
+                if table.has_pre_fight_coords[row]:
+                    table.x[row] = table.pre_fight_x[row]
+                    table.y[row] = table.pre_fight_y[row]
+                    # Mob.strike возвращает моба на место присваиванием списка, и дальше pre_fight_coords
+                    # движется вместе с мобом до следующей схватки, так что повторный возврат его не сдвигает
+                    table.has_pre_fight_coords[row] = False
+
+    def form_all_skirmishes(self, rows):
+        """Аналог OnlineGame.form_all_skirmishes для всех обновлённых мобов правого игрока (rows) по порядку.
+        Пары мобов, которые могут оказаться рядом, отбираются заранее сортировкой по x. Мобов левого игрока,
+        передвинутых стычками на этом тике, проверяют все мобы правого игрока, стоящие рядом с их новым местом"""
+        table = self.table
+        rows = rows[table.state[rows] != DEATH]
+        opponents = table.rows_of(PLAYER_1)
+        if not len(rows) or not len(opponents):
+            return
+        limit = SKIRMISH_DISTANCE + EPSILON
+        x, y = table.x[rows], table.y[rows]
+        opponents_x = table.x[opponents]
+        by_x = np.argsort(opponents_x, kind='stable')
+        sorted_x = opponents_x[by_x]
+        first = np.searchsorted(sorted_x, x - limit, 'left')
+        counts = np.searchsorted(sorted_x, x + limit, 'right') - first
+        pairs = np.repeat(np.arange(len(rows)), counts)
+        pairs_opponents = opponents[by_x[np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts - first, counts)]]
+        # Драться могут только пары, в которых кто-то идёт и никто не умирает:
+        states, opponents_states = table.state[rows][pairs], table.state[pairs_opponents]
+        close = ((np.hypot(x[pairs] - table.x[pairs_opponents], y[pairs] - table.y[pairs_opponents]) < limit)
+                 & (opponents_states != DEATH) & ((states == MOVE) | (opponents_states == MOVE)))
+        pairs, pairs_opponents = pairs[close], pairs_opponents[close]
+        starts = np.searchsorted(pairs, np.arange(len(rows) + 1)).tolist()
+        pairs_opponents = pairs_opponents.tolist()
+        queue = sorted(set(pairs.tolist()))
+        heapify(queue)
+        moved = set()  # мобы левого игрока, передвинутые стычками на этом тике
+        last = -1
+        while queue:
+            i = heappop(queue)
+            if i <= last:
+                continue
+            last = i
+            row = int(rows[i])
+            candidates = sorted(moved.union(pairs_opponents[starts[i]:starts[i + 1]]))
+            checked = -1
+            j = 0
+            while j < len(candidates):
+                opponent_row = candidates[j]
+                j += 1
+                if opponent_row <= checked:
+                    continue
+                checked = opponent_row
+                if calculate_distance_between_points(table.x[row].item(), table.y[row].item(),
+                                                     table.x[opponent_row].item(),
+                                                     table.y[opponent_row].item()) < SKIRMISH_DISTANCE:
+                    states = {table.state[row], table.state[opponent_row]}
+                    if MOVE in states and DEATH not in states:
+                        self.let_mobs_fight(row, opponent_row)
+                        moved.add(opponent_row)
+                        opponent_x, opponent_y = table.x[opponent_row], table.y[opponent_row]
+                        for k in np.flatnonzero(np.hypot(x - opponent_x, y - opponent_y) < limit).tolist():
+                            if k > i:
+                                heappush(queue, k)
+                        distances = np.hypot(table.x[row] - table.x[opponents], table.y[row] - table.y[opponents])
+                        candidates = opponents[distances < limit].tolist()
+                        j = 0
+
+    def let_mobs_fight(self, row, opponent_row):
+        """Аналог server.let_mobs_fight для моба правого игрока row и моба левого игрока opponent_row"""
+        table = self.table
+        x = (table.x[row].item() + table.x[opponent_row].item()) / 2
+        y = (table.y[row].item() + table.y[opponent_row].item()) / 2
+        table.set_coords(row, x + 30, y)
+        table.set_coords(opponent_row, x - 30, y)
+        table.attack(row, opponent_row)
+        table.attack(opponent_row, row)
+
+    def update_bullets(self):
+        self.bullets.update()
+
+    def get_entities(self):
+        entities = {}
+        table = self.table
+        rows = np.concatenate((table.rows_of(PLAYER_1), table.rows_of(PLAYER_2)))
+        self.assign_entity_ids(table.id, rows)
+        records = zip(table.player[rows].tolist(), [MOBS[mob_type] for mob_type in table.type[rows].tolist()],
+                      (table.x[rows] - table.half_width[rows]).tolist(),
+                      (table.y[rows] - table.half_height[rows]).tolist(),
+                      [MOB_STATES[state] for state in table.state[rows].tolist()],
+                      table.animation_index[rows].astype(np.int64).tolist(), table.health[rows].tolist())
+        entities.update(zip(table.id[rows].tolist(), zip(repeat(MOB_KIND), records)))
+        self.add_towers_entities(entities)
+        bullets = self.bullets
+        size = bullets.size
+        bullets.spawn_tick[self.assign_entity_ids(bullets.id, np.arange(size))] = self.tick
+        for entity_id, homing, bullet_type, x, y, angle, animation_index, end_x, end_y, spawn_tick, velocity in zip(
+                bullets.id[:size].tolist(), bullets.homing[:size].tolist(),
+                [bullets.types[bullet_type] for bullet_type in bullets.type[:size].tolist()],
+                bullets.x[:size].tolist(), bullets.y[:size].tolist(), bullets.angle[:size].tolist(),
+                bullets.animation_index[:size].tolist(), bullets.end_x[:size].tolist(), bullets.end_y[:size].tolist(),
+                bullets.spawn_tick[:size].tolist(), bullets.velocity[:size].tolist()):
+            if homing:
+                entities[entity_id] = (BULLET_KIND, (bullet_type, x, y, angle, animation_index))
+            else:
+                entities[entity_id] = (PROJECTILE_KIND, (bullet_type, x, y, end_x, end_y, spawn_tick, velocity))
+        return entities
+
+    def assign_entity_ids(self, ids, rows):
+        """Выдаёт id строкам, у которых его ещё нет, в том же порядке, что и OnlineGame.get_entity_id.
+        Возвращает строки, получившие id"""
+        new_rows = rows[ids[rows] == 0]
+        if len(new_rows):
+            ids[new_rows] = [next(self.entity_ids) for _ in range(len(new_rows))]
+        return new_rows
@@ -1,22 +1,24 @@
-import socket
-import pickle
 import math
+from time import perf_counter
 from sprites import *
 from exceptions import *
 from threading import Thread
 from utils import opponent
+from protocol import *
+from recording import SnapshotRecording
+from interpolation import SnapshotBuffer
+from client_connection import ServerConnection
+from mob_templates import get_mob_template
 from pygame_functions import *
 from sounds import *
 
 
 def load_mobs_data():
-    """Загружает информацию о всех мобах из json файлов"""
+    """Собирает информацию о всех мобах: параметры из реестра шаблонов мобов и анимации"""
     data = {}
     animations = load_mob_animations()
     for mob in MOBS:
-        with open(os.path.join('mobs', mob, 'info.json'), 'r', encoding='utf-8') as info_file:
-            data[mob] = json.load(info_file)
-        data[mob]['animations'] = animations[mob]
+        data[mob] = dict(get_mob_template(mob).info, animations=animations[mob])
     return data
 
 
@@ -58,6 +60,15 @@ MOBS_DATA = load_mobs_data()
 ROAD_ZONES = load_mob_spawn_zones()
 
 
+def animation_length(kind, record):
+    """Число кадров анимации сущности из состояния игры (для интерполяции кадров между состояниями)"""
+    if kind == MOB_KIND:
+        return len(MOBS_DATA[record[1]]['animations'][record[4]])
+    if kind == TOWER_KIND:
+        return len(TOWERS_SPRITES[record[0]])
+    return len(BULLETS_SPRITES[record[0]])
+
+
 class AddTowerMenu(pygame.sprite.Sprite):
     """Меню выбора башни, выпадающее при нажатии на плент"""
     width = 400
@@ -115,7 +126,7 @@ class AddTowerMenu(pygame.sprite.Sprite):
 
     def spawn_tower(self, tower):
         """Отсылает серверу команду спавна башни и убирает плент, если он был"""
-        self.client.send(str.encode(f"spawn_tower {tower} {';'.join(map(str, self.coords))}"))
+        self.client.send_action(f"spawn_tower {tower} {';'.join(map(str, self.coords))}")
         if self.plant.free:
             self.plant.free = False
             self.plant.image = load_image(os.path.join('sprites', 'nothing.png'))
@@ -292,10 +303,12 @@ class OnlineGame:
     def __init__(self, screen):
         self.screen = screen
         self.plants = self.load_plants()
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect(ADDRESS)
-        self.data_from_server = pickle.loads(self.client.recv(1024))
-        self.player_index = self.data_from_server
+        self.client = ServerConnection(ADDRESS)
+        self.data_from_server = self.player_index = self.client.player
+        self.snapshot_buffer = SnapshotBuffer(animation_length)  # состояния для отрисовки с интерполяцией
+        self.init_ui()
+
+    def init_ui(self):
         if self.player_index == PLAYER_1:
             mirror_mob_icons()
         self.add_tower_menus = pygame.sprite.Group()
@@ -364,20 +377,17 @@ class OnlineGame:
         self.pause.check_keypress(key)
 
     def get_data_from_server(self, my_data='ok'):
-        self.client.send(str.encode(my_data))  # 'ok' - дефолтное сообщение, не вызывает никакой реакции сервера
-        data = []
-        while True:  # получем пакеты пока не прийдут все нужные данные
-            packet = self.client.recv(2048)
-            data.append(packet)
-            if len(packet) != 2048:  # если пакет не полный, значит он последний
-                break
-        try:
-            data = pickle.loads(b"".join(data))
-            return data
-        except EOFError:
-            raise OpponentExitError
-        except ConnectionResetError:
-            raise OpponentExitError
+        """Ставит действие игрока в очередь на отправку, забирает присланные сервером состояния игры и возвращает
+        состояние для текущего кадра. Сеть обслуживают потоки ServerConnection, поэтому кадр её не ждёт.
+        Сервер рассылает состояние реже, чем клиент рисует кадры, поэтому положения мобов и снарядов
+        между полученными состояниями интерполируются (см. interpolation.py)"""
+        if my_data != 'ok':  # 'ok' - дефолтное значение, означает что игрок ничего не сделал
+            self.client.send_action(my_data)
+        for snapshot, arrival in self.client.take_snapshots():
+            self.snapshot_buffer.add(snapshot, arrival)
+        if self.client.waiting or not self.snapshot_buffer:
+            return 'Waiting for players'
+        return self.snapshot_buffer.frame(perf_counter())
 
     def render_currency(self):
         """Отрисовывает количество валюты и иконку монеты в левом верхнем углу"""
@@ -464,43 +474,120 @@ class OnlineGame:
             self.pause.render()
             for sound in sounds_data:
                 SOUNDS[sound].play()
-            # Проверка на выигрыш/проигрыш:
-            if self.main_towers_hp[self.player_index] <= 0:
-                raise Lose
-            elif self.main_towers_hp[opponent(self.player_index)] <= 0:
-                raise Win
+            self.check_game_over()
         else:
             self.screen.blit(WAITING_PLAYERS_SCREEN, (0, 0))
             self.buttons.draw(self.screen)
 
+    def check_game_over(self):
+        """Проверка на выигрыш/проигрыш"""
+        if self.main_towers_hp[self.player_index] <= 0:
+            raise Lose
+        elif self.main_towers_hp[opponent(self.player_index)] <= 0:
+            raise Win
+
+
+class RecordingViewer(OnlineGame):
+    """Просмотр записи матча (см. recording.py). Состояния игры берутся из записи, а не от сервера, и отрисовываются
+    так же, как в матче. Стрелки вверх/вниз меняют скорость просмотра, влево/вправо - перематывают запись,
+    пробел ставит просмотр на паузу"""
+    speeds = (0.25, 0.5, 1, 2, 4, 8, 16)
+    seek_step = 10  # на сколько секунд перематывается запись
+
+    def __init__(self, screen, path, player=PLAYER_1, speed=1):
+        self.screen = screen
+        self.plants = self.load_plants()
+        self.recording = SnapshotRecording(path)
+        self.player_index = player  # глазами какого игрока смотрится запись
+        self.data_from_server = None
+        self.speed = min(self.speeds, key=lambda known_speed: abs(known_speed - speed))
+        self.position = self.recording.first_tick  # текущий тик просмотра, может быть дробным
+        self.paused = False
+        self.info_font = pygame.font.SysFont('Arial', 24)
+        self.init_ui()
+
+    def on_click_down(self, pos):
+        self.pause.check_click_down(pygame.Rect(*pos, 1, 1))
+
+    def on_release(self, pos):
+        if self.pause:
+            self.pause.check_release(pos)
+
+    def on_click_up(self, pos):
+        if self.pause:
+            self.pause.check_click_up()
+        return 'ok'
+
+    def on_keypress(self, key):
+        speed_index = self.speeds.index(self.speed)
+        if key == pygame.K_UP:
+            self.speed = self.speeds[min(speed_index + 1, len(self.speeds) - 1)]
+        elif key == pygame.K_DOWN:
+            self.speed = self.speeds[max(speed_index - 1, 0)]
+        elif key == pygame.K_SPACE:
+            self.paused = not self.paused
+        elif key in (pygame.K_LEFT, pygame.K_RIGHT):
+            step = self.seek_step * self.recording.tick_rate * (1 if key == pygame.K_RIGHT else -1)
+            self.position = min(max(self.position + step, self.recording.first_tick), self.recording.last_tick)
+            self.recording.seek(int(self.position))
+        else:
+            self.pause.check_keypress(key)
+
+    def get_data_from_server(self, my_data='ok'):
+        """Возвращает состояние игры из записи, передвигая просмотр на один кадр с текущей скоростью"""
+        sounds = ()
+        if not self.pause and not self.paused:
+            self.position = min(self.position + self.speed * self.recording.tick_rate / FPS, self.recording.last_tick)
+            sounds = self.recording.advance(int(self.position))
+            if self.speed > 1:
+                sounds = ()  # при ускоренном просмотре звуки сливаются в шум
+        data = self.recording.snapshot.as_tuple()
+        return data[:3] + (tuple(sounds),) + data[4:]
+
+    def update_and_render(self, user_action='ok'):
+        super().update_and_render(user_action)
+        state = 'pause' if self.paused else f'x{self.speed:g}'
+        info = self.info_font.render(f'{state}  {self.recording.snapshot.tick} / {self.recording.last_tick}',
+                                     True, (255, 255, 255))
+        self.screen.blit(info, (900, 20))
+
+    def check_game_over(self):
+        pass  # запись просто доходит до конца
+
+
+def run_game(screen, game):
+    """Игровой цикл онлайн матча или просмотра записи"""
+    time = pygame.time.Clock()
+    fps_font = pygame.font.SysFont("Arial", 18)
+    user_action = 'ok'
+    running = True
+    while running:
+        game.update_and_render(user_action)
+        user_action = 'ok'
+        time.tick(FPS)
+        for event in pygame.event.get():
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                game.on_click_down(event.pos)
+            elif event.type == pygame.MOUSEMOTION:
+                game.on_release(event.pos)
+            elif event.type == pygame.MOUSEBUTTONUP:
+                user_action = game.on_click_up(event.pos)
+            elif event.type == pygame.KEYDOWN:
+                game.on_keypress(event.key)
+            elif event.type == pygame.QUIT:
+                running = False
+        fps_text = fps_font.render(str(int(time.get_fps())), True, (0, 255, 0))
+        screen.blit(fps_text, (10, 0))
+        pygame.display.flip()
+
 
 def play_online(screen, background_music=None):
+    game = None
     try:
         game = OnlineGame(screen)
         if background_music is not None:  # Если играла музыка главного меню, нужно её выключить
             Thread(target=start_or_stop_music, args=(background_music, True), daemon=True).start()
-        time = pygame.time.Clock()
-        fps_font = pygame.font.SysFont("Arial", 18)
-        user_action = 'ok'
-        running = True
-        while running:
-            game.update_and_render(user_action)
-            user_action = 'ok'
-            time.tick(FPS)
-            for event in pygame.event.get():
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    game.on_click_down(event.pos)
-                elif event.type == pygame.MOUSEMOTION:
-                    game.on_release(event.pos)
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    user_action = game.on_click_up(event.pos)
-                elif event.type == pygame.KEYDOWN:
-                    game.on_keypress(event.key)
-                elif event.type == pygame.QUIT:
-                    running = False
-            fps_text = fps_font.render(str(int(time.get_fps())), True, (0, 255, 0))
-            screen.blit(fps_text, (10, 0))
-            pygame.display.flip()
+        run_game(screen, game)
     except Win:
         return 'win'
     except Exit:
@@ -513,10 +600,35 @@ def play_online(screen, background_music=None):
         return 'opponent_disconnected'
     except Exception:
         raise ServerError
+    finally:
+        if game is not None:
+            game.client.close()
+
+
+def play_recording(screen, path, player=PLAYER_1, speed=1):
+    """Показывает запись матча, сделанную сервером (server.py --record-dir)"""
+    game = RecordingViewer(screen, path, player, speed)
+    try:
+        run_game(screen, game)
+    except Exit:
+        pass
+    finally:
+        game.recording.close()
+    return 'exit'
 
 
 if __name__ == '__main__':  # Предполагается что данный файл - это модуль проекта, но возможен и автономный запуск
+    import argparse
+    parser = argparse.ArgumentParser(description='Онлайн режим. Если указан файл записи матча - просмотр записи')
+    parser.add_argument('recording', nargs='?', help='файл записи матча (server.py --record-dir)')
+    parser.add_argument('--speed', type=float, default=1, help='скорость просмотра записи, от 0.25 до 16')
+    parser.add_argument('--player', type=int, choices=(PLAYER_1, PLAYER_2), default=PLAYER_1,
+                        help='глазами какого игрока смотреть запись')
+    args = parser.parse_args()
     pygame.init()
     screen = pygame.display.set_mode(SIZE)
-    play_online(screen)
+    if args.recording is not None:
+        play_recording(screen, args.recording, args.player, args.speed)
+    else:
+        play_online(screen)
     pygame.quit()
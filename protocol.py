@@ -0,0 +1,263 @@
+import math
+import struct
+from constants import MOBS, MOB_STATES, TOWER_TYPES, BULLET_TYPES, SOUND_NAMES
+from exceptions import ProtocolError
+from snapshots import *
+
+
+# В этом файле описан протокол обмена данными между сервером и клиентом онлайн режима.
+# Каждое сообщение - это заголовок (длина тела, версия протокола, тип сообщения) и тело.
+# Игровые данные кодируются модулем struct, а не pickle, чтобы собеседник не мог выполнить произвольный код.
+# Состояние игры высылается в виде дельты относительно подтверждённого клиентом состояния (см. snapshots.py)
+
+LEGACY = 'legacy'  # старый протокол: pickle без заголовков, клиент дочитывает пакеты по 2048 байт
+FRAMED = 'framed'  # протокол из этого файла
+PROTOCOL_VERSION = 4
+MAX_MESSAGE_SIZE = 1 << 20
+
+# Типы сообщений:
+HELLO = 1  # сервер -> клиент: номер игрока
+WAITING = 2  # сервер -> клиент: ожидание второго игрока
+SNAPSHOT = 3  # сервер -> клиент: состояние игры (полное или дельта)
+ACTION = 4  # клиент -> сервер: действие игрока в текстовом виде, например "spawn_mob skillet 0 100;500"
+REQUEST = 5  # клиент -> сервер: запрос внеочередной отправки состояния игры (обычно сервер рассылает его сам)
+ACK = 6  # клиент -> сервер: подтверждение получения состояния игры на определённом тике
+KEYFRAME_REQUEST = 7  # клиент -> сервер: запрос полного состояния игры
+PING = 8  # клиент -> сервер: замер задержки, сервер возвращает тело сообщения в PONG без изменений
+PONG = 9  # сервер -> клиент: ответ на PING
+
+HEADER = struct.Struct('!IBB')  # длина тела, версия протокола, тип сообщения
+HELLO_BODY = struct.Struct('!B')
+TICK_BODY = struct.Struct('!I')
+PING_BODY = struct.Struct('!d')  # время отправки PING по часам клиента, сек
+# Состояние игры: номер тика, номер базового тика (NO_BASE для полного состояния), маска изменившихся скаляров,
+# количество записей мобов, башен, самонаводящихся и прямолетящих снарядов, количество исчезнувших сущностей и звуков.
+# Далее идут изменившиеся скаляры, записи появившихся и изменившихся сущностей (сначала все мобы, потом башни,
+# потом снаряды), id исчезнувших сущностей и номера звуков.
+# Запись сущности имеет постоянную длину для своего вида, поэтому записи одного вида декодируются одним
+# struct.iter_unpack. Строки (типы, состояния, звуки) передаются номерами в перечислениях из constants.py,
+# координаты - целым числом пикселей, а угол - одним байтом (ANGLE_STEPS делений окружности)
+SNAPSHOT_HEADER = struct.Struct('!IIBHHHHHH')
+NO_BASE = 0xFFFFFFFF
+SCALAR = struct.Struct('!i')
+SCALARS_COUNT = 4
+REMOVED_ENTITY = struct.Struct('!I')
+ANGLE_STEPS = 256
+SPEED_SCALE = 100  # скорость прямолетящего снаряда передаётся в сотых долях пикселя за тик
+# Записи сущностей: id и поля в порядке snapshots.py
+ENTITY_RECORDS = {
+    MOB_KIND: struct.Struct('!IBBhhBBh'),  # игрок, номер типа, x, y, номер состояния, кадр анимации, здоровье
+    TOWER_KIND: struct.Struct('!IBhhB'),  # номер типа, x, y, кадр анимации
+    BULLET_KIND: struct.Struct('!IBhhBB'),  # номер типа, x, y, угол, кадр анимации
+    PROJECTILE_KIND: struct.Struct('!IBhhhhIH')  # номер типа, точка вылета, точка попадания, тик вылета, скорость
+}
+ENTITY_KINDS = tuple(ENTITY_RECORDS)  # порядок, в котором в сообщении идут записи сущностей разных видов
+# Наименьшее и наибольшее значение каждого поля записей сущностей
+FORMAT_LIMITS = {'B': (0, 0xFF), 'H': (0, 0xFFFF), 'I': (0, 0xFFFFFFFF), 'h': (-0x8000, 0x7FFF)}
+FIELD_LIMITS = {kind: tuple(FORMAT_LIMITS[field] for field in record.format.lstrip('!'))
+                for kind, record in ENTITY_RECORDS.items()}
+MOB_IDS = {mob_type: i for i, mob_type in enumerate(MOBS)}
+MOB_STATE_IDS = {state: i for i, state in enumerate(MOB_STATES)}
+TOWER_IDS = {tower_type: i for i, tower_type in enumerate(TOWER_TYPES)}
+BULLET_IDS = {bullet_type: i for i, bullet_type in enumerate(BULLET_TYPES)}
+SOUND_IDS = {sound: i for i, sound in enumerate(SOUND_NAMES)}
+ANGLE_SCALE = ANGLE_STEPS / (2 * math.pi)
+
+
+def pack_message(message_type, body=b''):
+    return HEADER.pack(len(body), PROTOCOL_VERSION, message_type) + body
+
+
+def unpack_header(header):
+    """Возвращает длину тела и тип сообщения по его заголовку"""
+    length, version, message_type = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}')
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f'Message is too long ({length} bytes)')
+    return length, message_type
+
+
+def recv_exactly(sock, size):
+    """Читает из сокета ровно size байт"""
+    data = bytearray()
+    while len(data) < size:
+        packet = sock.recv(size - len(data))
+        if not packet:
+            raise EOFError('Connection closed')
+        data += packet
+    return bytes(data)
+
+
+def send_message(sock, message_type, body=b''):
+    sock.sendall(pack_message(message_type, body))
+
+
+def recv_message(sock):
+    """Читает из сокета одно сообщение целиком и возвращает его тип и тело"""
+    length, message_type = unpack_header(recv_exactly(sock, HEADER.size))
+    return message_type, recv_exactly(sock, length)
+
+
+async def read_message(reader):
+    """Аналог recv_message для asyncio.StreamReader"""
+    length, message_type = unpack_header(await reader.readexactly(HEADER.size))
+    return message_type, await reader.readexactly(length)
+
+
+def encode_hello(player):
+    return HELLO_BODY.pack(player)
+
+
+def decode_hello(body):
+    return HELLO_BODY.unpack(body)[0]
+
+
+def encode_ack(tick):
+    return TICK_BODY.pack(tick)
+
+
+def decode_ack(body):
+    return TICK_BODY.unpack(body)[0]
+
+
+def encode_ping(sent_at):
+    return PING_BODY.pack(sent_at)
+
+
+def decode_ping(body):
+    if len(body) != PING_BODY.size:
+        raise ProtocolError(f'Wrong ping length {len(body)}')
+    return PING_BODY.unpack(body)[0]
+
+
+def encode_record(entity_id, kind, record):
+    """Кодирует запись сущности в вид для передачи. Координаты игры не выходят за пределы short, а если значение
+    всё же не помещается в своё поле записи, оно прижимается к границе поля: одна такая сущность не должна
+    ломать рассылку всего состояния"""
+    fields = record_fields(entity_id, kind, record)
+    try:
+        return ENTITY_RECORDS[kind].pack(*fields)
+    except struct.error:
+        return ENTITY_RECORDS[kind].pack(*(min(max(value, low), high)
+                                           for value, (low, high) in zip(fields, FIELD_LIMITS[kind])))
+
+
+def record_fields(entity_id, kind, record):
+    """Значения полей записи сущности в том виде, в котором они упаковываются"""
+    if kind == MOB_KIND:
+        player, mob_type, x, y, state, animation_index, health = record
+        return entity_id, player, MOB_IDS[mob_type], round(x), round(y), MOB_STATE_IDS[state], animation_index, health
+    if kind == TOWER_KIND:
+        tower_type, x, y, animation_index = record
+        return entity_id, TOWER_IDS[tower_type], round(x), round(y), animation_index
+    if kind == BULLET_KIND:
+        bullet_type, x, y, angle, animation_index = record
+        return (entity_id, BULLET_IDS[bullet_type], round(x), round(y), round(angle * ANGLE_SCALE) % ANGLE_STEPS,
+                animation_index)
+    bullet_type, start_x, start_y, end_x, end_y, spawn_tick, speed = record
+    return (entity_id, BULLET_IDS[bullet_type], round(start_x), round(start_y), round(end_x), round(end_y), spawn_tick,
+            round(speed * SPEED_SCALE))
+
+
+def decode_records(kind, data):
+    """Декодирует идущие подряд записи сущностей одного вида. Возвращает список (id, запись)"""
+    records = ENTITY_RECORDS[kind].iter_unpack(data)
+    if kind == MOB_KIND:
+        return [(entity_id, (player, MOBS[mob_type], x, y, MOB_STATES[state], animation_index, health))
+                for entity_id, player, mob_type, x, y, state, animation_index, health in records]
+    if kind == TOWER_KIND:
+        return [(entity_id, (TOWER_TYPES[tower_type], x, y, animation_index))
+                for entity_id, tower_type, x, y, animation_index in records]
+    if kind == BULLET_KIND:
+        return [(entity_id, (BULLET_TYPES[bullet_type], x, y, angle / ANGLE_SCALE, animation_index))
+                for entity_id, bullet_type, x, y, angle, animation_index in records]
+    return [(entity_id, (BULLET_TYPES[bullet_type], start_x, start_y, end_x, end_y, spawn_tick, speed / SPEED_SCALE))
+            for entity_id, bullet_type, start_x, start_y, end_x, end_y, spawn_tick, speed in records]
+
+
+def wire_records(snapshot, previous=None):
+    """Возвращает словарь id -> (вид, закодированная запись) сущностей состояния. Записи кодируются один раз на
+    состояние и сохраняются в нём: состояние служит и новым состоянием, и базой для следующих дельт.
+    Запись, которая досталась состоянию от previous тем же объектом (например, запись летящего снаряда),
+    заново не кодируется"""
+    if snapshot.wire is None:
+        wire = {}
+        previous_entities = previous.entities if previous is not None and previous.wire is not None else {}
+        for entity_id, (kind, record) in snapshot.entities.items():
+            previous_entity = previous_entities.get(entity_id)
+            if previous_entity is not None and previous_entity[1] is record:
+                wire[entity_id] = previous.wire[entity_id]
+                continue
+            try:
+                wire[entity_id] = (kind, encode_record(entity_id, kind, record))
+            except (struct.error, KeyError) as err:
+                raise ProtocolError(f'Entity {entity_id} {record} can not be encoded: {err}')
+        snapshot.wire = wire
+    return snapshot.wire
+
+
+def encode_snapshot(snapshot, base=None, sounds=None):
+    """Кодирует состояние игры в виде дельты относительно base, если base=None - кодируется полное состояние.
+    Неизменившиеся сущности и скаляры не занимают в сообщении ни одного байта. Сущности сравниваются
+    в закодированном виде, поэтому сдвиг меньше, чем на пиксель, не считается изменением.
+    sounds - звуки, которые уходят с состоянием, по умолчанию звуки его тика"""
+    base_records = wire_records(base) if base is not None else {}
+    records = {kind: [] for kind in ENTITY_KINDS}
+    for entity_id, entity in wire_records(snapshot, base).items():
+        if base_records.get(entity_id) != entity:
+            records[entity[0]].append(entity[1])
+    removed = [REMOVED_ENTITY.pack(entity_id) for entity_id in base_records if entity_id not in snapshot.entities]
+    base_scalars = base.scalars if base is not None else (None,) * SCALARS_COUNT
+    scalars_mask = 0
+    scalars = []
+    for i, value in enumerate(snapshot.scalars):
+        if value != base_scalars[i]:
+            scalars_mask |= 1 << i
+            scalars.append(SCALAR.pack(value))
+    try:
+        sounds = bytes(SOUND_IDS[sound] for sound in (snapshot.sounds if sounds is None else sounds))
+    except KeyError as err:
+        raise ProtocolError(f'Unknown sound {err}')
+    header = SNAPSHOT_HEADER.pack(snapshot.tick, base.tick if base is not None else NO_BASE, scalars_mask,
+                                  *(len(records[kind]) for kind in ENTITY_KINDS), len(removed), len(sounds))
+    return b''.join([header] + scalars + [b''.join(records[kind]) for kind in ENTITY_KINDS] + removed + [sounds])
+
+
+def decode_snapshot(body, history):
+    """Декодирует состояние игры, применяя дельту к базовому состоянию из history.
+    Возвращает None, если базового состояния в history нет - тогда клиенту нужно запросить полное состояние"""
+    try:
+        tick, base_tick, scalars_mask, *counts, removed_count, sounds_count = SNAPSHOT_HEADER.unpack_from(body)
+        if base_tick == NO_BASE:
+            entities = {}
+            scalars = [0] * SCALARS_COUNT
+        else:
+            base = history.get(base_tick)
+            if base is None:
+                return None
+            entities = dict(base.entities)
+            scalars = list(base.scalars)
+        offset = SNAPSHOT_HEADER.size
+        for i in range(SCALARS_COUNT):
+            if scalars_mask >> i & 1:
+                scalars[i], = SCALAR.unpack_from(body, offset)
+                offset += SCALAR.size
+        for kind, count in zip(ENTITY_KINDS, counts):
+            size = ENTITY_RECORDS[kind].size * count
+            if offset + size > len(body):
+                raise ProtocolError('Snapshot is truncated')
+            for entity_id, record in decode_records(kind, body[offset:offset + size]):
+                entities[entity_id] = (kind, record)
+            offset += size
+        for _ in range(removed_count):
+            entity_id, = REMOVED_ENTITY.unpack_from(body, offset)
+            offset += REMOVED_ENTITY.size
+            del entities[entity_id]
+        sounds = tuple(SOUND_NAMES[sound] for sound in body[offset:offset + sounds_count])
+        offset += sounds_count
+        if offset != len(body):
+            raise ProtocolError('Snapshot length mismatch')
+        return Snapshot(tick, entities, tuple(scalars), sounds)
+    except (struct.error, IndexError, KeyError) as err:
+        raise ProtocolError(f'Malformed snapshot: {err}')
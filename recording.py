@@ -0,0 +1,177 @@
+import mmap
+import struct
+from bisect import bisect_right
+from threading import Lock
+from constants import FPS
+from exceptions import ProtocolError
+from protocol import (HEADER, SNAPSHOT, SNAPSHOT_HEADER, NO_BASE, pack_message, unpack_header, encode_snapshot,
+                      decode_snapshot)
+from snapshots import SnapshotHistory
+
+
+# В этом файле находится запись матча: сервер сохраняет состояния игры, которые рассылает клиентам комнаты,
+# а клиент (online_game.py) показывает запись без повторного прогона игры, так что просмотр стоит только чтения файла.
+# Файл записи:
+#   заголовок RECORDING_HEADER;
+#   сообщения SNAPSHOT в том же виде, в каком они уходят клиентам (protocol.py): полное состояние раз в
+#   KEYFRAME_INTERVAL тиков, между ними - дельты относительно предыдущего записанного состояния;
+#   индекс: тик и смещение каждого полного состояния, чтобы можно было перейти к любому тику;
+#   RECORDING_TRAILER со смещением индекса. Если сервер упал и индекса нет, он восстанавливается чтением записи
+
+RECORDING_SUFFIX = '.rec'
+RECORDING_MAGIC = b'TDRC'
+RECORDING_VERSION = 3
+RECORDING_HEADER = struct.Struct('!4sBH')  # сигнатура, версия формата записи, тиков в секунду
+INDEX_ENTRY = struct.Struct('!IQ')  # тик и смещение полного состояния
+RECORDING_TRAILER = struct.Struct('!QII4s')  # смещение индекса, число записей индекса, последний тик, сигнатура
+KEYFRAME_INTERVAL = FPS * 2  # как часто в записи сохраняется полное состояние, тиков
+
+
+class SnapshotRecorder:
+    """Пишет состояния игры одной комнаты в файл записи. Состояния записывает игровой цикл, а закрывает запись
+    поток клиента, поэтому запись и закрытие защищены блокировкой"""
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'wb')
+        self.lock = Lock()
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, FPS))
+        self.offset = RECORDING_HEADER.size
+        self.index = []  # (тик, смещение) полных состояний
+        self.previous = None  # последнее записанное состояние
+        self.last_keyframe_tick = None
+
+    def record(self, snapshot, history):
+        """Записывает состояние snapshot со звуками всех тиков после прошлого записанного состояния из history"""
+        with self.lock:
+            if self.file is None:
+                return
+            base = self.previous
+            sounds_after = base.tick if base is not None else None
+            if base is None or snapshot.tick - self.last_keyframe_tick >= self.keyframe_interval:
+                base = None
+                self.last_keyframe_tick = snapshot.tick
+                self.index.append((snapshot.tick, self.offset))
+            base_tick = base.tick if base is not None else None
+            # Сообщение могло быть уже закодировано для клиентов с тем же подтверждённым и последним отправленным
+            # тиком (см. get_data_to_send)
+            key = (base_tick, sounds_after)
+            data = snapshot.encoded.get(key)
+            if data is None:
+                sounds = history.sounds_between(sounds_after, snapshot.tick)
+                data = snapshot.encoded[key] = pack_message(SNAPSHOT, encode_snapshot(snapshot, base, sounds))
+            self.file.write(data)
+            self.offset += len(data)
+            self.previous = snapshot
+
+    def close(self):
+        """Дописывает индекс и закрывает запись"""
+        with self.lock:
+            if self.file is None:
+                return
+            for tick, offset in self.index:
+                self.file.write(INDEX_ENTRY.pack(tick, offset))
+            last_tick = self.previous.tick if self.previous is not None else 0
+            self.file.write(RECORDING_TRAILER.pack(self.offset, len(self.index), last_tick, RECORDING_MAGIC))
+            self.file.close()
+            self.file = None
+
+
+class SnapshotRecording:
+    """Запись матча, открытая для просмотра. Файл отображается в память, состояния декодируются по мере просмотра"""
+    def __init__(self, path):
+        with open(path, 'rb') as recording_file:
+            self.data = mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < RECORDING_HEADER.size:
+            raise ProtocolError('Recording is empty')
+        magic, version, self.tick_rate = RECORDING_HEADER.unpack_from(self.data)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ProtocolError(f'Unsupported recording format {magic} {version}')
+        if not self.load_index():
+            self.rebuild_index()
+        if not self.keyframe_ticks:
+            raise ProtocolError('Recording has no snapshots')
+        self.first_tick = self.keyframe_ticks[0]
+        self.history = SnapshotHistory()
+        self.snapshot = None  # текущее показываемое состояние
+        self.offset = None  # смещение следующего сообщения записи
+        self.seek(self.first_tick)
+
+    def load_index(self):
+        """Читает индекс в конце записи. Возвращает False, если индекса нет"""
+        if len(self.data) < RECORDING_HEADER.size + RECORDING_TRAILER.size:
+            return False
+        trailer_offset = len(self.data) - RECORDING_TRAILER.size
+        index_offset, count, last_tick, magic = RECORDING_TRAILER.unpack_from(self.data, trailer_offset)
+        if magic != RECORDING_MAGIC or index_offset + count * INDEX_ENTRY.size != trailer_offset:
+            return False
+        index = [INDEX_ENTRY.unpack_from(self.data, index_offset + i * INDEX_ENTRY.size) for i in range(count)]
+        self.keyframe_ticks = [tick for tick, _ in index]
+        self.keyframe_offsets = [offset for _, offset in index]
+        self.end = index_offset  # конец сообщений записи
+        self.last_tick = last_tick
+        return True
+
+    def rebuild_index(self):
+        """Восстанавливает индекс недописанной записи, просматривая заголовки всех сообщений.
+        Недописанное последнее сообщение отбрасывается"""
+        self.keyframe_ticks, self.keyframe_offsets = [], []
+        self.last_tick = 0
+        offset = RECORDING_HEADER.size
+        while offset + HEADER.size <= len(self.data):
+            length, _ = unpack_header(self.data[offset:offset + HEADER.size])
+            body_offset = offset + HEADER.size
+            if body_offset + length > len(self.data) or length < SNAPSHOT_HEADER.size:
+                break
+            tick, base_tick = SNAPSHOT_HEADER.unpack_from(self.data, body_offset)[:2]
+            if base_tick == NO_BASE:
+                self.keyframe_ticks.append(tick)
+                self.keyframe_offsets.append(offset)
+            self.last_tick = tick
+            offset = body_offset + length
+        self.end = offset
+
+    def peek_tick(self):
+        """Тик следующего сообщения записи или None, если запись закончилась"""
+        if self.offset >= self.end:
+            return None
+        return SNAPSHOT_HEADER.unpack_from(self.data, self.offset + HEADER.size)[0]
+
+    def read_next(self):
+        """Декодирует следующее сообщение записи и делает его текущим состоянием"""
+        length, message_type = unpack_header(self.data[self.offset:self.offset + HEADER.size])
+        body_offset = self.offset + HEADER.size
+        if message_type != SNAPSHOT:
+            raise ProtocolError(f'Unexpected message type {message_type} in the recording')
+        snapshot = decode_snapshot(self.data[body_offset:body_offset + length], self.history)
+        if snapshot is None:
+            raise ProtocolError(f'Recording is broken before tick {self.peek_tick()}')
+        self.offset = body_offset + length
+        self.history.add(snapshot)
+        self.snapshot = snapshot
+        return snapshot
+
+    def advance(self, tick):
+        """Переходит вперёд к последнему записанному состоянию с тиком не больше tick.
+        Возвращает звуки всех пройденных состояний"""
+        sounds = []
+        while True:
+            next_tick = self.peek_tick()
+            if next_tick is None or next_tick > tick:
+                return sounds
+            sounds.extend(self.read_next().sounds)
+
+    def seek(self, tick):
+        """Переходит к последнему записанному состоянию с тиком не больше tick, начиная с ближайшего полного"""
+        tick = min(max(tick, self.first_tick), self.last_tick)
+        if self.snapshot is None or not self.snapshot.tick <= tick or \
+                bisect_right(self.keyframe_ticks, tick) != bisect_right(self.keyframe_ticks, self.snapshot.tick):
+            # Вперёд в пределах одного полного состояния идём по дельтам, иначе - с ближайшего полного состояния
+            self.history = SnapshotHistory()
+            self.offset = self.keyframe_offsets[bisect_right(self.keyframe_ticks, tick) - 1]
+            self.read_next()
+        self.advance(tick)
+        return self.snapshot
+
+    def close(self):
+        self.data.close()
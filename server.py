@@ -1,47 +1,184 @@
 import socket
 import sys
+import signal
 import os
-import time
-import json
 import math
 import random
 import pickle
-from threading import Thread
+import asyncio
+import argparse
+from threading import Thread, Lock
+from itertools import count
+from operator import attrgetter
 from constants import *
-from utils import opponent, load_ways, calculate_distance_between_points
+from utils import opponent, load_ways, calculate_distance_between_points, is_alive
+from tick_scheduler import TickScheduler
+from timer_wheel import TimerWheel
+from action_queue import ActionQueue
+from broadcast import SnapshotSender, AsyncSnapshotSender
+from spatial import SpatialGrid
+from mob_templates import get_mob_template
+from exceptions import ProtocolError
+from protocol import *
+from tick_profiler import TickProfiler, format_rooms_report
+from metrics import start_metrics_server, collect_lobby_metrics, METRICS_PORT
+from input_log import InputLog, room_file_path, INPUT_LOG_SUFFIX
+from recording import SnapshotRecorder, RECORDING_SUFFIX
 
 
 SERVER = '0.0.0.0'
 PORT = 4444
+BACKLOG = 128  # максимальная длина очереди ожидающих подключений
+SKIRMISH_DISTANCE = 100  # на каком расстоянии друг от друга мобы противников вступают в бой
+MAX_SWING_TICKS = 256  # насколько вперёд моб ищет тик удара, тиков (см. Mob.schedule_hit)
 P_2_WAYS = load_ways(os.path.join('maps', 'online_game_map'))
 # Пути левого игрока - это "перевёрнутые" пути правого игрока:
-P_1_WAYS = [[ways[::-1] for ways in road] for road in P_2_WAYS]
+P_1_WAYS = [[way.reversed() for way in road] for road in P_2_WAYS]
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-try:
-    s.bind((SERVER, PORT))
-except socket.error:
-    print('Socket error')
-    sys.exit(1)
+def create_server_socket(host=SERVER, port=PORT):
+    """Создаёт слушающий сокет для многопоточного сервера"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind((host, port))
+    except socket.error:
+        print('Socket error')
+        sys.exit(1)
+    s.listen(BACKLOG)
+    print('Waiting for connection')
+    return s
+
+
+def close_connection(connection):
+    """Закрывает соединение игрока - сокет или asyncio.StreamWriter. Сокет сначала выключается: close из чужого
+    потока не прерывает recv, в котором поток клиента ждёт сообщений, и соединение осталось бы открытым навсегда"""
+    if isinstance(connection, socket.socket):
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    connection.close()
+
+
+class RoomRegistry:
+    """Открытые комнаты по номерам. Комнату можно добавить и убрать за O(1), а ожидающая второго игрока комната
+    хранится отдельно. Комнаты убирают потоки клиентов, а читает поток метрик, поэтому реестр защищён блокировкой"""
+    def __init__(self):
+        self.rooms = {}
+        self.waiting_room = None
+        self.lock = Lock()
+        self.reclaimed = 0  # сколько комнат закрыто за время работы сервера
+
+    def add(self, room):
+        with self.lock:
+            self.rooms[room.number] = room
+            self.waiting_room = room
+
+    def take_waiting_room(self):
+        """Возвращает комнату, ожидающую второго игрока, или None. Комната перестаёт считаться ожидающей"""
+        with self.lock:
+            room, self.waiting_room = self.waiting_room, None
+        return room
+
+    def remove(self, room):
+        with self.lock:
+            if self.rooms.pop(room.number, None) is not None:
+                self.reclaimed += 1
+            if self.waiting_room is room:
+                self.waiting_room = None
+
+    def list(self):
+        with self.lock:
+            return list(self.rooms.values())
 
-s.listen(6)
-print('Waiting for connection')
+    def __len__(self):
+        return len(self.rooms)
 
 
 class Room:
     """Игровое лобби на двух игроков"""
-    def __init__(self, player_1_connection, rooms):
+    def __init__(self, player_1_connection, rooms, scheduler, protocol=FRAMED, send_rate=SEND_RATE, game_class=None,
+                 number=0, input_log_dir=None, record_dir=None):
         self.player_1 = (PLAYER_1, player_1_connection)
-        self.rooms = rooms
+        self.number = number  # номер комнаты в отчётах и метриках сервера
+        self.input_log_dir = input_log_dir  # папка для журналов действий игроков (см. input_log.py)
+        self.record_dir = record_dir  # папка для записей матчей (см. recording.py)
+        self.recorder = None
+        self.rooms = rooms  # реестр комнат сервера
+        self.scheduler = scheduler  # планировщик, выполняющий тики всех комнат сервера
         self.player_2 = None
-        self.game = OnlineGame()
+        self.state = WAITING_ROOM
+        self.lock = Lock()  # смена состояния: комнату закрывают потоки обоих клиентов, а завершает игровой цикл
+        self.game = (game_class or OnlineGame)(protocol)  # game_class - другой движок игры, например из numpy_engine.py
+        self.tick_clock = None  # игровые часы комнаты, появляются после начала игры
+        self.send_interval = max(round(FPS / send_rate), 1)  # раз во сколько тиков игрокам рассылается состояние игры
+        self.senders = []  # отправители состояния игры клиентам комнаты (только для протокола с заголовками)
 
     def add_player(self, player_2_connection):
-        self.player_2 = (PLAYER_2, player_2_connection)
+        """Сажает второго игрока и начинает игру. Возвращает False, если первый игрок уже успел уйти"""
+        with self.lock:
+            if self.state != WAITING_ROOM:
+                return False
+            self.player_2 = (PLAYER_2, player_2_connection)
+            self.state = RUNNING_ROOM
+            self.start_game()
+        return True
 
     def start_game(self):
-        Thread(target=self.game.start_mainloop).start()
+        if self.input_log_dir is not None:
+            self.game.input_log = InputLog(room_file_path(self.input_log_dir, self.number, INPUT_LOG_SUFFIX),
+                                           self.game.seed)
+        if self.record_dir is not None:
+            self.recorder = SnapshotRecorder(room_file_path(self.record_dir, self.number, RECORDING_SUFFIX))
+        # Если тик комнаты упадёт, комната закрывается: игроки отключаются, а не смотрят на замершую игру
+        self.tick_clock = self.scheduler.add(self, on_error=self.close)
+
+    def update(self):
+        """Тик комнаты: обновляет игру и с заданной частотой рассылает её состояние игрокам.
+        Когда падает главная башня, игроки получают последнее состояние, а тики комнаты останавливаются"""
+        if self.state != RUNNING_ROOM:
+            return  # планировщик мог взять комнату в работу до того, как её остановили
+        if self.game.update() and self.game.profiler.should_warn():
+            profiler = self.game.profiler
+            print(f'Tick {self.game.tick} is over budget: {profiler.describe_last_tick()}, '
+                  f'{profiler.over_budget} slow ticks in this room')
+        game_over = self.game.is_over()
+        if self.game.tick % self.send_interval == 0 or game_over:
+            for sender in self.senders:
+                sender.notify()
+            if self.recorder is not None:
+                self.recorder.record(self.game.snapshot, self.game.snapshots)
+        if game_over:
+            self.finish()
+
+    def finish(self):
+        """Останавливает тики комнаты после конца игры и закрывает журнал и запись матча"""
+        with self.lock:
+            if self.state != RUNNING_ROOM:
+                return
+            self.state = FINISHED_ROOM
+        self.scheduler.remove(self)
+        self.close_files()
+        print(f'Room {self.number} finished on tick {self.game.tick}')
+
+    def close_files(self):
+        try:
+            if self.game.input_log is not None:
+                self.game.input_log.close(self.game.snapshot)
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+    def add_sender(self, sender):
+        """Добавляет отправителя состояния игры клиенту комнаты. Если комната уже закончилась или закрыта,
+        отправитель сразу закрывается - иначе его поток или задачу никто бы не остановил - и возвращается False"""
+        with self.lock:
+            if self.state in (WAITING_ROOM, RUNNING_ROOM):
+                self.senders.append(sender)
+                return True
+        sender.close()
+        return False
 
     def is_full(self):
         if self.player_2 is not None:
@@ -49,34 +186,104 @@ class Room:
         return False
 
     def close(self):
-        if self.player_1 is not None:
-            self.player_1[1].close()
-            self.player_1 = None
-            print('player 1 disconnected successfully')
-        if self.player_2 is not None:
-            self.player_2[1].close()
-            self.player_2 = None
-            print('player 2 disconnected successfully')
-        if self in self.rooms:
+        """Закрывает комнату, когда её покидает игрок: отключает обоих игроков и убирает комнату из реестра"""
+        with self.lock:
+            if self.state == RECLAIMED_ROOM:
+                return
+            self.state = RECLAIMED_ROOM
+        try:
+            if self.player_1 is not None:
+                close_connection(self.player_1[1])
+                self.player_1 = None
+                print('player 1 disconnected successfully')
+            if self.player_2 is not None:
+                close_connection(self.player_2[1])
+                self.player_2 = None
+                print('player 2 disconnected successfully')
+            for sender in self.senders:
+                sender.close()
+            self.senders.clear()
+            self.scheduler.remove(self)
+            self.close_files()
+        finally:
+            # Комната уходит из реестра, даже если что-то из её ресурсов не удалось закрыть
             self.rooms.remove(self)
 
 
-def clients_accepting():
+class Lobby:
+    """Комнаты сервера (или одного процесса-обработчика, см. workers.py). Новый клиент попадает в комнату,
+    ожидающую второго игрока, а если такой нет - для него создаётся новая комната"""
+    def __init__(self, scheduler, protocol=FRAMED, send_rate=SEND_RATE, game_class=None, input_log_dir=None,
+                 record_dir=None):
+        self.rooms = RoomRegistry()
+        self.scheduler = scheduler  # планировщик, выполняющий тики всех комнат
+        self.protocol = protocol
+        self.send_rate = send_rate
+        self.game_class = game_class
+        self.input_log_dir = input_log_dir
+        self.record_dir = record_dir
+        self.room_numbers = count(1)
+
+    def join(self, connection):
+        """Возвращает комнату и номер игрока для подключившегося клиента"""
+        room = self.rooms.take_waiting_room()
+        if room is not None and room.add_player(connection):
+            return room, PLAYER_2
+        room = Room(connection, self.rooms, self.scheduler, self.protocol, self.send_rate, self.game_class,
+                    next(self.room_numbers), self.input_log_dir, self.record_dir)
+        self.rooms.add(room)
+        return room, PLAYER_1
+
+    def players_count(self):
+        return sum((room.player_1 is not None) + (room.player_2 is not None) for room in self.rooms.list())
+
+    def is_waiting(self):
+        """Есть ли комната, ожидающая второго игрока"""
+        room = self.rooms.waiting_room
+        return room is not None and room.state == WAITING_ROOM
+
+    def print_tick_report(self):
+        """Выводит процентили времени фаз тика по всем комнатам (по сигналу SIGUSR1: kill -USR1 <pid сервера>)"""
+        print(f'Tick report of process {os.getpid()}:')
+        for line in format_rooms_report(self.rooms.list()):
+            print(line)
+
+
+def handle_report_signal(handler, loop=None):
+    """Вызывает handler по сигналу SIGUSR1 (в цикле событий loop, если он задан). На платформах без SIGUSR1,
+    например в Windows, сигнал не регистрируется - отчёт о тиках тогда недоступен"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    if loop is not None:
+        loop.add_signal_handler(signal.SIGUSR1, handler)
+    else:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: handler())
+
+
+def clients_accepting(s, protocol=FRAMED, send_rate=SEND_RATE, game_class=None, metrics_port=0, input_log_dir=None,
+                      record_dir=None):
     """Функция для приёма клиентов.
-    Выполняется в отдельном потоке, после подключения клиента запускает client_processing"""
-    rooms = []
+    Выполняется в отдельном потоке, после подключения клиента запускает client_processing.
+    Если metrics_port не 0, на этом порту локального адреса отдаются метрики сервера (см. metrics.py).
+    Если задана папка input_log_dir, каждая комната ведёт в ней журнал действий игроков (см. input_log.py),
+    если задана папка record_dir - записывает в неё рассылаемые состояния игры (см. recording.py)"""
+    scheduler = TickScheduler()
+    Thread(target=scheduler.run, daemon=True).start()
+    lobby = Lobby(scheduler, protocol, send_rate, game_class, input_log_dir, record_dir)
+    if metrics_port:
+        start_metrics_server(lambda writer: collect_lobby_metrics(lobby, writer), metrics_port)
+    handle_report_signal(lobby.print_tick_report)
     while True:
         conn, addr = s.accept()
         print(f'Connected to {addr}')
-        if rooms and not rooms[-1].is_full() == 1:
-            room = rooms[-1]
-            room.add_player(conn)
-            Thread(target=client_processing, args=[conn, PLAYER_2, room]).start()
-            room.start_game()
-        else:
-            room = Room(conn, rooms)
-            rooms.append(room)
-            Thread(target=client_processing, args=[conn, PLAYER_1, room]).start()
+        start_client_processing(conn, lobby)
+
+
+def start_client_processing(conn, lobby):
+    """Сажает клиента в комнату и запускает поток, который его обслуживает"""
+    processing = framed_client_processing if lobby.protocol == FRAMED else client_processing
+    room, player = lobby.join(conn)
+    Thread(target=processing, args=[conn, player, room]).start()
 
 
 def client_processing(conn, player, room):
@@ -108,6 +315,144 @@ def client_processing(conn, player, room):
         room.close()
 
 
+def framed_client_processing(conn, player, room):
+    """Аналог client_processing для протокола с заголовками сообщений (см. protocol.py).
+    Этот поток только принимает сообщения клиента, состояние игры комната рассылает сама (см. broadcast.py)"""
+    game = room.game
+    try:
+        send_message(conn, HELLO, encode_hello(player))
+        sender = SnapshotSender(conn, game, player)
+        if not room.add_sender(sender):
+            raise ConnectionAbortedError('Room is already closed')
+        sender.notify()  # клиент сразу узнаёт, идёт ли игра или он ждёт второго игрока
+        while True:
+            message_type, body = recv_message(conn)
+            if message_type == ACTION:
+                data = body.decode().split()
+                if len(data) > 1:
+                    game.get_player_action(player, data[0], data[1:])
+            elif message_type == ACK:
+                sender.stream.ack(decode_ack(body))
+            elif message_type == KEYFRAME_REQUEST:
+                sender.stream.request_keyframe()
+                sender.notify()
+            elif message_type == REQUEST:
+                sender.notify()
+            elif message_type == PING:
+                decode_ping(body)
+                sender.reply(pack_message(PONG, body))
+            else:
+                raise ProtocolError(f'Unexpected message type {message_type}')
+    except EOFError:
+        print('disconnected')
+    except Exception as err:
+        print('Error:', err)
+    print('connection is lost')
+    conn.close()
+    room.close()
+
+
+async def async_clients_accepting(host=SERVER, port=PORT, protocol=FRAMED, send_rate=SEND_RATE, game_class=None,
+                                  metrics_port=0, input_log_dir=None, record_dir=None):
+    """Асинхронный аналог clients_accepting.
+    Приём клиентов, обслуживание всех клиентов и игровые циклы всех комнат выполняются
+    в одном потоке, в общем цикле событий asyncio. Протокол обмена данными с клиентом не меняется"""
+    scheduler = TickScheduler()
+    scheduler_task = asyncio.create_task(scheduler.run_async())
+    lobby = Lobby(scheduler, protocol, send_rate, game_class, input_log_dir, record_dir)
+    handle_report_signal(lobby.print_tick_report, asyncio.get_running_loop())
+    if metrics_port:
+        start_metrics_server(lambda writer: collect_lobby_metrics(lobby, writer), metrics_port)
+
+    async def on_connect(reader, writer):
+        print(f'Connected to {writer.get_extra_info("peername")}')
+        await async_client_joining(reader, writer, lobby)
+
+    server = await asyncio.start_server(on_connect, host, port, backlog=BACKLOG, reuse_address=True)
+    print('Waiting for connection')
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            scheduler.stop()
+            await scheduler_task
+
+
+async def async_client_joining(reader, writer, lobby, on_joined=None):
+    """Асинхронный аналог start_client_processing: сажает клиента в комнату и обслуживает его.
+    on_joined вызывается, как только клиент сел в комнату"""
+    processing = async_framed_client_processing if lobby.protocol == FRAMED else async_client_processing
+    room, player = lobby.join(writer)
+    if on_joined is not None:
+        on_joined()
+    await processing(reader, writer, player, room)
+
+
+async def async_client_processing(reader, writer, player, room):
+    """Асинхронный аналог client_processing: обслуживает одного клиента в виде сопрограммы"""
+    game = room.game
+    try:
+        writer.write(pickle.dumps(player))
+        await writer.drain()
+        while True:
+            data = (await reader.read(1024)).decode().split()
+            if not data:
+                print('disconnected')
+                break
+            elif len(data) > 1:
+                game.get_player_action(player, data[0], data[1:])
+            writer.write(game.data_to_send)
+            await writer.drain()
+    except Exception as err:
+        print('Error:', err)
+    print('connection is lost')
+    writer.close()
+    room.close()
+
+
+async def async_framed_client_processing(reader, writer, player, room):
+    """Асинхронный аналог framed_client_processing"""
+    game = room.game
+    try:
+        writer.write(pack_message(HELLO, encode_hello(player)))
+        await writer.drain()
+        sender = AsyncSnapshotSender(writer, game, player)
+        if not room.add_sender(sender):
+            raise ConnectionAbortedError('Room is already closed')
+        sender.notify()
+        while True:
+            message_type, body = await read_message(reader)
+            if message_type == ACTION:
+                data = body.decode().split()
+                if len(data) > 1:
+                    game.get_player_action(player, data[0], data[1:])
+            elif message_type == ACK:
+                sender.stream.ack(decode_ack(body))
+            elif message_type == KEYFRAME_REQUEST:
+                sender.stream.request_keyframe()
+                sender.notify()
+            elif message_type == REQUEST:
+                sender.notify()
+            elif message_type == PING:
+                decode_ping(body)
+                sender.reply(pack_message(PONG, body))
+            else:
+                raise ProtocolError(f'Unexpected message type {message_type}')
+    except asyncio.IncompleteReadError:
+        print('disconnected')
+    except Exception as err:
+        print('Error:', err)
+    print('connection is lost')
+    writer.close()
+    room.close()
+
+
+def check_on_map(x, y):
+    """Вызывает ValueError, если точка x;y из действия игрока лежит за пределами карты"""
+    if not (0 <= x <= WIDTH and 0 <= y <= HEIGHT):
+        raise ValueError(f'Point {x};{y} is off the map')
+
+
 def let_mobs_fight(mob1, mob2):
     """Ставит двух мобов друг напротив друга и заставляет их атаковать друг друга"""
     # Ставим мобов друг напротив друга:
@@ -125,8 +470,15 @@ def let_mobs_fight(mob1, mob2):
 
 
 class Mob:
-    def __init__(self, player, type, road_index, coords, opponent_main_tower, game_sounds_query):
+    id = None  # постоянный id в рассылаемом клиентам состоянии игры, выдаётся в OnlineGame.update_sending_data
+    order = None  # порядковый номер моба в игре, выдаётся в OnlineGame.handle_player_action
+
+    def __init__(self, player, type, road_index, coords, opponent_main_tower, game_sounds_query, hit_timers,
+                 rng=random):
         self.player = player
+        self.random = rng  # генератор случайных чисел игры
+        self.hit_timers = hit_timers  # колесо таймеров, на котором стоят удары мобов
+        self.hit_tick = None  # тик следующего удара в состоянии attack
         self.type = type
         self.road = road_index
         self.coords = list(coords)
@@ -135,6 +487,7 @@ class Mob:
         self.way = self.define_way()
         self.pos = 0  # индекс проходимой точки в маршруте моба
         self.load_info(self.type)
+        self.steps_table = self.way.get_steps_table(self.velocity)  # шаги моба по каждому отрезку маршрута
         self.set_state('move')
         self.steps_to_next_point = 0  # сколько шагов осталось пройти до следующей точки маршрута
         self.tagged = False
@@ -145,8 +498,8 @@ class Mob:
         # координаты моба перед боем, чтобы после окончания схватки вернуть его на место
 
     def define_way(self):
-        # Случайно определяется путь моба:
-        way = (P_1_WAYS if self.player == PLAYER_1 else P_2_WAYS)[self.road][random.randint(0, 1)]
+        # Случайно определяется путь моба. У каждой игры свой генератор случайных чисел, чтобы матч можно повторить:
+        way = (P_1_WAYS if self.player == PLAYER_1 else P_2_WAYS)[self.road][self.random.randint(0, 1)]
         # Далее определяется точка, с которой начинается путь:
         if self.player == 1:
             direction = 1
@@ -154,26 +507,27 @@ class Mob:
             direction = -1
         for index, point in enumerate(way):
             if (point[0] - self.coords[0]) * direction > 100:
-                return tuple([self.coords] + list(way[index:]))
+                return way.starting_at(self.coords, index)
 
     def load_info(self, type):
-        """Загружает параметры моба из json файла"""
-        with open(os.path.join('mobs', type, 'info.json'), 'r', encoding='utf-8') as info_file:
-            self.info = json.load(info_file)
-        self.velocity = self.info['velocity'] / FPS
-        self.health = self.max_health = self.info['health']
-        self.damage = self.info['damage']
-        self.cost = self.info['cost']
+        """Берёт параметры моба из общего реестра шаблонов мобов (см. mob_templates.py)"""
+        self.template = get_mob_template(type)
+        self.velocity = self.template.velocity
+        self.health = self.max_health = self.template.health
+        self.damage = self.template.damage
+        self.cost = self.template.cost
 
     def set_state(self, state):
         """В разных состояниях моб(спрайт моба) разного размера,
         поэтому при смене состояния моба приходится менять и некоторые другие параметры"""
         self.state = state
-        self.half_width = self.info[self.state]['width'] / 2
-        self.half_height = self.info[self.state]['height'] / 2
-        self.animation_speed = self.info[state]['animation_speed']
-        self.animation_length = self.info[state]['animation_length']
+        state_template = self.template.states[state]
+        self.half_width = state_template.half_width
+        self.half_height = state_template.half_height
+        self.animation_speed = state_template.animation_speed
+        self.animation_length = state_template.animation_length
         self.animation_index = 0.
+        self.hit_tick = None
 
     def set_coords(self, x, y):
         """Вызывается перед схваткой моба с другим мобом и нужна чтобы поставить их друг перед другом"""
@@ -189,29 +543,7 @@ class Mob:
 
     def get_position(self, delta_steps):
         """Возвращает координату, в которой окажется моб через заданное количество шагов"""
-        index = self.pos
-        steps = self.steps_to_next_point
-        way_len = len(self.way)
-        # Будет просчитываться движение моба до тех пор, пока он не пройдёт нужное количество шагов
-        while index < way_len - 1:
-            if steps < delta_steps:
-                delta_steps -= steps
-            else:
-                if index > self.pos:
-                    way_point_1 = self.way[index - 1]
-                else:
-                    way_point_1 = self.coords
-                way_point_2 = self.way[index]
-                d_x, d_y = way_point_2[0] - way_point_1[0], way_point_2[1] - way_point_1[1]
-                return (way_point_1[0] + d_x / steps * delta_steps,
-                        way_point_1[1] + d_y / steps * delta_steps)
-            start_point = self.way[index]
-            index += 1
-            next_point = self.way[index]
-            d_x, d_y = next_point[0] - start_point[0], next_point[1] - start_point[1]
-            steps = math.hypot(d_x, d_y) / self.velocity
-        else:
-            return self.way[-1]
+        return self.way.get_position(self.pos, self.coords, self.steps_to_next_point, self.velocity, delta_steps)
 
     def update(self):
         self.animation_index = (self.animation_index + self.animation_speed) % self.animation_length
@@ -221,31 +553,16 @@ class Mob:
             # Совершается перемещение(шаг)
             try:
                 if self.steps_to_next_point <= 0:
-                    start_point = self.way[self.pos]
-                    self.pos += 1
-                    next_point = self.way[self.pos]
-                    d_x, d_y = next_point[0] - start_point[0], next_point[1] - start_point[1]
-                    self.steps_to_next_point = math.hypot(d_x, d_y) // self.velocity
-                    if self.steps_to_next_point == 0:
-                        self.steps_to_next_point = 1
-                    self.x_velocity = d_x / self.steps_to_next_point
-                    self.y_velocity = d_y / self.steps_to_next_point
+                    # Переходим на следующий отрезок маршрута, шаги по нему посчитаны заранее.
+                    # В конце маршрута таблица шагов заканчивается и возникает IndexError
+                    self.pos = min(self.pos + 1, len(self.way))
+                    self.steps_to_next_point, self.x_velocity, self.y_velocity = self.steps_table[self.pos - 1]
                 self.steps_to_next_point -= 1
                 self.coords[0] += self.x_velocity
                 self.coords[1] += self.y_velocity
             except IndexError:
                 self.attack(self.opponent_main_tower)
-        elif self.state == 'attack':
-            # Если проигрывается последний кадр анимации атаки, то цели наносится урон:
-            if int(self.animation_index) == self.animation_length - 1:
-                self.target.hit(self.damage)
-                self.game_sounds_query.append('mob_hit')
-                # Если цель умерла, то двигаемся дальше:
-                if self.target.health <= 0:
-                    self.target = None
-                    self.set_state('move')
-                    if self.pre_fight_coords is not None:
-                        self.coords = self.pre_fight_coords  # ставим моба туда где он был перед боем
+        # Удары в состоянии attack наносит OnlineGame на тиках, поставленных в колесо таймеров (см. schedule_hit)
         elif self.state == 'death' and round(self.animation_index) == self.animation_length:
             self.state = 'killed'
 
@@ -253,16 +570,49 @@ class Mob:
         if self.state != 'attack':
             self.target = target
             self.set_state('attack')
+            self.schedule_hit()
+
+    def schedule_hit(self):
+        """Ставит в колесо таймеров тик, на котором анимация атаки дойдёт до последнего кадра. Кадры считаются
+        теми же сложениями, что и в update, поэтому тик удара совпадает с тиком, на котором update увидел бы
+        последний кадр. Если за MAX_SWING_TICKS тиков последнего кадра нет, на этот тик ставится проверка"""
+        index = self.animation_index
+        for delay in range(1, MAX_SWING_TICKS + 1):
+            index = (index + self.animation_speed) % self.animation_length
+            if int(index) == self.animation_length - 1:
+                break
+        self.hit_tick = self.hit_timers.tick + delay
+        self.hit_timers.schedule(self.hit_tick, self)
+
+    def strike(self):
+        """Вызывается на тике, поставленном schedule_hit. Если проигрывается последний кадр анимации атаки,
+        то цели наносится урон"""
+        self.hit_tick = None
+        if int(self.animation_index) != self.animation_length - 1:
+            self.schedule_hit()
+            return
+        self.target.hit(self.damage)
+        self.game_sounds_query.append('mob_hit')
+        # Если цель умерла, то двигаемся дальше:
+        if self.target.health <= 0:
+            self.target = None
+            self.set_state('move')
+            if self.pre_fight_coords is not None:
+                self.coords = self.pre_fight_coords  # ставим моба туда где он был перед боем
+        else:
+            self.schedule_hit()
 
     def hit(self, damage):
         self.health -= damage
 
     def get_data(self):
         """Возвращает всю информацию о мобе для отправки клиенту"""
-        return self.player, self.type, self.get_current_coords(), self.state, int(self.animation_index), self.health
+        return self.player, self.type, *self.get_current_coords(), self.state, int(self.animation_index), self.health
 
 
 class BowTower:
+    id = None  # постоянный id в рассылаемом клиентам состоянии игры, выдаётся в OnlineGame.update_sending_data
+    order = None  # место башни в порядке обновления башен, выдаётся в OnlineGame.place_tower
     cost = 50
     time_to_reload = 100
     shooting_range = 600
@@ -271,37 +621,36 @@ class BowTower:
     x_bias = 125
     y_bias = -25
 
-    def __init__(self, player, coords, mobs, bullets, game_sounds_query):
+    def __init__(self, player, coords, mob_grids, bullets, game_sounds_query):
         self.player = player
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.mobs = mobs
+        self.mob_grids = mob_grids  # сетки с мобами обоих игроков, по которым башня ищет цель
         self.bullets = bullets
         self.game_sounds_query = game_sounds_query  # очередь звуков, отсылаемых клиентам
-        self.reloading = 0  # сколько времени осталось до выстрела(сек/60)
+        self.wake_tick = None  # тик, на котором закончится перезарядка, None - башня заряжена
 
     def get_coords(self):
         """Возвращает координаты левого верхнего угла башни для отправки клиенту"""
         return self.coords[0] - self.x_bias, self.coords[1] + self.y_bias
 
     def update(self):
-        if not self.reloading:
-            for mob in self.mobs[opponent(self.player)]:
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        self.bullets.append(Bullet(self.coords, self.damage, 'arrow', 600, mob, distance))
-                        self.game_sounds_query.append('bow_shot')
-                        self.reloading = self.time_to_reload
-                        return
-        else:
-            self.reloading -= 1
+        """Ищет цель и стреляет в неё. Вызывается только у заряженной башни (перезарядку отсчитывает
+        OnlineGame.update_towers), возвращает True, если башня выстрелила"""
+        mob, distance = self.mob_grids[opponent(self.player)].first_within(self.coords, self.shooting_range, is_alive)
+        if mob is None:
+            return False
+        self.bullets.append(Bullet(self.coords, self.damage, 'arrow', 600, mob, distance))
+        self.game_sounds_query.append('bow_shot')
+        return True
 
     def get_data(self):
         """Возвращает всю информацию о башне для отправки клиенту"""
-        return 'bow', self.get_coords(), int(self.animation_index)
+        return 'bow', *self.get_coords(), int(self.animation_index)
 
 
 class CannonTower:
+    id = None  # постоянный id в рассылаемом клиентам состоянии игры, выдаётся в OnlineGame.update_sending_data
+    order = None  # место башни в порядке обновления башен, выдаётся в OnlineGame.place_tower
     cost = 100
     time_to_reload = 200
     shooting_range = 800
@@ -311,13 +660,13 @@ class CannonTower:
     # bias - смещение точки, из которой вылетает снаряд, от левого верхнего угла плента, на котором спавнится башня
     animation_length = 16
 
-    def __init__(self, player, coords, mobs, bullets, game_sounds_query):
+    def __init__(self, player, coords, mob_grids, bullets, game_sounds_query):
         self.player = player
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.mobs = mobs
+        self.mob_grids = mob_grids  # сетки с мобами обоих игроков, по которым башня ищет цель
         self.bullets = bullets
         self.game_sounds_query = game_sounds_query  # очередь звуков, отсылаемых клиентам
-        self.reloading = 0  # сколько времени осталось до выстрела(сек/60)
+        self.wake_tick = None  # тик, на котором закончится перезарядка, None - башня заряжена
         self.animation_index = 0
 
     def get_coords(self):
@@ -325,26 +674,24 @@ class CannonTower:
         return self.coords[0] - self.x_bias, self.coords[1] - self.y_bias
 
     def update(self):
-        if not self.reloading:
-            for mob in self.mobs[opponent(self.player)]:
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        bullet = Bullet(self.coords, self.damage, 'shell', 1200, mob, distance)
-                        self.bullets.append(bullet)
-                        self.game_sounds_query.append('cannon_shot')
-                        self.animation_index = round(bullet.angle / (math.pi / 8)) % self.animation_length
-                        self.reloading = self.time_to_reload
-                        return
-        else:
-            self.reloading -= 1
+        """Аналог BowTower.update"""
+        mob, distance = self.mob_grids[opponent(self.player)].first_within(self.coords, self.shooting_range, is_alive)
+        if mob is None:
+            return False
+        bullet = Bullet(self.coords, self.damage, 'shell', 1200, mob, distance)
+        self.bullets.append(bullet)
+        self.game_sounds_query.append('cannon_shot')
+        self.animation_index = round(bullet.angle / (math.pi / 8)) % self.animation_length
+        return True
 
     def get_data(self):
         """Возвращает всю информацию о башне для отправки клиенту"""
-        return 'cannon', self.get_coords(), int(self.animation_index)
+        return 'cannon', *self.get_coords(), int(self.animation_index)
 
 
 class CrystalTower:
+    id = None  # постоянный id в рассылаемом клиентам состоянии игры, выдаётся в OnlineGame.update_sending_data
+    order = None  # место башни в порядке обновления башен, выдаётся в OnlineGame.place_tower
     cost = 150
     time_to_reload = 30
     shooting_range = 700
@@ -354,36 +701,40 @@ class CrystalTower:
     # bias - смещение точки, из которой вылетает снаряд, от левого верхнего угла плента, на котором спавнится башня
     animation_length = 27
 
-    def __init__(self, player, coords, mobs, bullets, game_sounds_query):
+    def __init__(self, player, coords, mob_grids, bullets, game_sounds_query):
         self.player = player
         self.coords = (coords[0] + self.x_bias, coords[1] + self.y_bias)
-        self.mobs = mobs
+        self.mob_grids = mob_grids  # сетки с мобами обоих игроков, по которым башня ищет цель
         self.bullets = bullets
         self.game_sounds_query = game_sounds_query  # очередь звуков, отсылаемых клиентам
-        self.reloading = 0  # сколько времени осталось до выстрела(сек/60)
+        self.wake_tick = None  # тик, на котором закончится перезарядка, None - башня заряжена
         self.animation_index = 0
+        self.shot = False  # выстрелила ли башня на этом тике
 
     def get_coords(self):
         """Возвращает координаты левого верхнего угла башни для отправки клиенту"""
         return self.coords[0] - self.x_bias, self.coords[1] + self.y_bias
 
     def update(self):
-        if not self.reloading:
-            for mob in self.mobs[opponent(self.player)]:
-                if mob.state != 'death':
-                    distance = calculate_distance_between_points(*self.coords, *mob.coords)
-                    if distance <= self.shooting_range:
-                        self.bullets.append(HomingBullet(self.coords, self.damage, 'sphere', 300, mob))
-                        self.game_sounds_query.append('crystal_shot')
-                        self.reloading = self.time_to_reload
-                        return
+        """Аналог BowTower.update"""
+        mob, distance = self.mob_grids[opponent(self.player)].first_within(self.coords, self.shooting_range, is_alive)
+        if mob is None:
+            return False
+        self.bullets.append(HomingBullet(self.coords, self.damage, 'sphere', 300, mob))
+        self.game_sounds_query.append('crystal_shot')
+        self.shot = True
+        return True
+
+    def animate(self):
+        """Кристалл переливается каждый тик, кроме тика выстрела, в том числе пока башня перезаряжается"""
+        if self.shot:
+            self.shot = False
         else:
-            self.reloading -= 1
-        self.animation_index = (self.animation_index + 0.3) % self.animation_length
+            self.animation_index = (self.animation_index + 0.3) % self.animation_length
 
     def get_data(self):
         """Возвращает всю информацию о башне для отправки клиенту"""
-        return 'crystal', self.get_coords(), int(self.animation_index)
+        return 'crystal', *self.get_coords(), int(self.animation_index)
 
 
 class MainTower(BowTower):
@@ -391,19 +742,31 @@ class MainTower(BowTower):
     full_hp = 1000
     time_to_reload = 60
 
-    def __init__(self, player, mobs, bullets, game_sounds_query):
+    def __init__(self, player, mob_grids, bullets, game_sounds_query):
         if player == PLAYER_1:
             coords = (98, 462)
         else:
             coords = (1828, 470)
-        super().__init__(player, coords, mobs, bullets, game_sounds_query)
+        super().__init__(player, coords, mob_grids, bullets, game_sounds_query)
+        self.order = (PLAYER_2 + 1, player)  # главные башни обновляются после башен обоих игроков
 
     def hit(self, damage):
         self.health -= damage
 
 
+TOWERS = {
+    'bow': BowTower,
+    'cannon': CannonTower,
+    'crystal': CrystalTower
+}
+
+
 class BaseBullet:
     """Класс-родитель для классов конкретных пуль"""
+    id = None  # постоянный id в рассылаемом клиентам состоянии игры, выдаётся в OnlineGame.update_sending_data
+    kind = BULLET_KIND  # вид сущности в состоянии игры
+    spawn_tick = None  # тик, на котором снаряд появился, выставляется в OnlineGame.get_entities
+
     def __init__(self, start_coords, damage, type, velocity, mob):
         self.coords = list(start_coords)
         self.damage = damage
@@ -416,14 +779,19 @@ class BaseBullet:
 
     def get_data(self):
         """Возвращает всю информацию о снаряде для отправки клиенту"""
-        return self.type, self.coords, self.angle, int(self.animation_index)
+        return self.type, *self.coords, self.angle, int(self.animation_index)
 
 
 class Bullet(BaseBullet):
-    """Класс прямолетящего снаряда"""
+    """Класс прямолетящего снаряда. Его полёт известен заранее, поэтому клиентам отправляется только точка вылета,
+    точка попадания, тик вылета и скорость, а положение снаряда клиент рассчитывает сам (см. snapshots.py)"""
+    kind = PROJECTILE_KIND
+
     def __init__(self, start_coords, damage, type, velocity, mob, distance_to_target):
         super().__init__(start_coords, damage, type, velocity, mob)
+        self.start_coords = tuple(start_coords)
         self.distance_to_target = distance_to_target
+        self.record = None  # запись для состояния игры, не меняется за время полёта
         self.calculate_trajectory(mob, distance_to_target)
 
     def calculate_trajectory(self, mob, distance_to_target):
@@ -443,14 +811,18 @@ class Bullet(BaseBullet):
             self.angle += math.pi
 
     def update(self):
+        # Координаты снаряда нужны только клиенту, а он рассчитывает их сам по записи из get_data
         if self.steps_to_target > 0:
-            self.coords[0] += self.step[0]
-            self.coords[1] += self.step[1]
             self.steps_to_target -= 1
         else:
             self.mob.hit(self.damage)
             self.killed = True
 
+    def get_data(self):
+        if self.record is None:
+            self.record = (self.type, *self.start_coords, *self.end_coords, self.spawn_tick, self.velocity)
+        return self.record
+
 
 class HomingBullet(BaseBullet):
     """Класс самонаводящегося снаряда"""
@@ -475,7 +847,13 @@ class HomingBullet(BaseBullet):
 
 
 class OnlineGame:
-    def __init__(self):
+    def __init__(self, protocol=FRAMED, seed=None):
+        self.protocol = protocol  # протокол, в котором кодируется data_to_send
+        # Все случайные решения игры принимаются генератором с известным зерном, так что по зерну и журналу
+        # действий игроков матч можно повторить (см. input_log.py):
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.random = random.Random(self.seed)
+        self.input_log = None  # журнал действий игроков, если комната его ведёт
         self.sounds_query = []
         # Очередь звуков, которые будут высылаться игрокам.
         # Другие классы будут добавлять туда звуки выстрелов или ударов
@@ -483,10 +861,16 @@ class OnlineGame:
             PLAYER_1: [],
             PLAYER_2: []
         }
+        # Сетки с мобами каждого игрока. По сетке левого игрока мобы правого ищут, с кем вступить в бой,
+        # а по обеим сеткам башни ищут цели:
+        self.mob_grids = {
+            PLAYER_1: SpatialGrid(SKIRMISH_DISTANCE),
+            PLAYER_2: SpatialGrid(SKIRMISH_DISTANCE)
+        }
         self.bullets = []
         self.main_towers = {
-            PLAYER_1: MainTower(PLAYER_1, self.mobs, self.bullets, self.sounds_query),
-            PLAYER_2: MainTower(PLAYER_2, self.mobs, self.bullets, self.sounds_query)
+            PLAYER_1: MainTower(PLAYER_1, self.mob_grids, self.bullets, self.sounds_query),
+            PLAYER_2: MainTower(PLAYER_2, self.mob_grids, self.bullets, self.sounds_query)
         }
         self.players_cache = {
             PLAYER_1: 100,
@@ -496,102 +880,339 @@ class OnlineGame:
             PLAYER_1: [],
             PLAYER_2: []
         }
-        self.action_query = []  # очередь действий пользователей
-        self.data_to_send = pickle.dumps('Waiting for players')
+        # Башни обновляются, только пока заряжены, а перезаряжающиеся башни будит колесо таймеров. Заряженные башни
+        # хранятся в порядке обновления: башни левого игрока, башни правого игрока, главные башни:
+        self.ready_towers = [self.main_towers[PLAYER_1], self.main_towers[PLAYER_2]]
+        self.animated_towers = []  # башни, анимация которых идёт каждый тик
+        self.tower_orders = {
+            PLAYER_1: count(),
+            PLAYER_2: count()
+        }
+        self.reload_timers = TimerWheel()  # когда закончится перезарядка башен
+        self.hit_timers = TimerWheel()  # когда мобы нанесут удар
+        self.mob_orders = count()
+        self.actions = ActionQueue()  # очередь действий пользователей
+        self.tick = 0  # номер текущего тика
+        self.entity_ids = count(1)
+        self.snapshot = None  # состояние игры, собранное на последнем тике
+        self.snapshots = SnapshotHistory()  # последние состояния игры, относительно которых считаются дельты
+        self.profiler = TickProfiler()  # время фаз тика
+        if self.protocol == LEGACY:
+            self.data_to_send = pickle.dumps('Waiting for players')
 
     def start_mainloop(self):
-        while True:
-            start_time = time.time()
-            self.update()
-            sleep_time = 0.8 * TICK - (time.time() - start_time)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+        """Запускает игру в текущем потоке с собственным планировщиком тиков.
+        На сервере комнаты вместо этого регистрируются в общем для всех комнат планировщике"""
+        scheduler = TickScheduler()
+        scheduler.add(self)
+        scheduler.run()
 
     def update(self):
-        if self.action_query:
-            self.handle_player_action(*self.action_query.pop(-1))
-        # Очистка списков мобов(удаление умерших мобов) и формирование боёв между мобами:
+        # Время каждой фазы тика записывается профилировщиком (см. tick_profiler.py)
+        profiler = self.profiler
+        profiler.start()
+        self.tick += 1
+        for player, action, data, raw_data in self.actions.drain(self.parse_player_action):
+            if self.input_log is not None:
+                self.input_log.record(self.tick, player, action, raw_data)
+            self.handle_player_action(player, action, data)
+        profiler.mark('actions')
+
+        mobs_to_pair = self.update_mobs()
+        profiler.mark('mobs')
+        self.form_all_skirmishes(mobs_to_pair)
+        profiler.mark('skirmishes')
+
+        self.update_towers()
+        profiler.mark('towers')
+
+        self.update_bullets()
+        profiler.mark('bullets')
+
+        self.players_cache[PLAYER_1] += CACHE_VELOCITY
+        self.players_cache[PLAYER_2] += CACHE_VELOCITY
+
+        self.update_sending_data()
+        profiler.mark('snapshot')
+        return profiler.finish()
+
+    def update_mobs(self):
+        """Обновляет мобов и убирает умерших. Возвращает мобов правого игрока, которых нужно поставить в бой"""
+        hits = self.hit_timers.advance(self.tick)
+        # Моб, следующий в списке за убранным, на этом тике не обновляется: цикл перескакивает через него
+        skipped = []
         for mob in self.mobs[PLAYER_1]:
             mob.update()
             if mob.state == 'killed':
-                self.mobs[PLAYER_1].remove(mob)
+                self.remove_mob(mob, skipped)
+        self.resolve_hits(hits, PLAYER_1, skipped)
+        for mob in self.mobs[PLAYER_1]:
+            self.mob_grids[PLAYER_1].place(mob)
+        mobs_to_pair = []
+        skipped = []
         for mob in self.mobs[PLAYER_2]:
             mob.update()
             if mob.state == 'killed':
-                self.mobs[PLAYER_2].remove(mob)
+                self.remove_mob(mob, skipped)
                 continue
-            # Формирование стычек между мобами:
-            for opponent_mob in self.mobs[PLAYER_1]:
-                if calculate_distance_between_points(*mob.coords, *opponent_mob.coords) < 100:
-                    states = {mob.state, opponent_mob.state}
-                    if 'move' in states and 'death' not in states:
-                        let_mobs_fight(mob, opponent_mob)
-
-        for tower in self.towers[PLAYER_1] + self.towers[PLAYER_2]:
-            tower.update()
-
-        self.main_towers[PLAYER_1].update()
-        self.main_towers[PLAYER_2].update()
+            mobs_to_pair.append(mob)
+        self.resolve_hits(hits, PLAYER_2, skipped)
+        return mobs_to_pair
+
+    def remove_mob(self, mob, skipped):
+        """Убирает моба из игры во время цикла по мобам его игрока и добавляет в skipped следующего моба"""
+        mobs = self.mobs[mob.player]
+        i = mobs.index(mob)
+        del mobs[i]
+        self.mob_grids[mob.player].remove(mob)
+        if i < len(mobs):
+            skipped.append(mobs[i])
+
+    def resolve_hits(self, hits, player, skipped):
+        """Удары мобов игрока, поставленные на этот тик, в порядке списка мобов. Удар меняет только самого моба
+        и его цель - моба или главную башню противника, поэтому удары можно нанести после обновления всех мобов
+        игрока: мобы противника левого игрока ещё не обновлялись, а мобы противника правого игрока уже обновились.
+        Пропущенные на этом тике мобы (skipped) не бьют, их удар переносится"""
+        due = [mob for mob in hits if mob.player == player and mob.hit_tick == self.tick and mob.state == 'attack']
+        due.sort(key=attrgetter('order'))
+        for mob in due:
+            if mob in skipped:
+                mob.schedule_hit()
+            else:
+                mob.strike()
+
+    def update_towers(self):
+        """Обновляет заряженные башни, будит башни, у которых закончилась перезарядка, и анимирует башни"""
+        woken = self.reload_timers.advance(self.tick)
+        if woken:
+            for tower in woken:
+                tower.wake_tick = None
+            self.ready_towers.extend(woken)
+            self.ready_towers.sort(key=attrgetter('order'))
+        ready = []
+        for tower in self.ready_towers:
+            if tower.update():
+                # Раньше башня отсчитывала перезарядку сама и стреляла на следующем тике после её окончания
+                tower.wake_tick = self.tick + tower.time_to_reload + 1
+                self.reload_timers.schedule(tower.wake_tick, tower)
+            else:
+                ready.append(tower)
+        self.ready_towers = ready
+        for tower in self.animated_towers:
+            tower.animate()
+
+    def place_tower(self, player, tower, index=None):
+        """Ставит башню игрока на место башни с номером index в списке башен или, если index=None, в конец списка.
+        Новая башня заряжена и стреляет уже на этом тике"""
+        towers = self.towers[player]
+        if index is None:
+            tower.order = (player, next(self.tower_orders[player]))
+            towers.append(tower)
+        else:
+            old_tower = towers[index]
+            tower.order = old_tower.order
+            if old_tower.wake_tick is not None:
+                self.reload_timers.cancel(old_tower.wake_tick, old_tower)
+            else:
+                self.ready_towers.remove(old_tower)
+            if old_tower in self.animated_towers:
+                self.animated_towers.remove(old_tower)
+            towers[index] = tower
+        self.ready_towers.append(tower)
+        self.ready_towers.sort(key=attrgetter('order'))
+        if hasattr(tower, 'animate'):
+            self.animated_towers.append(tower)
+
+    def form_all_skirmishes(self, mobs):
+        """Формирование стычек между мобами. Стычка меняет только моба правого игрока, которого ставят в бой,
+        и мобов левого игрока, поэтому её можно искать после обновления всех мобов, а не сразу после обновления моба"""
+        for mob in mobs:
+            self.form_skirmishes(mob)
+        for mob in self.mobs[PLAYER_2]:
+            self.mob_grids[PLAYER_2].place(mob)
 
+    def update_bullets(self):
         for bullet in self.bullets:
             bullet.update()
             if bullet.killed:
                 self.bullets.remove(bullet)
 
-        self.players_cache[PLAYER_1] += CACHE_VELOCITY
-        self.players_cache[PLAYER_2] += CACHE_VELOCITY
-
-        self.update_sending_data()
-
-    def update_sending_data(self):
-        """Обновляет атрибут data_to_send, который отправляется клиентам в функции client_processing"""
-        mobs_data = []
+    def form_skirmishes(self, mob):
+        """Ставит моба правого игрока в бой с мобами левого игрока, оказавшимися рядом.
+        Мобы противника проверяются в порядке их появления, как при полном переборе списка, но только из соседних ячеек"""
+        checked = -1  # порядковый номер последнего проверенного моба противника
+        grid = self.mob_grids[PLAYER_1]
+        candidates = grid.near(mob.coords, SKIRMISH_DISTANCE)
+        i = 0
+        while i < len(candidates):
+            order, opponent_mob = candidates[i]
+            i += 1
+            if order <= checked:
+                continue
+            checked = order
+            if calculate_distance_between_points(*mob.coords, *opponent_mob.coords) < SKIRMISH_DISTANCE:
+                states = {mob.state, opponent_mob.state}
+                if 'move' in states and 'death' not in states:
+                    let_mobs_fight(mob, opponent_mob)
+                    grid.place(opponent_mob)
+                    # Оба моба встали друг напротив друга, поэтому соседей ищем заново от нового места
+                    candidates = grid.near(mob.coords, SKIRMISH_DISTANCE)
+                    i = 0
+
+    def get_entities(self):
+        """Возвращает словарь id сущности -> (вид сущности, запись сущности) для состояния игры"""
+        entities = {}
         for mob in self.mobs[PLAYER_1] + self.mobs[PLAYER_2]:
-            mobs_data.append(mob.get_data())
+            entities[self.get_entity_id(mob)] = (MOB_KIND, mob.get_data())
+        self.add_towers_entities(entities)
+        for bullet in self.bullets:
+            if bullet.id is None:
+                bullet.spawn_tick = self.tick
+            entities[self.get_entity_id(bullet)] = (bullet.kind, bullet.get_data())
+        return entities
 
-        towers_data = []
+    def add_towers_entities(self, entities):
         for tower in self.towers[PLAYER_1] + self.towers[PLAYER_2]:
-            towers_data.append(tower.get_data())
-
-        bullets_data = []
-        for bullet in self.bullets:
-            bullets_data.append(bullet.get_data())
+            entities[self.get_entity_id(tower)] = (TOWER_KIND, tower.get_data())
 
+    def update_sending_data(self):
+        """Собирает состояние игры на текущем тике, которое рассылается клиентам"""
+        entities = self.get_entities()
         sounds_data = tuple(self.sounds_query)
         self.sounds_query.clear()
 
-        self.data_to_send = pickle.dumps((tuple(mobs_data), tuple(towers_data), tuple(bullets_data), sounds_data,
-                                          self.main_towers[1].health, self.main_towers[2].health,
-                                          int(self.players_cache[PLAYER_1]), int(self.players_cache[PLAYER_2])))
+        self.snapshot = Snapshot(self.tick, entities,
+                                 (self.main_towers[1].health, self.main_towers[2].health,
+                                  int(self.players_cache[PLAYER_1]), int(self.players_cache[PLAYER_2])),
+                                 sounds_data)
+        self.snapshots.add(self.snapshot)
+        if self.protocol == LEGACY:
+            self.data_to_send = pickle.dumps(self.snapshot.as_tuple())
+
+    def get_entity_id(self, entity):
+        if entity.id is None:
+            entity.id = next(self.entity_ids)
+        return entity.id
+
+    def get_data_to_send(self, stream):
+        """Возвращает сообщение с состоянием игры для клиента, которому состояние рассылается через stream.
+        Состояние кодируется дельтой относительно подтверждённого клиентом состояния"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return pack_message(WAITING)
+        base = stream.choose_base(snapshot, self.snapshots)
+        base_tick = base.tick if base is not None else None
+        sounds_after, stream.sent_tick = stream.sent_tick, snapshot.tick  # звуки со времени прошлой отправки
+        key = (base_tick, sounds_after)
+        data = snapshot.encoded.get(key)
+        if data is None:
+            # Оба игрока обычно подтверждают и получают одни и те же тики, поэтому дельта кодируется один раз на двоих
+            sounds = self.snapshots.sounds_between(sounds_after, snapshot.tick)
+            data = snapshot.encoded[key] = pack_message(SNAPSHOT, encode_snapshot(snapshot, base, sounds))
+        return data
+
+    def is_over(self):
+        """Упала ли главная башня одного из игроков"""
+        return self.main_towers[PLAYER_1].health <= 0 or self.main_towers[PLAYER_2].health <= 0
 
     def get_player_action(self, player, action, data):
-        self.action_query.append((player, action, data))
+        self.actions.put(player, action, data)
+
+    @staticmethod
+    def parse_player_action(player, action, data):
+        """Проверяет действие игрока и приводит его аргументы к нужным типам.
+        Если действие некорректно, вызывается ValueError"""
+        if action == 'spawn_mob':
+            mob_type, road_index, coords = data
+            road_index = int(road_index)
+            x, y = map(int, coords.split(';'))
+            if mob_type not in MOBS or not 0 <= road_index < len(P_2_WAYS):
+                raise ValueError(f'Unknown mob {mob_type} or road {road_index}')
+            check_on_map(x, y)
+            # Спавнить мобов можно только в своей четверти карты:
+            if (player == PLAYER_1 and x >= WIDTH / 4) or (player == PLAYER_2 and x <= WIDTH / 4 * 3):
+                raise ValueError(f'Mob spawn point {x};{y} is out of the spawn zone')
+            return mob_type, road_index, (x, y)
+        elif action == 'spawn_tower':
+            tower_type, coords = data
+            if tower_type not in TOWERS:
+                raise ValueError(f'Unknown tower {tower_type}')
+            x, y = map(int, coords.split(';'))
+            check_on_map(x, y)
+            return tower_type, (x, y)
+        raise ValueError(f'Unknown action {action}')
 
     def handle_player_action(self, player, action, data):
         if action == 'spawn_mob':
-            mob_type = data[0]
-            road_index = int(data[1])
-            coords = tuple(map(int, data[2].split(';')))
-            mob = Mob(player, mob_type, road_index, coords, self.main_towers[opponent(player)], self.sounds_query)
+            mob_type, road_index, coords = data
+            mob = Mob(player, mob_type, road_index, coords, self.main_towers[opponent(player)], self.sounds_query,
+                      self.hit_timers, self.random)
             if self.players_cache[player] >= mob.cost:
-                if (player == PLAYER_1 and coords[0] < WIDTH / 4) or (player == PLAYER_2 and coords[0] > WIDTH / 4 * 3):
-                    self.mobs[player].append(mob)
-                    self.players_cache[player] -= mob.cost
+                mob.order = next(self.mob_orders)
+                self.mobs[player].append(mob)
+                self.players_cache[player] -= mob.cost
         elif action == 'spawn_tower':
-            tower_type = data[0]
-            coords = tuple(map(int, data[1].split(';')))
-            tower = {'bow': BowTower, 'cannon': CannonTower, 'crystal': CrystalTower}[tower_type]
+            tower_type, coords = data
+            tower = TOWERS[tower_type]
+            if self.players_cache[player] < tower.cost:
+                return
             towers = self.towers[player]
+            index = None  # номер башни, которую заменит новая
             for i in range(len(towers)):
                 if calculate_distance_between_points(*coords, *towers[i].get_coords()) <= 142:
                     if towers[i].cost < tower.cost:
-                        towers[i] = tower(player, coords, self.mobs, self.bullets, self.sounds_query)
-                    else:
+                        index = i
                         break
-            else:
-                towers.append(tower(player, coords, self.mobs, self.bullets, self.sounds_query))
+                    else:
+                        return  # нельзя заменить башню на более дешёвую
+            self.place_tower(player, tower(player, coords, self.mob_grids, self.bullets, self.sounds_query), index)
             self.players_cache[player] -= tower.cost
 
 
+def main():
+    parser = argparse.ArgumentParser(description='Сервер онлайн режима')
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio',
+                        help='asyncio - все комнаты в одном цикле событий, threaded - поток на каждого клиента')
+    parser.add_argument('--protocol', choices=(FRAMED, LEGACY), default=FRAMED,
+                        help='framed - сообщения с заголовками (protocol.py), legacy - прежний протокол на pickle')
+    parser.add_argument('--host', default=SERVER)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='сколько раз в секунду клиентам рассылается состояние игры (только для framed)')
+    parser.add_argument('--engine', choices=('objects', 'numpy'), default='objects',
+                        help='objects - мобы и снаряды объектами, numpy - столбцами numpy (numpy_engine.py)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='число процессов-обработчиков комнат (workers.py), 0 - все комнаты в этом процессе')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='порт метрик сервера на 127.0.0.1 (metrics.py), 0 - без метрик. '
+                             'Обработчики отдают свои метрики на следующих портах')
+    parser.add_argument('--record-dir',
+                        help='папка, в которую каждая комната записывает рассылаемые состояния игры для просмотра '
+                             'в online_game.py (recording.py)')
+    parser.add_argument('--input-log-dir',
+                        help='папка, в которую каждая комната пишет журнал действий игроков для повтора матча '
+                             'в headless.py (input_log.py)')
+    args = parser.parse_args()
+    game_class = OnlineGame
+    if args.engine == 'numpy':
+        try:
+            from numpy_engine import NumpyOnlineGame as game_class
+        except ImportError:
+            parser.error('для движка numpy нужен пакет numpy')
+    for directory in (args.input_log_dir, args.record_dir):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+    if args.workers > 0:
+        from workers import run_master
+        run_master(args.host, args.port, args.workers, args.mode, args.protocol, args.send_rate, game_class,
+                   args.metrics_port, args.input_log_dir, args.record_dir)
+    elif args.mode == 'threaded':
+        clients_accepting(create_server_socket(args.host, args.port), args.protocol, args.send_rate, game_class,
+                          args.metrics_port, args.input_log_dir, args.record_dir)
+    else:
+        asyncio.run(async_clients_accepting(args.host, args.port, args.protocol, args.send_rate, game_class,
+                                            args.metrics_port, args.input_log_dir, args.record_dir))
+
+
 if __name__ == '__main__':
-    clients_accepting()
+    main()
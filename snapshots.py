@@ -0,0 +1,127 @@
+import math
+from collections import deque
+
+
+# В этом файле описано состояние онлайн игры, которое сервер рассылает клиентам.
+# Сервер шлёт клиенту не всё состояние целиком, а только его изменения (дельту) относительно
+# последнего состояния, получение которого клиент подтвердил. Для этого у всех мобов, башен и снарядов есть постоянные id
+
+# Виды сущностей и поля их записей:
+MOB_KIND = 0  # игрок, тип, x, y, состояние, кадр анимации, здоровье
+TOWER_KIND = 1  # тип, x, y, кадр анимации
+BULLET_KIND = 2  # тип, x, y, угол, кадр анимации (самонаводящийся снаряд)
+# Прямолетящий снаряд: тип, x и y точки вылета, x и y точки попадания, тик вылета, скорость (пикселей за тик).
+# Запись не меняется, пока снаряд летит, поэтому клиенту она отправляется один раз, а положение снаряда
+# клиент рассчитывает сам (см. projectile_data)
+PROJECTILE_KIND = 3
+KEYFRAME_INTERVAL = 300  # как часто клиенту высылается полное состояние, даже если у него есть подтверждённое, тиков
+
+
+class Snapshot:
+    """Состояние игры на определённом тике"""
+    def __init__(self, tick, entities, scalars, sounds):
+        self.tick = tick
+        self.entities = entities  # id -> (вид сущности, запись)
+        self.scalars = scalars  # хп главных башен и деньги обоих игроков
+        self.sounds = sounds  # звуки, прозвучавшие на этом тике (у принятого клиентом - с прошлого принятого)
+        # (базовый тик, тик, после которого собраны звуки) -> закодированная дельта, чтобы не кодировать её заново
+        # для каждого клиента
+        self.encoded = {}
+        self.wire = None  # закодированные записи сущностей (см. protocol.py)
+
+    def as_tuple(self, tick=None):
+        """Возвращает состояние в виде кортежа, который отрисовывает клиент и который пересылался в старом протоколе.
+        tick - дробный тик, на котором рисуются прямолетящие снаряды (по умолчанию тик состояния)"""
+        if tick is None:
+            tick = self.tick
+        mobs_data, towers_data, bullets_data, projectiles_data = [], [], [], []
+        for kind, record in self.entities.values():
+            if kind == MOB_KIND:
+                player, mob_type, x, y, state, animation_index, health = record
+                mobs_data.append((player, mob_type, (x, y), state, animation_index, health))
+            elif kind == TOWER_KIND:
+                tower_type, x, y, animation_index = record
+                towers_data.append((tower_type, (x, y), animation_index))
+            elif kind == BULLET_KIND:
+                bullet_type, x, y, angle, animation_index = record
+                bullets_data.append((bullet_type, (x, y), angle, animation_index))
+            else:
+                projectiles_data.append(projectile_data(record, tick))
+        # Снаряды разных видов идут по отдельности, чтобы их порядок не зависел от того, получено состояние
+        # целиком или дельтой
+        return (tuple(mobs_data), tuple(towers_data), tuple(bullets_data + projectiles_data), self.sounds,
+                *self.scalars)
+
+
+def projectile_data(record, tick):
+    """Тип, координаты, угол и кадр анимации прямолетящего снаряда на тике tick, как у снаряда на сервере:
+    снаряд сдвигается на скорость за тик, начиная с тика вылета, пока не пройдёт весь путь до цели"""
+    bullet_type, start_x, start_y, end_x, end_y, spawn_tick, speed = record
+    d_x, d_y = end_x - start_x, end_y - start_y
+    distance = math.hypot(d_x, d_y) or 1
+    steps = min(tick - spawn_tick + 1, math.ceil(distance / speed))
+    x, y = start_x + d_x / distance * speed * steps, start_y + d_y / distance * speed * steps
+    # Округлённые при передаче координаты могут дать d_x = 0, на сервере такого снаряда не бывает
+    angle = -math.atan(d_y / d_x) if d_x else -math.copysign(math.pi / 2, d_y)
+    if d_x < 0:
+        angle += math.pi
+    return bullet_type, (x, y), angle, 0
+
+
+class SnapshotHistory:
+    """Несколько последних состояний игры по номерам тиков.
+    На сервере из неё берутся подтверждённые клиентами состояния, на клиенте - базовые состояния для дельт"""
+    def __init__(self, length=64):
+        self.snapshots = {}
+        self.ticks = deque()
+        self.length = length
+
+    def add(self, snapshot):
+        self.snapshots[snapshot.tick] = snapshot
+        self.ticks.append(snapshot.tick)
+        if len(self.ticks) > self.length:
+            self.snapshots.pop(self.ticks.popleft(), None)
+
+    def get(self, tick):
+        return self.snapshots.get(tick)
+
+    def sounds_between(self, after_tick, tick):
+        """Звуки состояний с тиками после after_tick до tick включительно (after_tick=None - только тика tick).
+        Звуки тиков, которые уже выпали из истории, не возвращаются"""
+        if after_tick is None:
+            after_tick = tick - 1
+        sounds = []
+        for sound_tick in range(max(after_tick + 1, tick - self.length + 1), tick + 1):
+            snapshot = self.snapshots.get(sound_tick)
+            if snapshot is not None:
+                sounds.extend(snapshot.sounds)
+        return tuple(sounds)
+
+
+class SnapshotStream:
+    """Состояние рассылки снимков одному клиенту: какой тик клиент подтвердил, когда получал полное состояние
+    и какое состояние ему отправлено последним. Состояние отправляется не каждый тик, а отправитель пропускает
+    состояния, которые клиент не успевает принять, поэтому с состоянием уходят звуки всех тиков после
+    последнего отправленного"""
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.acked_tick = None
+        self.last_keyframe_tick = None
+        self.sent_tick = None
+
+    def ack(self, tick):
+        self.acked_tick = tick
+
+    def request_keyframe(self):
+        self.acked_tick = None
+
+    def choose_base(self, snapshot, history):
+        """Возвращает подтверждённое клиентом состояние, относительно которого нужно закодировать snapshot,
+        или None, если клиенту нужно отправить полное состояние"""
+        base = None
+        if self.acked_tick is not None and self.last_keyframe_tick is not None \
+                and snapshot.tick - self.last_keyframe_tick < self.keyframe_interval:
+            base = history.get(self.acked_tick)
+        if base is None:
+            self.last_keyframe_tick = snapshot.tick
+        return base
@@ -0,0 +1,99 @@
+from itertools import count
+from utils import calculate_distance_between_points
+
+
+# В этом файле находится пространственный индекс, через который мобы и башни ищут мобов рядом с собой,
+# не перебирая всех мобов на карте
+
+
+class SpatialGrid:
+    """Равномерная сетка из квадратных ячеек, в каждой ячейке хранятся лежащие в ней объекты (всё, у чего есть coords).
+    Объекты перекладываются между ячейками только тогда, когда действительно переходят в другую ячейку.
+    Каждый объект получает порядковый номер при первом добавлении, и поиск учитывает этот порядок -
+    так результат поиска совпадает с результатом полного перебора списка, в который объекты добавлялись"""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}  # (столбец, строка) -> {объект: порядковый номер}
+        self.positions = {}  # объект -> (ячейка, порядковый номер)
+        self.sequence = count()
+
+    def get_cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def place(self, obj):
+        """Добавляет объект в сетку или перемещает его в ячейку, соответствующую его текущим координатам"""
+        cell = self.get_cell(*obj.coords)
+        position = self.positions.get(obj)
+        if position is None:
+            order = next(self.sequence)
+        else:
+            old_cell, order = position
+            if old_cell == cell:
+                return
+            old_cell_objects = self.cells[old_cell]
+            del old_cell_objects[obj]
+            if not old_cell_objects:
+                del self.cells[old_cell]
+        self.cells.setdefault(cell, {})[obj] = order
+        self.positions[obj] = (cell, order)
+
+    def remove(self, obj):
+        position = self.positions.pop(obj, None)
+        if position is not None:
+            cell = self.cells[position[0]]
+            del cell[obj]
+            if not cell:
+                del self.cells[position[0]]
+
+    def clear(self):
+        self.cells.clear()
+        self.positions.clear()
+
+    def cells_within(self, coords, radius):
+        """Возвращает содержимое непустых ячеек, которые пересекает круг радиуса radius с центром в coords"""
+        x, y = coords
+        size = self.cell_size
+        first_column, first_row = self.get_cell(x - radius, y - radius)
+        last_column, last_row = self.get_cell(x + radius, y + radius)
+        if (last_column - first_column + 1) * (last_row - first_row + 1) > len(self.cells):
+            # Ячеек под кругом больше, чем непустых ячеек в сетке - быстрее пройти по непустым
+            cells = [cell for cell in self.cells
+                     if first_column <= cell[0] <= last_column and first_row <= cell[1] <= last_row]
+        else:
+            cells = [(column, row) for column in range(first_column, last_column + 1)
+                     for row in range(first_row, last_row + 1) if (column, row) in self.cells]
+        found = []
+        for column, row in cells:
+            # Расстояние от центра круга до ближайшей точки ячейки (с запасом на погрешность округления):
+            d_x = max(column * size - x, x - (column + 1) * size, 0)
+            d_y = max(row * size - y, y - (row + 1) * size, 0)
+            if d_x * d_x + d_y * d_y <= (radius + 1) ** 2:
+                found.append(self.cells[column, row])
+        return found
+
+    def near(self, coords, radius):
+        """Возвращает список (порядковый номер, объект) в порядке добавления для всех объектов из ячеек,
+        которые пересекает круг радиуса radius. Расстояние до объектов нужно проверять отдельно"""
+        found = []
+        for objects in self.cells_within(coords, radius):
+            found.extend((order, obj) for obj, order in objects.items())
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def first_within(self, coords, radius, accept, key=None):
+        """Возвращает первый по порядку добавления объект не дальше radius от coords, для которого accept(объект)
+        истинно, и расстояние до него. Если задан key, объекты с меньшим key(объект) идут раньше остальных.
+        Если подходящего объекта нет, возвращает (None, None)"""
+        best, best_rank, best_distance = None, None, None
+        for objects in self.cells_within(coords, radius):
+            for obj, order in objects.items():
+                rank = (key(obj), order) if key is not None else order
+                if best_rank is not None and rank >= best_rank:
+                    continue
+                distance = calculate_distance_between_points(*coords, *obj.coords)
+                if distance <= radius and accept(obj):
+                    best, best_rank, best_distance = obj, rank, distance
+        return best, best_distance
+
+    def __len__(self):
+        return len(self.positions)
@@ -1,8 +1,8 @@
 import pygame
-import json
 import sys
 import os
 from constants import *
+from mob_templates import get_mob_template
 
 
 # В этом файле загружаются спрайты для игры
@@ -54,12 +54,11 @@ def load_mob_animations():
     for mob in os.listdir(root):
         mob_dir = os.path.join(root, mob)
         animations[mob] = {}
-        with open(os.path.join(mob_dir, 'info.json'), 'r', encoding='utf-8') as info_file:
-            info = json.load(info_file)
+        states = get_mob_template(mob).states
         for animation in ('move', 'attack', 'death'):
             animations[mob][animation] = load_animation(os.path.join(mob_dir, 'sprites', animation + '.png'),
-                                                        info[animation]['width'],
-                                                        info[animation]['height'])
+                                                        states[animation].width,
+                                                        states[animation].height)
     return animations
 
 
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Сервер загружает карты и данные мобов по относительным путям, поэтому тесты выполняются из корня проекта
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
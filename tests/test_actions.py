@@ -0,0 +1,33 @@
+import pytest
+from constants import PLAYER_1, PLAYER_2, WIDTH, HEIGHT
+from server import OnlineGame
+
+
+# Проверка действий игроков перед тем, как они попадут в игру (OnlineGame.parse_player_action)
+
+
+def test_spawn_mob_in_own_zone():
+    assert OnlineGame.parse_player_action(PLAYER_2, 'spawn_mob', ['skillet', '0', f'{WIDTH - 150};540']) == \
+        ('skillet', 0, (WIDTH - 150, 540))
+
+
+@pytest.mark.parametrize('player, coords', [
+    (PLAYER_1, f'150;{HEIGHT + 1}'),
+    (PLAYER_1, '150;-1'),
+    (PLAYER_2, f'{WIDTH - 150};99999'),
+    (PLAYER_2, f'{WIDTH + 1};540'),
+    (PLAYER_2, '40000;540'),
+])
+def test_spawn_mob_off_map(player, coords):
+    with pytest.raises(ValueError):
+        OnlineGame.parse_player_action(player, 'spawn_mob', ['skillet', '0', coords])
+
+
+@pytest.mark.parametrize('coords', ['619;-5', f'619;{HEIGHT + 1}', f'{WIDTH + 1};259', '5', '1;2;3'])
+def test_spawn_tower_bad_coords(coords):
+    with pytest.raises(ValueError):
+        OnlineGame.parse_player_action(PLAYER_1, 'spawn_tower', ['bow', coords])
+
+
+def test_spawn_tower_on_plant():
+    assert OnlineGame.parse_player_action(PLAYER_1, 'spawn_tower', ['bow', '619;259']) == ('bow', (619, 259))
@@ -0,0 +1,46 @@
+import os
+import shutil
+import pytest
+from mob_templates import MobTemplates
+
+
+# Горячая перезагрузка параметров мобов не должна ломать тик, если info.json прочитан посреди записи
+
+
+@pytest.fixture
+def registry(tmp_path):
+    shutil.copytree(os.path.join('mobs', 'skillet'), tmp_path / 'skillet', ignore=shutil.ignore_patterns('sprites'))
+    return MobTemplates(str(tmp_path), ('skillet',), check_interval=0)
+
+
+def rewrite(path, text):
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, 'w', encoding='utf-8') as info_file:
+        info_file.write(text)
+    os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))  # время изменения обязательно должно поменяться
+
+
+@pytest.mark.parametrize('text', ['{"velocity": 3', '{"velocity": 3}', '[]', ''])
+def test_broken_reload_keeps_previous_template(registry, text):
+    path = os.path.join(registry.root, 'skillet', 'info.json')
+    template = registry.get('skillet')
+    with open(path, encoding='utf-8') as info_file:
+        good = info_file.read()
+    rewrite(path, text)
+    assert registry.get('skillet') is template
+    # Когда файл допишут, он перечитается при следующей проверке
+    rewrite(path, good.replace(f'"health": {template.health}', f'"health": {template.health + 1}', 1))
+    assert registry.get('skillet').health == template.health + 1
+
+
+def test_missing_file_keeps_previous_template(registry):
+    template = registry.get('skillet')
+    os.remove(os.path.join(registry.root, 'skillet', 'info.json'))
+    assert registry.get('skillet') is template
+
+
+def test_broken_file_fails_on_first_load(tmp_path):
+    os.makedirs(tmp_path / 'skillet')
+    (tmp_path / 'skillet' / 'info.json').write_text('{', encoding='utf-8')
+    with pytest.raises(ValueError):
+        MobTemplates(str(tmp_path), ('skillet',))
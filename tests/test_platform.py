@@ -0,0 +1,49 @@
+import os
+import sys
+import subprocess
+from conftest import ROOT
+
+
+# Сервер должен запускаться и там, где нет модулей и сигналов, которые есть только в Unix.
+# Отсутствие модуля имитируется записью None в sys.modules: import такого модуля вызывает ImportError
+
+
+def run_without(modules, code):
+    """Выполняет code в отдельном процессе, в котором модули modules нельзя импортировать"""
+    prelude = ''.join(f'sys.modules[{module!r}] = None\n' for module in modules)
+    env = dict(os.environ, SDL_AUDIODRIVER='dummy')
+    result = subprocess.run([sys.executable, '-c', 'import sys\n' + prelude + code], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+
+def test_broadcast_without_fcntl():
+    run_without(('fcntl', 'termios'), 'import socket, broadcast\n'
+                                      'a, b = socket.socketpair()\n'
+                                      'assert broadcast.unsent_bytes(a) == 0\n')
+
+
+def test_metrics_without_resource():
+    run_without(('resource',), 'import os, metrics\n'
+                               'del os.sysconf\n'  # как в Windows: узнать память процесса нечем
+                               'assert metrics.resident_memory() is None\n')
+
+
+def test_server_starts_without_sigusr1():
+    # Многопоточный сервер: ошибка в потоке приёма клиентов попадёт в errors
+    run_without((), 'import signal, socket, threading, time, server\n'
+                    'del signal.SIGUSR1\n'
+                    'errors = []\n'
+                    'threading.excepthook = errors.append\n'
+                    'listener = server.create_server_socket("127.0.0.1", 0)\n'
+                    'threading.Thread(target=server.clients_accepting, args=[listener], daemon=True).start()\n'
+                    'socket.create_connection(listener.getsockname(), timeout=5).close()\n'
+                    'time.sleep(0.5)\n'
+                    'assert not errors, errors[0].exc_value\n')
+    # Асинхронный сервер работает, пока его не остановят, поэтому ожидание должно закончиться по таймауту
+    run_without((), 'import signal, asyncio, server\n'
+                    'del signal.SIGUSR1\n'
+                    'try:\n'
+                    '    asyncio.run(asyncio.wait_for(server.async_clients_accepting("127.0.0.1", 0), 1))\n'
+                    'except asyncio.TimeoutError:\n'
+                    '    pass\n')
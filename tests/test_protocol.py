@@ -0,0 +1,46 @@
+import socket
+import asyncio
+from broadcast import SnapshotSender, AsyncSnapshotSender
+from exceptions import ProtocolError
+from protocol import encode_snapshot, decode_snapshot
+from snapshots import Snapshot, SnapshotHistory, MOB_KIND, PROJECTILE_KIND
+
+
+# Кодирование состояния игры и отправка его клиенту (protocol.py, broadcast.py)
+
+
+def test_out_of_range_values_saturate():
+    snapshot = Snapshot(1, {1: (MOB_KIND, (2, 'skillet', 40000, 99999, 'move', 3, -70000)),
+                            2: (PROJECTILE_KIND, ('arrow', -40000, 0, 10, 10, 1, 1000.))},
+                        (1000, 1000, 0, 0), ())
+    decoded = decode_snapshot(encode_snapshot(snapshot), SnapshotHistory())
+    assert decoded.entities[1] == (MOB_KIND, (2, 'skillet', 32767, 32767, 'move', 3, -32768))
+    assert decoded.entities[2] == (PROJECTILE_KIND, ('arrow', -32768, 0, 10, 10, 1, 655.35))
+
+
+class BrokenGame:
+    """Игра, состояние которой не удаётся закодировать"""
+    def get_data_to_send(self, stream):
+        raise ProtocolError('broken snapshot')
+
+
+def test_sender_disconnects_on_encode_error():
+    server_side, client_side = socket.socketpair()
+    client_side.settimeout(5)
+    sender = SnapshotSender(server_side, BrokenGame(), 1)
+    sender.notify()
+    assert client_side.recv(1) == b''  # соединение закрыто, а не зависло
+    server_side.close()
+    client_side.close()
+
+
+def test_async_sender_disconnects_on_encode_error():
+    async def run():
+        server_side, client_side = socket.socketpair()
+        _, writer = await asyncio.open_connection(sock=server_side)
+        client_reader, client_writer = await asyncio.open_connection(sock=client_side)
+        sender = AsyncSnapshotSender(writer, BrokenGame(), 1)
+        sender.notify()
+        assert await asyncio.wait_for(client_reader.read(1), 5) == b''
+        client_writer.close()
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import socket
+from constants import RUNNING_ROOM, RECLAIMED_ROOM
+from broadcast import SnapshotSender
+from server import Room, RoomRegistry, OnlineGame
+from tick_scheduler import TickScheduler
+
+
+# Жизненный цикл комнаты при ошибках (server.Room, tick_scheduler.TickScheduler)
+
+
+class FailingGame(OnlineGame):
+    """Игра, тик которой завершается исключением"""
+    def update(self):
+        raise RuntimeError('tick failed')
+
+
+class BrokenInputLog:
+    def close(self, snapshot=None):
+        raise OSError('disk is full')
+
+
+def start_room(game_class=OnlineGame):
+    """Комната с двумя игроками, подключёнными через пары сокетов. Возвращает комнату, реестр, планировщик
+    и сокеты на стороне игроков"""
+    rooms = RoomRegistry()
+    scheduler = TickScheduler()
+    players = [socket.socketpair() for _ in range(2)]
+    room = Room(players[0][0], rooms, scheduler, game_class=game_class, number=1)
+    rooms.add(room)
+    assert room.add_player(players[1][0])
+    for _, client_side in players:
+        client_side.settimeout(5)
+    return room, rooms, scheduler, [client_side for _, client_side in players]
+
+
+def test_failed_tick_closes_room():
+    room, rooms, scheduler, clients = start_room(FailingGame)
+    assert room.state == RUNNING_ROOM
+    scheduler.run_due_ticks()
+    assert room.state == RECLAIMED_ROOM
+    assert len(rooms) == 0 and len(scheduler) == 0
+    for client in clients:
+        assert client.recv(1) == b''  # игроки отключены
+        client.close()
+
+
+def test_close_removes_room_when_files_fail():
+    room, rooms, scheduler, clients = start_room()
+    room.game.input_log = BrokenInputLog()
+    try:
+        room.close()
+    except OSError:
+        pass
+    assert room.state == RECLAIMED_ROOM
+    assert len(rooms) == 0 and len(scheduler) == 0
+    for client in clients:
+        client.close()
+
+
+def test_sender_of_closed_room_is_stopped():
+    room, rooms, scheduler, clients = start_room()
+    room.close()
+    server_side, client_side = socket.socketpair()
+    sender = SnapshotSender(server_side, room.game, 1)
+    assert not room.add_sender(sender)
+    assert sender.closed and not room.senders
+    for sock in clients + [server_side, client_side]:
+        sock.close()
+
+
+def test_sender_of_running_room_is_closed_with_room():
+    room, rooms, scheduler, clients = start_room()
+    server_side, client_side = socket.socketpair()
+    sender = SnapshotSender(server_side, room.game, 1)
+    assert room.add_sender(sender)
+    room.close()
+    assert sender.closed
+    for sock in clients + [server_side, client_side]:
+        sock.close()
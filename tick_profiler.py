@@ -0,0 +1,151 @@
+import time
+from bisect import bisect_left
+from constants import TICK, FPS
+
+
+# В этом файле находится встроенный профилировщик тиков игры: время каждой фазы тика (действия игроков, мобы,
+# стычки, башни, снаряды, сборка состояния игры) складывается в гистограммы за последние несколько секунд.
+# Замер фазы - это один вызов time.perf_counter, поэтому профилировщик включён всегда
+
+PHASES = ('actions', 'mobs', 'skirmishes', 'towers', 'bullets', 'snapshot')
+TOTAL = 'tick'  # тик целиком
+WINDOW = FPS * 10  # за сколько тиков хранится статистика (гистограммы за текущее и предыдущее окно)
+WARNING_INTERVAL = 10  # как часто комната может сообщать о превышении бюджета тика, сек
+# Границы корзин гистограммы, сек: от 10 мкс до ~1.3 с, каждая следующая на 25% больше предыдущей
+BUCKETS = tuple(1e-5 * 1.25 ** i for i in range(53))
+
+
+class Histogram:
+    """Гистограмма длительностей с логарифмическими корзинами"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # последняя корзина - всё, что больше последней границы
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Верхняя граница корзины, в которую попадает заданный процентиль (не больше максимума)"""
+        if not self.count:
+            return 0.
+        rank = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+
+class TickProfiler:
+    """Время фаз тика одной игры. Игра вызывает start в начале тика, mark после каждой фазы и finish в конце"""
+    def __init__(self, phases=PHASES, budget=TICK, window=WINDOW):
+        self.phases = phases + (TOTAL,)
+        self.budget = budget  # бюджет тика, сек
+        self.window = window
+        self.current = {phase: Histogram() for phase in self.phases}
+        self.previous = {phase: Histogram() for phase in self.phases}
+        self.window_ticks = 0
+        self.tick_start = self.last = 0.
+        self.last_tick = {}  # фаза -> её время на последнем тике
+        self.over_budget = 0  # сколько тиков не уложились в бюджет за всё время
+        self.last_warning = None
+
+    def start(self):
+        self.tick_start = self.last = time.perf_counter()
+
+    def mark(self, phase):
+        """Отмечает конец фазы phase, которая длилась с конца предыдущей фазы"""
+        now = time.perf_counter()
+        duration = now - self.last
+        self.current[phase].add(duration)
+        self.last_tick[phase] = duration
+        self.last = now
+
+    def finish(self):
+        """Завершает тик. Возвращает True, если тик не уложился в бюджет"""
+        duration = self.last - self.tick_start
+        self.current[TOTAL].add(duration)
+        self.last_tick[TOTAL] = duration
+        self.window_ticks += 1
+        if self.window_ticks >= self.window:
+            self.previous = self.current
+            self.current = {phase: Histogram() for phase in self.phases}
+            self.window_ticks = 0
+        if duration > self.budget:
+            self.over_budget += 1
+            return True
+        return False
+
+    def should_warn(self):
+        """Пора ли снова сообщить о превышении бюджета (не чаще раза в WARNING_INTERVAL секунд)"""
+        now = time.monotonic()
+        if self.last_warning is not None and now - self.last_warning < WARNING_INTERVAL:
+            return False
+        self.last_warning = now
+        return True
+
+    def describe_last_tick(self):
+        """Строка с длительностью последнего тика и его фаз, самые долгие фазы первыми"""
+        phases = sorted(((duration, phase) for phase, duration in self.last_tick.items() if phase != TOTAL),
+                        reverse=True)
+        return (f'{self.last_tick.get(TOTAL, 0) * 1000:.1f} ms (' +
+                ', '.join(f'{phase} {duration * 1000:.1f}' for duration, phase in phases) + ')')
+
+    def histograms(self):
+        """Гистограммы фаз за последние одно-два окна"""
+        merged = {phase: Histogram() for phase in self.phases}
+        for phase, histogram in merged.items():
+            histogram.merge(self.previous[phase])
+            histogram.merge(self.current[phase])
+        return merged
+
+
+def merge_histograms(profilers):
+    """Суммирует гистограммы нескольких профилировщиков (например, всех комнат сервера)"""
+    merged = {}
+    for profiler in profilers:
+        for phase, histogram in profiler.histograms().items():
+            merged.setdefault(phase, Histogram()).merge(histogram)
+    return merged
+
+
+def format_histograms(histograms, percents=(50, 90, 99)):
+    """Таблица процентилей, среднего и максимума по фазам, мс"""
+    header = f'{"phase":>11} {"ticks":>7} ' + ' '.join(f'{"p" + str(p):>7}' for p in percents) + \
+             f' {"mean":>7} {"max":>7}'
+    lines = [header]
+    for phase, histogram in histograms.items():
+        lines.append(f'{phase:>11} {histogram.count:>7} ' +
+                     ' '.join(f'{histogram.percentile(p) * 1000:>7.2f}' for p in percents) +
+                     f' {histogram.mean() * 1000:>7.2f} {histogram.max * 1000:>7.2f}')
+    return lines
+
+
+def format_rooms_report(rooms):
+    """Отчёт о тиках комнат сервера: сводные процентили по всем комнатам и комнаты, не укладывающиеся в бюджет"""
+    lines = [f'{len(rooms)} rooms']
+    lines += format_histograms(merge_histograms(room.game.profiler for room in rooms))
+    for room in rooms:
+        profiler = room.game.profiler
+        if profiler.over_budget:
+            lines.append(f'room {room.number}: {profiler.over_budget} ticks over budget, '
+                         f'p99 {profiler.histograms()[TOTAL].percentile(99) * 1000:.2f} ms, '
+                         f'last tick {profiler.describe_last_tick()}')
+    return lines
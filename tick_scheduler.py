@@ -0,0 +1,120 @@
+import time
+import asyncio
+import traceback
+from threading import Lock, Event
+from constants import TICK
+
+
+# В этом файле находится планировщик игровых тиков, общий для всех комнат сервера
+
+
+class TickClock:
+    """Игровые часы одной комнаты: хранят привязку игрового времени к реальному и статистику тиков"""
+    def __init__(self, start_time, tick):
+        self.start_time = start_time  # реальное время, в которое должен был выполниться нулевой тик
+        self.tick = tick
+        self.ticks = 0  # сколько тиков уже выполнено
+        self.lag = 0.  # насколько последний тик опоздал относительно своего расписания, сек
+        self.max_lag = 0.
+        self.overruns = 0  # сколько раз комната отставала больше чем на тик и догоняла расписание
+        self.skipped_ticks = 0  # тики, пропущенные из-за слишком большого отставания
+        self.tick_rate = 0.  # измеренная частота тиков, тиков/сек
+        self.rate_window_start = start_time
+        self.rate_window_ticks = 0
+        self.on_error = None  # вызывается, если тик игры завершился исключением
+
+    def next_tick_time(self):
+        return self.start_time + self.ticks * self.tick
+
+    def ticks_due(self, now):
+        """Сколько тиков должно быть выполнено к моменту now, чтобы игра шла вровень с реальным временем"""
+        return int((now - self.start_time) / self.tick) + 1 - self.ticks
+
+    def update_tick_rate(self, now):
+        elapsed = now - self.rate_window_start
+        if elapsed >= 1:
+            self.tick_rate = self.rate_window_ticks / elapsed
+            self.rate_window_start = now
+            self.rate_window_ticks = 0
+
+
+class TickScheduler:
+    """Планировщик тиков с фиксированным шагом.
+    Игровое время каждой комнаты привязано к реальному, поэтому скорость игры не зависит от задержек планирования.
+    После зависания комната догоняет расписание, но не более чем max_substeps тиками за раз,
+    остальное отставание отбрасывается. Один таймер обслуживает тики всех зарегистрированных комнат"""
+    def __init__(self, tick=TICK, max_substeps=5):
+        self.tick = tick
+        self.max_substeps = max_substeps
+        self.clocks = {}  # игра -> её игровые часы
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def add(self, game, on_error=None):
+        """Регистрирует игру (любой объект с методом update) и возвращает её игровые часы.
+        Если тик игры завершится исключением, игра снимается с планировщика и вызывается on_error"""
+        clock = TickClock(time.perf_counter(), self.tick)
+        clock.on_error = on_error
+        with self.lock:
+            self.clocks[game] = clock
+        return clock
+
+    def remove(self, game):
+        with self.lock:
+            self.clocks.pop(game, None)
+
+    def __len__(self):
+        return len(self.clocks)
+
+    def run_due_ticks(self):
+        """Выполняет все тики, время которых наступило, и возвращает время следующего тика"""
+        with self.lock:
+            clocks = list(self.clocks.items())
+        next_tick_time = time.perf_counter() + self.tick
+        for game, clock in clocks:
+            now = time.perf_counter()
+            ticks_due = clock.ticks_due(now)
+            if ticks_due > 1:
+                clock.overruns += 1
+                if ticks_due > self.max_substeps:
+                    # Отставание слишком большое - сдвигаем расписание, чтобы не пытаться догнать его бесконечно:
+                    skipped = ticks_due - self.max_substeps
+                    clock.start_time += skipped * self.tick
+                    clock.skipped_ticks += skipped
+                    ticks_due = self.max_substeps
+            for _ in range(ticks_due):
+                clock.lag = now - clock.next_tick_time()
+                clock.max_lag = max(clock.max_lag, clock.lag)
+                try:
+                    game.update()
+                except Exception:
+                    # Ошибка в одной комнате не должна останавливать остальные
+                    traceback.print_exc()
+                    self.remove(game)
+                    if clock.on_error is not None:
+                        try:
+                            clock.on_error()
+                        except Exception:
+                            traceback.print_exc()
+                    break
+                clock.ticks += 1
+                clock.rate_window_ticks += 1
+            clock.update_tick_rate(now)
+            next_tick_time = min(next_tick_time, clock.next_tick_time())
+        return next_tick_time
+
+    def run(self):
+        """Цикл планировщика для многопоточного сервера, выполняется в отдельном потоке"""
+        while not self.stopped.is_set():
+            delay = self.run_due_ticks() - time.perf_counter()
+            if delay > 0:
+                self.stopped.wait(delay)
+
+    async def run_async(self):
+        """Цикл планировщика для асинхронного сервера, выполняется как задача asyncio"""
+        while not self.stopped.is_set():
+            delay = self.run_due_ticks() - time.perf_counter()
+            await asyncio.sleep(max(delay, 0))
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,46 @@
+# В этом файле находится колесо таймеров, по которому игра будит объекты на нужном тике, вместо того чтобы
+# каждый тик проверять все объекты: башни просыпаются, когда закончится перезарядка, а мобы наносят удар,
+# когда анимация атаки дойдёт до последнего кадра
+
+WHEEL_SIZE = 256  # число ячеек колеса, тиков
+
+
+class TimerWheel:
+    """Хешированное колесо таймеров. Событие на тике tick лежит в ячейке tick % size, поэтому постановка события
+    и выборка событий тика не зависят от того, сколько всего событий ждёт своего тика.
+    Событие дальше чем на size тиков вперёд лежит в своей ячейке, пока колесо не сделает нужное число оборотов.
+    Колесо нужно переводить на каждый тик по порядку (см. advance)"""
+    def __init__(self, size=WHEEL_SIZE):
+        self.size = size
+        self.slots = [[] for _ in range(size)]  # ячейки со списками (тик, объект)
+        self.tick = 0  # тик, на который колесо переведено последним
+        self.count = 0
+
+    def schedule(self, tick, item):
+        """Ставит объект item на тик tick, который ещё не наступил"""
+        if tick <= self.tick:
+            raise ValueError(f'Tick {tick} has already come')
+        self.slots[tick % self.size].append((tick, item))
+        self.count += 1
+
+    def cancel(self, tick, item):
+        """Снимает объект, поставленный на тик tick"""
+        self.slots[tick % self.size].remove((tick, item))
+        self.count -= 1
+
+    def advance(self, tick):
+        """Переводит колесо на тик tick и возвращает объекты, поставленные на этот тик, в порядке постановки"""
+        self.tick = tick
+        slot = self.slots[tick % self.size]
+        if not slot:
+            return []
+        due = [item for event_tick, item in slot if event_tick == tick]
+        if len(due) == len(slot):
+            slot.clear()
+        else:
+            slot[:] = [event for event in slot if event[0] != tick]
+        self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
@@ -1,4 +1,6 @@
 from constants import PLAYER_1, PLAYER_2
+from bisect import bisect_left
+from itertools import accumulate
 import os
 import math
 
@@ -12,8 +14,85 @@ def opponent(player):
     return PLAYER_1
 
 
+def get_segment(point_1, point_2):
+    """Возвращает смещение, длину и единичный вектор направления отрезка между двумя точками"""
+    d_x, d_y = point_2[0] - point_1[0], point_2[1] - point_1[1]
+    length = math.hypot(d_x, d_y)
+    if length == 0:
+        return d_x, d_y, length, 0., 0.
+    return d_x, d_y, length, d_x / length, d_y / length
+
+
+class Way(tuple):
+    """Маршрут моба - кортеж точек. Вместе с точками хранит посчитанные один раз параметры отрезков маршрута,
+    расстояния от начала маршрута до каждой точки и таблицы шагов мобов с разными скоростями"""
+    def __new__(cls, points, segments=None, base=None, base_index=0):
+        way = super().__new__(cls, points)
+        if segments is None:
+            segments = tuple(get_segment(point_1, point_2) for point_1, point_2 in zip(way, way[1:]))
+        way.segments = segments  # (d_x, d_y, длина, направление по x, направление по y) для каждого отрезка
+        way.distances = tuple(accumulate((segment[2] for segment in segments), initial=0.))
+        way.base = base  # маршрут, из конца которого составлен этот маршрут (см. starting_at)
+        way.base_index = base_index
+        way.steps_tables = {}  # скорость моба -> таблица шагов
+        return way
+
+    def reversed(self):
+        return Way(self[::-1])
+
+    def starting_at(self, coords, index):
+        """Возвращает маршрут из точки coords в точку с номером index и далее по этому маршруту.
+        Параметры отрезков берутся из этого маршрута, заново считается только первый отрезок"""
+        return Way((tuple(coords),) + self[index:], (get_segment(coords, self[index]),) + self.segments[index:],
+                   self, index)
+
+    def get_steps_table(self, velocity):
+        """Возвращает для каждого отрезка, сколько целых шагов моб со скоростью velocity делает по нему
+        и на сколько сдвигается за шаг по x и по y"""
+        table = self.steps_tables.get(velocity)
+        if table is None:
+            if self.base is not None:
+                first_segment = self.make_steps_table(self.segments[:1], velocity)
+                table = first_segment + self.base.get_steps_table(velocity)[self.base_index:]
+            else:
+                table = self.make_steps_table(self.segments, velocity)
+            self.steps_tables[velocity] = table
+        return table
+
+    @staticmethod
+    def make_steps_table(segments, velocity):
+        table = []
+        for d_x, d_y, length, _, _ in segments:
+            steps = length // velocity
+            if steps == 0:
+                steps = 1
+            table.append((steps, d_x / steps, d_y / steps))
+        return tuple(table)
+
+    def get_position(self, pos, coords, steps_to_next_point, velocity, delta_steps):
+        """Возвращает точку, в которой окажется моб через delta_steps шагов, если сейчас он в coords,
+        идёт к точке с номером pos и до неё ему осталось steps_to_next_point шагов.
+        Нужный отрезок маршрута находится двоичным поиском по расстояниям от начала маршрута.
+        Как и раньше, на последнем отрезке маршрута моб считается уже дошедшим до конца"""
+        last = len(self) - 1
+        if pos >= last:
+            return self[-1]
+        if steps_to_next_point >= delta_steps:
+            next_point = self[pos]
+            return (coords[0] + (next_point[0] - coords[0]) / steps_to_next_point * delta_steps,
+                    coords[1] + (next_point[1] - coords[1]) / steps_to_next_point * delta_steps)
+        distance = self.distances[pos] + (delta_steps - steps_to_next_point) * velocity
+        index = bisect_left(self.distances, distance, pos + 1, last)
+        if index == last:
+            return self[-1]
+        start_point = self[index - 1]
+        _, _, _, direction_x, direction_y = self.segments[index - 1]
+        travelled = distance - self.distances[index - 1]
+        return start_point[0] + direction_x * travelled, start_point[1] + direction_y * travelled
+
+
 def load_ways(map_dir):
-    """Загружает пути для мобов на конкретной карте из csv файла и возмращает кортеж из точек маршрута"""
+    """Загружает пути для мобов на конкретной карте из csv файла и возмращает их в виде маршрутов Way"""
     ways = []
     path_to_roads = os.path.join(map_dir, 'ways')
     for road in sorted(os.listdir(path_to_roads)):
@@ -25,9 +104,18 @@ def load_ways(map_dir):
                     ways[-1].append([])
                     for line in f.readlines():
                         ways[-1][-1].append(tuple(map(float, line.rstrip().split(';'))))
-                    ways[-1][-1] = tuple(ways[-1][-1])
+                    ways[-1][-1] = Way(ways[-1][-1])
     return ways
 
 
 def calculate_distance_between_points(x, y, x1, y1):
     return math.hypot(x - x1, y - y1)
+
+
+def is_alive(mob):
+    return mob.state != 'death'
+
+
+def tagged_first(mob):
+    """Ключ сортировки, с которым помеченные игроком мобы идут раньше остальных"""
+    return not mob.tagged
@@ -0,0 +1,254 @@
+import gc
+import os
+import sys
+import time
+import signal
+import socket
+import struct
+import asyncio
+import selectors
+import multiprocessing
+from threading import Thread
+from server import (Lobby, create_server_socket, start_client_processing, async_client_joining, handle_report_signal,
+                    SERVER, PORT, FRAMED, SEND_RATE)
+from tick_scheduler import TickScheduler
+from metrics import start_metrics_server, collect_lobby_metrics, collect_workers_metrics
+
+
+# В этом файле находится многопроцессный режим сервера: комнаты распределяются между несколькими
+# процессами-обработчиками, чтобы сервер мог занять все ядра процессора.
+# Главный процесс только принимает подключения и передаёт сокет клиента (файловый дескриптор) обработчику,
+# у которого меньше всего игроков. Оба игрока одной комнаты передаются одному обработчику.
+# Обработчики создаются через fork, поэтому загруженные до этого неизменяемые данные (маршруты мобов
+# P_1_WAYS/P_2_WAYS, шаблоны мобов) не копируются, а разделяются процессами, пока их никто не меняет
+
+REPORT = struct.Struct('!IIB')  # отчёт обработчика: сколько клиентов он принял, сколько игроков в игре, ждёт ли комната
+REPORT_INTERVAL = 0.25  # как часто обработчик сообщает главному процессу о своей загрузке, сек
+ACK_TIMEOUT = 5  # сколько главный процесс ждёт, пока обработчик примет клиента, сек
+MAX_FDS = 16  # сколько дескрипторов можно получить одним сообщением
+
+
+class Worker:
+    """Процесс-обработчик глазами главного процесса"""
+    def __init__(self, process, control):
+        self.process = process
+        self.control = control  # сокет, через который передаются клиенты и приходят отчёты
+        self.sent = 0  # сколько клиентов передано обработчику
+        self.received = 0  # сколько из них обработчик получил к моменту последнего отчёта
+        self.players = 0
+        self.waiting = False
+
+    def send(self, conn):
+        """Передаёт клиента обработчику и ждёт, пока тот посадит его в комнату.
+        Так главный процесс всегда знает, у какого обработчика есть комната, ожидающая второго игрока"""
+        socket.send_fds(self.control, [b'c'], [conn.fileno()])
+        self.sent += 1
+        self.control.settimeout(ACK_TIMEOUT)
+        try:
+            while self.received < self.sent:
+                if not self.read_report():
+                    raise ConnectionError('Worker has stopped')
+        finally:
+            self.control.settimeout(None)
+
+    def read_report(self):
+        """Читает отчёт обработчика. Возвращает False, если обработчик завершился"""
+        data = self.control.recv(REPORT.size)
+        if not data:
+            return False
+        received, players, waiting = REPORT.unpack(data)
+        # Отчёт, собранный до подтверждения последнего клиента (у многопоточного обработчика), уже устарел:
+        if received >= self.received:
+            self.received, self.players, self.waiting = received, players, waiting
+        return True
+
+
+def choose_worker(workers):
+    """Выбирает обработчика для нового клиента: клиент становится вторым игроком в ожидающей комнате,
+    а если такой нет - достаётся обработчику с наименьшим числом игроков"""
+    for worker in workers:
+        if worker.waiting:
+            return worker
+    return min(workers, key=lambda worker: worker.players)
+
+
+def start_workers(count, inherited, mode, protocol, send_rate, game_class, metrics_port=0, input_log_dir=None,
+                  record_dir=None):
+    context = multiprocessing.get_context('fork')
+    # Объекты, созданные до fork, больше не трогает сборщик мусора, чтобы не копировались занятые ими страницы:
+    gc.freeze()
+    workers = []
+    for number in range(count):
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # Дочерний процесс закрывает унаследованные сокеты главного процесса и других обработчиков:
+        inherited_sockets = inherited + [control] + [worker.control for worker in workers]
+        # Обработчик отдаёт метрики своих комнат на своём порту, следующем за портом метрик главного процесса:
+        worker_metrics_port = metrics_port + 1 + number if metrics_port else 0
+        process = context.Process(target=run_worker, daemon=True,
+                                  args=(worker_control, inherited_sockets, mode, protocol, send_rate, game_class,
+                                        worker_metrics_port, input_log_dir, record_dir))
+        process.start()
+        worker_control.close()
+        workers.append(Worker(process, control))
+    return workers
+
+
+def run_master(host=SERVER, port=PORT, workers_count=2, mode='asyncio', protocol=FRAMED, send_rate=SEND_RATE,
+               game_class=None, metrics_port=0, input_log_dir=None, record_dir=None):
+    """Главный процесс многопроцессного сервера: принимает клиентов и раздаёт их обработчикам"""
+    listener = create_server_socket(host, port)
+    workers = start_workers(workers_count, [listener], mode, protocol, send_rate, game_class, metrics_port,
+                            input_log_dir, record_dir)
+    if metrics_port:
+        start_metrics_server(lambda writer: collect_workers_metrics(workers, writer), metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Отчёт о времени тиков (см. Lobby.print_tick_report) выводит каждый обработчик про свои комнаты:
+    handle_report_signal(lambda: forward_signal(workers, signal.SIGUSR1))
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    for worker in workers:
+        selector.register(worker.control, selectors.EVENT_READ, worker)
+    try:
+        while workers:
+            for key, _ in selector.select():
+                worker = key.data
+                if worker is not None:
+                    if not worker.read_report():
+                        print('Worker has stopped')
+                        selector.unregister(worker.control)
+                        workers.remove(worker)
+                    continue
+                conn, addr = listener.accept()
+                print(f'Connected to {addr}')
+                while workers:
+                    worker = choose_worker(workers)
+                    try:
+                        worker.send(conn)
+                        break
+                    except OSError:
+                        selector.unregister(worker.control)
+                        workers.remove(worker)
+                conn.close()  # у обработчика осталась своя копия дескриптора
+    finally:
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
+
+
+def forward_signal(workers, signum):
+    for worker in workers:
+        try:
+            os.kill(worker.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def run_worker(control, inherited, mode, protocol, send_rate, game_class, metrics_port=0, input_log_dir=None,
+               record_dir=None):
+    """Процесс-обработчик: получает клиентов от главного процесса и ведёт их комнаты"""
+    for sock in inherited:
+        sock.close()
+    try:
+        if mode == 'threaded':
+            threaded_worker(control, protocol, send_rate, game_class, metrics_port, input_log_dir, record_dir)
+        else:
+            asyncio.run(async_worker(control, protocol, send_rate, game_class, metrics_port, input_log_dir,
+                                     record_dir))
+    except KeyboardInterrupt:
+        pass
+
+
+def make_report(received, lobby):
+    return REPORT.pack(received, lobby.players_count(), lobby.is_waiting())
+
+
+def threaded_worker(control, protocol, send_rate, game_class, metrics_port=0, input_log_dir=None,
+                    record_dir=None):
+    """Обработчик многопоточного сервера: каждый клиент обслуживается своим потоком, как в clients_accepting"""
+    scheduler = TickScheduler()
+    Thread(target=scheduler.run, daemon=True).start()
+    lobby = Lobby(scheduler, protocol, send_rate, game_class, input_log_dir, record_dir)
+    if metrics_port:
+        start_metrics_server(lambda writer: collect_lobby_metrics(lobby, writer), metrics_port)
+    handle_report_signal(lobby.print_tick_report)
+    received = 0
+
+    def reporting():
+        report = None
+        while True:
+            new_report = make_report(received, lobby)
+            if new_report != report:
+                control.send(new_report)
+                report = new_report
+            time.sleep(REPORT_INTERVAL)
+
+    Thread(target=reporting, daemon=True).start()
+    while True:
+        message, fds, _, _ = socket.recv_fds(control, 1, MAX_FDS)
+        if not message:
+            break  # главный процесс завершился
+        for fd in fds:
+            start_client_processing(socket.socket(fileno=fd), lobby)
+            received += 1
+            control.send(make_report(received, lobby))  # подтверждение для главного процесса
+
+
+async def async_worker(control, protocol, send_rate, game_class, metrics_port=0, input_log_dir=None,
+                       record_dir=None):
+    """Обработчик асинхронного сервера: все его клиенты и комнаты обслуживаются одним циклом событий"""
+    scheduler = TickScheduler()
+    scheduler_task = asyncio.create_task(scheduler.run_async())
+    lobby = Lobby(scheduler, protocol, send_rate, game_class, input_log_dir, record_dir)
+    if metrics_port:
+        start_metrics_server(lambda writer: collect_lobby_metrics(lobby, writer), metrics_port)
+    received = 0
+    loop = asyncio.get_running_loop()
+    handle_report_signal(lobby.print_tick_report, loop)
+    stopped = loop.create_future()
+    control.setblocking(False)
+
+    def acknowledge():
+        """Подтверждает главному процессу, что очередной клиент принят"""
+        nonlocal received
+        received += 1
+        control.send(make_report(received, lobby))
+
+    async def serve(conn):
+        try:
+            reader, writer = await asyncio.open_connection(sock=conn)
+        except OSError:
+            conn.close()  # клиент отключился, пока его передавали обработчику
+            acknowledge()
+            return
+        await async_client_joining(reader, writer, lobby, acknowledge)
+
+    def on_control():
+        try:
+            message, fds, _, _ = socket.recv_fds(control, 1, MAX_FDS)
+        except BlockingIOError:
+            return
+        if not message:
+            if not stopped.done():
+                stopped.set_result(None)  # главный процесс завершился
+            return
+        for fd in fds:
+            asyncio.create_task(serve(socket.socket(fileno=fd)))
+
+    async def reporting():
+        report = None
+        while True:
+            new_report = make_report(received, lobby)
+            if new_report != report:
+                control.send(new_report)
+                report = new_report
+            await asyncio.sleep(REPORT_INTERVAL)
+
+    loop.add_reader(control.fileno(), on_control)
+    reporting_task = asyncio.create_task(reporting())
+    try:
+        await stopped
+    finally:
+        reporting_task.cancel()
+        scheduler.stop()
+        await scheduler_task